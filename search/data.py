@@ -387,12 +387,31 @@ class ProfileData:
                     result[(x, i)] = p[x]
         return result
 
+    # the result only depends on the gpu type of each device and the batch size, which is used as the cache key.
+    # The returned dict is shared between calls and should not be modified.
     def to_tge(self, topo_spec, batch_size):
-        gtypes = [ gtype for name, gtype, memory in topo_spec.devices() ]
-        nrep = len(gtypes)
-        cache = { gtype: self.to_tge_single(gtype, batch_size, nrep) for gtype in ProfileData.ALL_GTYPES }
-        result = {}
-        for key in cache[gtypes[0]]:
-            result[key] = [ cache[gtype][key] for gtype in gtypes ]
-
-        return result
+        gtypes = tuple( gtype for name, gtype, memory in topo_spec.devices() )
+        tge_cache = self.__dict__.setdefault('tge_cache', {})
+        if (gtypes, batch_size) not in tge_cache:
+            nrep = len(gtypes)
+            cache = { gtype: self.to_tge_single(gtype, batch_size, nrep) for gtype in ProfileData.ALL_GTYPES }
+            result = {}
+            for key in cache[gtypes[0]]:
+                result[key] = [ cache[gtype][key] for gtype in gtypes ]
+            tge_cache[(gtypes, batch_size)] = result
+
+        return tge_cache[(gtypes, batch_size)]
+
+    # a tge.Profile of the nodes of gdef that can be shared by all evaluations on the same topology and batch size
+    def to_tge_profile(self, gdef, topo_spec, batch_size):
+        gtypes = tuple( gtype for name, gtype, memory in topo_spec.devices() )
+        profile_cache = self.__dict__.setdefault('tge_profile_cache', {})
+        if (gtypes, batch_size) not in profile_cache:
+            profile_cache[(gtypes, batch_size)] = tge.Profile(self.to_tge(topo_spec, batch_size), gdef)
+        return profile_cache[(gtypes, batch_size)]
+
+    def __getstate__(self): # the caches are derived data and the profiles hold pointers into libtge
+        state = self.__dict__.copy()
+        state.pop('tge_cache', None)
+        state.pop('tge_profile_cache', None)
+        return state
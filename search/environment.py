@@ -1,31 +1,84 @@
+import tge
 from tge import TGE
 from utils import car, cadr, cdr, info
 from metis import metis
 import numpy as np
 import tensorflow as tf
-import tempfile
-import os
-import json
 
-def evaluate_with_feedback(state, trace=""):
-    record = state.record
-    strategy = state.dump_strategy()
+# count variables and Adam slots and estimate fragmentation so invalidity() reflects real OOMs
+MEMORY_MODEL = { "persistent": True, "fragmentation": True }
+
+# the list scheduler (e.g. "peft") used to see if strategies that run out of memory would fit with the ops reordered. None disables it.
+# It costs an extra compile and simulation per OOM state, and the reordering is not part of the strategy, so it does not change their validity.
+MEMORY_SCHEDULER = None
 
+def _create_tge(state):
+    record = state.record
     tge = TGE(record['gdef'], [device for device, _ in record['device_list']], sinks=["Adam"])
-    tge.set_strategy(strategy)
+    tge.set_strategy(state.dump_strategy())
     tge.fill_batchsize(record['batchsize'])
     tge.replace_placeholder(record['batchsize'])
     tge.set_topology(*record["topology_for_simulator"])
     tge.set_nccl_model(record["nccl_models"])
+    tge.set_memory_model(**MEMORY_MODEL)
+    return tge
 
-    temp_path = tempfile.mktemp()
-    time, mem = tge.evaluate(record["prof_data"].to_tge(record["topo_spec"], record['batchsize']), chrome_path=trace, dump_path=temp_path)
-    feedback = json.load(open(temp_path, "r"))
-    feedback["peak_memory"] = mem
-    os.remove(temp_path)
+def evaluate_with_feedback(state, trace=""):
+    """the feedback is a dict of arrays. Ops are indexed in the order of record['gdef'].node"""
+    record = state.record
+    tge = _create_tge(state)
+
+    time, mem, feedback = tge.evaluate(record["prof_data"].to_tge_profile(record['gdef'], record["topo_spec"], record['batchsize']), chrome_path=trace, feedback=True)
+    feedback["peak_memory"] = feedback["device_peak_memory"] = mem
 
     return time, feedback
 
+def record_timeline(state):
+    """the timeline of the simulation of a state, so states that differ from it in a few actions can be evaluated incrementally"""
+    record = state.record
+    return _create_tge(state).record_timeline(record["prof_data"].to_tge_profile(record['gdef'], record["topo_spec"], record['batchsize']))
+
+def evaluate_batch_with_feedback(states, timeline=None):
+    """evaluate states of the same record in parallel. Returns a list of (time, feedback) in the same format of evaluate_with_feedback"""
+    if len(states) == 0:
+        return []
+
+    record = states[0].record
+    times, peak_memories, feedback = tge.evaluate_batch(
+        record['gdef'], [device for device, _ in record['device_list']], [state.dump_strategy() for state in states],
+        record["prof_data"].to_tge_profile(record['gdef'], record["topo_spec"], record['batchsize']),
+        topology=record["topology_for_simulator"], nccl_model=record["nccl_models"], sinks=["Adam"],
+        options={ "fill_batchsize": record['batchsize'], "replace_placeholder": record['batchsize'] },
+        target_options=tge.memory_model_options(**MEMORY_MODEL), timeline=timeline
+    )
+
+    results = []
+    for i, time in enumerate(times.tolist()):
+        mem = peak_memories[i].tolist()
+        results.append((time, { **{ k: v[i] for k, v in feedback.items() }, "peak_memory": mem, "device_peak_memory": mem }))
+    return results
+
+def evaluate_with_memory_schedule(state, feedback, trace=""):
+    """
+    evaluate a state again with the ops reordered by MEMORY_SCHEDULER under the memory of each device.
+    The result is added to feedback as "memory_scheduled_time" and "memory_scheduled_peak_memory". Returns feedback.
+    """
+    if MEMORY_SCHEDULER is None:
+        return feedback
+
+    record = state.record
+    profile = record["prof_data"].to_tge_profile(record['gdef'], record["topo_spec"], record['batchsize'])
+    memory_limit = [record["topo_spec"].tasks[task_id].memory for _, task_id in record["device_list"]]
+
+    tge = _create_tge(state)
+    tge.schedule(profile, MEMORY_SCHEDULER, add_control_dependency=True, memory_limit=memory_limit)
+    scheduled_time, mem = tge.evaluate(profile, chrome_path=trace)
+
+    info("memory schedule: peak memory {} -> {}".format(feedback["peak_memory"], mem))
+    feedback["memory_scheduled_time"] = scheduled_time
+    feedback["memory_scheduled_peak_memory"] = mem
+    return feedback
+
 def invalidity(record, feedback): # 0 means valid
     oom = 0
     for peak_memory, (_, task_id) in zip(feedback["peak_memory"], record["device_list"]):
@@ -7,7 +7,7 @@ from data import TopoSpec, TopoSpecTask, ProfileData, device_name, gen_topology_
 from grouping import group_with_topk_nodes, group_with_tge_basegroups
 from utils import info, load
 from metis import metis
-from environment import evaluate_with_feedback, invalidity
+from environment import evaluate_with_feedback, evaluate_batch_with_feedback, evaluate_with_memory_schedule, record_timeline, invalidity
 from scipy.special import softmax
 
 @dataclass
@@ -51,14 +51,24 @@ class State:
 
     def evaluate(self):
         if self.result is None:
-            time, feedback = evaluate_with_feedback(self)
-
-            speed_up = -1 if invalidity(self.record, feedback) > 0 else self.baseline[0] / time - 1
-            if speed_up > 1:
-                speed_up = np.sqrt(np.sqrt(speed_up))
-            self.result = speed_up, feedback
+            self.set_result(*evaluate_with_feedback(self))
         return self.result
 
+    @staticmethod
+    def evaluate_all(states, parent=None): # evaluate the states that have no result yet in a single batch. If the parent state is given, the simulations resume from its timeline
+        states = [ state for state in states if state.result is None ]
+        timeline = record_timeline(parent) if parent is not None and len(states) > 1 else None
+        for state, (time, feedback) in zip(states, evaluate_batch_with_feedback(states, timeline)):
+            state.set_result(time, feedback)
+
+    def set_result(self, time, feedback):
+        if invalidity(self.record, feedback) > 0: # see if reordering the ops would fit in memory
+            feedback = evaluate_with_memory_schedule(self, feedback)
+        speed_up = -1 if invalidity(self.record, feedback) > 0 else self.baseline[0] / time - 1
+        if speed_up > 1:
+            speed_up = np.sqrt(np.sqrt(speed_up))
+        self.result = speed_up, feedback
+
     def get_action(self, i):
         if len(self.actions) == 0:
             return self.baseline[1]
@@ -179,6 +189,8 @@ class Node:
         for child in self.children:
             child.c = np.sqrt(len(self.children) / 10)
 
+        State.evaluate_all([ child.state for child in self.children ], self.state if options.incremental else None)
+
         if options.policy_fun is not None:
             log_ps = options.policy_fun(self.state, (child.action for child in self.children))
 
@@ -192,9 +204,12 @@ class Node:
         np.random.shuffle(self.children)
 
 class Tree:
-    def __init__(self, record, policy_fun, real_topo=False): # real_topo controls whether we should filter out the un-dividable replications
+    # real_topo controls whether we should filter out the un-dividable replications
+    # incremental controls whether the children of a node resume the simulation of the node. It only saves time when actions leave the early events (e.g. the variables) unchanged, since it costs an extra simulation per expansion
+    def __init__(self, record, policy_fun, real_topo=False, incremental=False):
         self.policy_fun = policy_fun
         self.real_topo = real_topo
+        self.incremental = incremental
         self.root = Node(State.new(record))
 
     def playout(self, ntimes, trace_fun=None):
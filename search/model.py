@@ -6,6 +6,9 @@ from utils import info, positional_encoding
 
 all_etypes = ["link", "prev", "succ", "place", "serve"]
 
+# add the slack and critical time of op groups and the critical share of devices to the runtime features. It changes the input width, so it must match the saved model
+CRITICAL_PATH_FEATURES = False
+
 class GConv(tf.keras.layers.Layer):
     '''Graph Conv layer that concats the edge features before sending message'''
     def __init__(self, out_feats, activation=None):
@@ -233,17 +236,21 @@ def encode_features(state):
     for group in record['op_groups']:
         op_makespan = 0 # TODO: use the overall makespan of the group, rather than the average of each op
         op_idle_after = 0
+        op_slack = 0
+        op_critical_time = 0
         for node_id in group:
-            node_def = record['gdef'].node[node_id]
-            # if node.name not in feedback['op_makespan'] or node.name not in feedback['op_idle_after']:
-                # info(node.name)
-            op_makespan += feedback['op_makespan'].get(node_def.name, 0) / CL2 # the ratio of makespan and computation time?
-            op_idle_after += feedback['op_idle_after'].get(node_def.name, 0) / CL2
+            op_makespan += feedback['op_makespan'][node_id] / CL2 # the ratio of makespan and computation time?
+            op_idle_after += feedback['op_idle_after'][node_id] / CL2
+            op_slack += feedback['op_slack'][node_id] / CL2
+            op_critical_time += feedback['op_critical_time'][node_id] / CL2
 
         op_feedbacks.append([
             op_makespan / len(group),
             op_idle_after / len(group),
-        ])
+        ] + ([
+            op_slack / len(group),
+            op_critical_time / len(group),
+        ] if CRITICAL_PATH_FEATURES else []))
 
     op_communication_strategy = [ state.get_action(gid).to_mask()[1] for gid in range(len(record['op_groups'])) ]
 
@@ -262,8 +269,13 @@ def encode_features(state):
     device_feats = np.hstack((
         record["device_feats"],
         [ [ max( feedback['device_peak_memory'][i] / record['topo_spec'].tasks[tid].memory for i in range(len(record['device_segments'])) if tid == record['device_segments'][i] ) ] for tid in range(record['topo_spec'].ntasks) ],
-        [ [ np.average( [feedback['device_total_utilization'][i] for i in range(len(record['device_segments'])) if tid == record['device_segments'][i]] ) ] for tid in range(record['topo_spec'].ntasks) ]
+        [ [ np.average( [feedback['device_total_utilization'][i] for i in range(len(record['device_segments'])) if tid == record['device_segments'][i]] ) ] for tid in range(record['topo_spec'].ntasks) ],
     ))
+    if CRITICAL_PATH_FEATURES:
+        device_feats = np.hstack((
+            device_feats,
+            [ [ np.average( [feedback['device_critical_time'][i] / max(feedback['device_busy_time'][i], 1) for i in range(len(record['device_segments'])) if tid == record['device_segments'][i]] ) ] for tid in range(record['topo_spec'].ntasks) ]
+        ))
 
     tensor_feats = record["tensor_feats"]
 
@@ -4,12 +4,17 @@ use crate::graph::*;
 use std::collections::{BTreeSet, BTreeMap};
 use crate::misc::Target;
 
-pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (Vec<usize>, i8)>) { // devices (the same definition of form), aggregation_method
+/// the i-th element is the decision for the i-th node in the graph: devices (the same definition of form), aggregation_method. None means the default (replicate on all devices)
+/// aggregation_method 5 marks a forward node for recomputation in the backward pass (see Graph::add_recomputation)
+pub type Strategy = [Option<(Vec<usize>, i8)>];
+
+pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &Strategy) {
     let allow_split_input = graph.options.contains_key("replace_placeholder");
 
     // do replications as the user requested
-    for node in graph.nodes.iter_mut() {
-        let s = strategy.get(&node.raw_node.name[..]).cloned();
+    for (node_id, node) in graph.nodes.iter_mut().enumerate() {
+        let s = strategy[node_id].as_ref();
+        node.renew();
 
         match &node.raw_node.op[..] {
             // TODO: RandomUniform, NoOp
@@ -20,10 +25,12 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
                 node.put_on_devices(&var.form.devices);
             }
             _ => match s {
-                Some((devices, _)) => node.put_on_devices(&devices),
+                Some((devices, _)) => node.put_on_devices(devices),
                 None => node.put_on_devices(&(0..target.ndev()).collect::<Vec<_>>()),
             }
         }
+
+        node.recompute = matches!(s, Some((_, 5)));
     }
 
     // hack: Tensorflow requires is_ref arguments to be on the same device. This includes variables and optimizer states
@@ -48,7 +55,7 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
             }
             let group = &node.group.as_ref().unwrap().borrow();
             let n = node.form.ndev();
-            if n > 1 && group.iter().map(|x| &node.graph().nodes[*x]).all(|x| x.form.ndev() == n && !matches!(strategy.get(&x.raw_node.name[..]), Some((_, 4)))) {
+            if n > 1 && group.iter().all(|&x| node.graph().nodes[x].form.ndev() == n && !matches!(strategy[x], Some((_, 4)))) {
                 for member in group.iter() {
                     let member = &mut node.graph().nodes[*member];
                     if member.inputs.is_empty() && member.is_input() {
@@ -67,21 +74,22 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
         }
     }
 
-    for node in graph.nodes.iter_mut() {
+    for (node_id, node) in graph.nodes.iter_mut().enumerate() {
         match &node.raw_node.op[..] {
             n if apply_nodes_dict(n).is_some() => {
                 node.form.kind = FormKind::Full;
                 node.inputs[apply_nodes_dict(n).unwrap()].2 = FormKind::Full;
                 let (id, index, _) = &node.inputs[apply_nodes_dict(n).unwrap()];
                 if node.replicated().unwrap() {
-                    let s = strategy.get(&node.raw_node.name[..]).cloned();
+                    let s = strategy[node_id].clone();
                     let grad = &mut node.graph().nodes[*id].get_output(*index);
                     if grad.node().form.is_part() { // is_part implies ndev > 1
                         let full = match s {
-                            Some((_, m @ 1..=3)) if grad.node().form.devices == node.form.devices => match m {
+                            Some((_, m)) if matches!(m, 1..=3 | 6) && grad.node().form.devices == node.form.devices => match m {
                                 1 => grad.all_reduce_sum_collective(&grad.node().form, &node.form, target),
                                 2 => grad.all_reduce_sum_ring(&grad.node().form, &node.form, target),
                                 3 => grad.all_reduce_sum_nccl(&grad.node().form, &node.form, target),
+                                6 => grad.all_reduce_sum_hierarchical(&grad.node().form, &node.form, target),
                                 _ => unreachable!()
                             },
                             _ => { // remember node.form.ndev() may not equal to grad.node().form.ndev()
@@ -94,7 +102,7 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
                                 }
                             }
                         };
-                        grad.forms.insert(node.form.clone(), full);
+                        grad.forms_mut().insert(node.form.clone(), full);
                     }
                 }
             },
@@ -106,7 +114,7 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
                 let (updates_id, updates_index, _) = &node.inputs[2];
                 assert!(node.graph().nodes[*indices_id].form == node.graph().nodes[*updates_id].form);
                 if node.replicated().unwrap() {
-                    let s = strategy.get(&node.raw_node.name[..]).cloned();
+                    let s = strategy[node_id].clone();
                     let indices = &mut node.graph().nodes[*indices_id].get_output(*indices_index);
                     if indices.node().form.is_part() {
                         let full = match s {
@@ -122,7 +130,7 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
                                 }
                             }
                         };
-                        indices.forms.insert(node.form.clone(), full);
+                        indices.forms_mut().insert(node.form.clone(), full);
                     }
 
                     let updates = &mut node.graph().nodes[*updates_id].get_output(*updates_index);
@@ -140,7 +148,7 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
                                 }
                             }
                         };
-                        updates.forms.insert(node.form.clone(), full);
+                        updates.forms_mut().insert(node.form.clone(), full);
                     }
                 }
             }
@@ -149,13 +157,11 @@ pub fn edit(graph: &mut Graph, target: &mut Target, strategy: &BTreeMap<&str, (V
     }
 }
 
+/// clear the decisions and the compiled names, so the graph can be edited and compiled again with a new target.
+/// It only starts a new generation; the nodes are cleared when `edit` visits them and the tensors when their forms are used.
 pub fn reset(graph: &mut Graph) {
-    for node in graph.nodes.iter_mut() {
-        node.form = Form { kind: FormKind::Full, devices: vec![] };
-        for (_, _, form) in node.inputs.iter_mut() {
-            *form = FormKind::Full
-        }
-    }
+    graph.generation += 1;
+    graph.collective_state = Default::default()
 }
 
 fn apply_nodes_dict(x: &str) -> Option<usize> { // get gradient input index if it is an "apply*" operation
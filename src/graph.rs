@@ -4,6 +4,7 @@ use crate::proto::{graph::GraphDef, node_def::NodeDef, attr_value::AttrValue, ty
 use std::collections::{BTreeMap, BTreeSet};
 use core::fmt::Write;
 use core::convert::TryInto;
+use core::cmp;
 use core::iter::FromIterator;
 use crate::proto::attr_value::AttrValue_ListValue;
 use core::hint::unreachable_unchecked;
@@ -36,44 +37,66 @@ impl CollectiveState {
     }
 }
 
+/// bumped when the format of `Graph::export_analysis` or the analysis itself changes
+pub const ANALYSIS_VERSION: u32 = 1;
+
 #[derive(Default)]
 pub struct Graph {
     pub nodes: Vec<Node>, // This vector is partial ordered: inputs are guaranteed to appear earlier than descendants
     pub options: BTreeMap<String, String>,
     pub name_dict: BTreeMap<String, usize>,
+    pub raw_order: Vec<usize>, // the i-th element is the id in `nodes` of the i-th NodeDef of the input GraphDef
+    pub generation: u64, // bumped by editor::reset. The decisions of nodes and the forms of tensors stamped with an older generation are stale
 
-    collective_state: CollectiveState
+    pub(crate) collective_state: CollectiveState
 }
 
 impl Graph {
     pub fn new(nodes: &[NodeDef]) -> Box<Self> {
-        task!("building graph of {} nodes...", nodes.len());
+        let mut g = Self::build(nodes);
+        g.analyze();
+        g
+    }
 
-        let mut g = Box::new(Graph { nodes: Vec::with_capacity(nodes.len()), ..Default::default() });
+    /// build a graph with the result of `export_analysis` of a graph created from the same nodes, skipping the analysis.
+    /// Falls back to analyzing if the analysis does not fit the nodes (e.g. it is exported by another version).
+    pub fn with_analysis(nodes: &[NodeDef], analysis: &[u32]) -> Box<Self> {
+        let mut g = Self::build(nodes);
+        if g.import_analysis(analysis).is_none() {
+            warn!("the analysis does not match the graph, analyzing again");
+            g.analyze()
+        }
+        g
+    }
 
-        // not always optimal, but good enough since the input is actually mostly ordered
-        let mut queue: std::collections::VecDeque::<_> = nodes.iter().collect();
-        'outer: while let Some(node_def) = queue.pop_front() {
-            for input in node_def.input.iter() {
-                let input = if input.starts_with('^') {
-                    &input[1..]
-                } else {
-                    parse_input(input).0
-                };
-                if !g.name_dict.contains_key(input) {
-                    debug!("pushing back {}", node_def.name);
-                    queue.push_back(node_def);
-                    continue 'outer;
-                }
-            }
+    /// a copy of the nodes, options and analysis, as if the graph is reset (see editor::reset). It skips sorting and analysis.
+    pub fn duplicate(&self) -> Box<Self> {
+        let mut g = Box::new(Graph {
+            nodes: Vec::with_capacity(self.nodes.len()), options: self.options.clone(),
+            name_dict: self.name_dict.clone(), raw_order: self.raw_order.clone(), ..Default::default()
+        });
+
+        for node in self.nodes.iter() {
+            let node = Node::new(&g, node.raw_node.clone());
+            g.nodes.push(node)
+        }
+
+        g.import_analysis(&self.export_analysis()).unwrap();
+        g
+    }
+
+    fn build(nodes: &[NodeDef]) -> Box<Self> {
+        task!("building graph of {} nodes...", nodes.len());
+
+        let mut g = Box::new(Graph { nodes: Vec::with_capacity(nodes.len()), raw_order: vec![0; nodes.len()], ..Default::default() });
 
-            let node = Node::new(&g, node_def.clone());
+        for raw_id in sort_nodes(nodes) {
+            let node = Node::new(&g, nodes[raw_id].clone());
             g.name_dict.insert(node.raw_node.name.clone(), g.nodes.len());
+            g.raw_order[raw_id] = g.nodes.len();
             g.nodes.push(node);
         }
 
-        g.analyze();
-
         g
     }
 
@@ -84,8 +107,19 @@ impl Graph {
             node.compile(target)
         }
 
+        if let Some(bucket_size) = self.options.get("collective_bucket_size") {
+            let bucket_size = bucket_size.parse().unwrap();
+            if bucket_size > 0 {
+                self.bucket_collective_nodes(target, bucket_size)
+            }
+        }
+
         self.add_control_dependencies_for_collective_nodes(target);
 
+        if self.nodes.iter().any(|node| node.recompute) {
+            self.add_recomputation(target);
+        }
+
         // TODO: integrate this into the compiling stage incase of we replicate the sinks in the future
         for sink in target.sinks.iter_mut() {
             *sink = format!("{}/replica_0", sink)
@@ -231,15 +265,382 @@ impl Graph {
         }).collect()
     }
 
+    /// the result of `analyze` as a flat array, so it can be saved to a file and mapped back. All numbers are u32, node ids are in the sorted order:
+    /// [ANALYSIS_VERSION, nnodes, ngroups, the group of each node (u32::MAX for none), offsets of each group (ngroups + 1) followed by the members,
+    /// offsets of the outputs of each node (nnodes + 1) followed by the flags of each output]
+    pub fn export_analysis(&self) -> Vec<u32> {
+        let mut group_id = BTreeMap::new();
+        let mut groups = vec![];
+        let node_groups: Vec<u32> = self.nodes.iter().map(|node| match &node.group {
+            Some(group) => *group_id.entry(group.as_ptr()).or_insert_with(|| { groups.push(group.clone()); groups.len() as u32 - 1 }),
+            None => u32::MAX
+        }).collect();
+
+        let mut result = vec![ANALYSIS_VERSION, self.nodes.len() as _, groups.len() as _];
+        result.extend(node_groups);
+        let mut offset = 0;
+        result.push(offset);
+        for group in groups.iter() {
+            offset += group.borrow().len() as u32;
+            result.push(offset)
+        }
+        for group in groups.iter() {
+            result.extend(group.borrow().iter().map(|&x| x as u32))
+        }
+        let mut offset = 0;
+        result.push(offset);
+        for node in self.nodes.iter() {
+            offset += node.outputs.len() as u32;
+            result.push(offset)
+        }
+        for node in self.nodes.iter() {
+            result.extend(node.outputs.iter().map(|tensor| tensor.flags as u32))
+        }
+        result
+    }
+
+    /// the inverse of `export_analysis`. Nothing is changed if the analysis does not fit.
+    fn import_analysis(&mut self, analysis: &[u32]) -> Option<()> {
+        let n = self.nodes.len();
+        let (version, nnodes, ngroups) = (*analysis.get(0)?, *analysis.get(1)? as usize, *analysis.get(2)? as usize);
+        if version != ANALYSIS_VERSION || nnodes != n {
+            return None
+        }
+
+        let node_groups = analysis.get(3..3+n)?;
+        let group_offsets = analysis.get(3+n..4+n+ngroups)?;
+        let members_start = 4 + n + ngroups;
+        let output_offsets_start = members_start + *group_offsets.last()? as usize;
+        let output_offsets = analysis.get(output_offsets_start..output_offsets_start+n+1)?;
+        let flags_start = output_offsets_start + n + 1;
+        if analysis.len() != flags_start + *output_offsets.last()? as usize {
+            return None
+        }
+
+        let mut groups: Vec<Group> = Vec::with_capacity(ngroups);
+        for i in 0..ngroups {
+            let members = analysis.get(members_start + group_offsets[i] as usize..members_start + group_offsets[i+1] as usize)?;
+            if members.iter().any(|&x| x as usize >= n) {
+                return None
+            }
+            groups.push(Rc::new(RefCell::new(members.iter().map(|&x| x as usize).collect())))
+        }
+        if node_groups.iter().any(|&x| x != u32::MAX && x as usize >= ngroups) || output_offsets.windows(2).any(|w| w[0] > w[1]) {
+            return None
+        }
+
+        for (node_id, node) in self.nodes.iter_mut().enumerate() {
+            node.group = groups.get(node_groups[node_id] as usize).cloned();
+            node.outputs.clear();
+            for (index, &flags) in analysis[flags_start + output_offsets[node_id] as usize..flags_start + output_offsets[node_id+1] as usize].iter().enumerate() {
+                node.get_output(index).flags = flags as _
+            }
+        }
+
+        Some(())
+    }
+
+    /// duplicate the forward nodes marked for recomputation (strategy 5) for the backward nodes that use them, so their outputs can be
+    /// freed after the forward pass. Connected marked nodes form a segment. The copies of a segment on a device that have no copied inputs
+    /// wait for the other inputs of the backward nodes that use the segment, so the segment is recomputed when the gradients reach it.
+    /// Such a dependency is skipped if it would form a cycle.
+    fn add_recomputation(&mut self, target: &mut Target) {
+        let recomputed: Vec<bool> = self.nodes.iter().map(|node| node.recompute && node.recomputable()).collect();
+
+        // segments as connected components of the recomputed nodes
+        let mut segments: Vec<usize> = (0..self.nodes.len()).collect();
+        fn find(segments: &mut [usize], x: usize) -> usize {
+            if segments[x] != x {
+                segments[x] = find(segments, segments[x])
+            }
+            segments[x]
+        }
+        for (node_id, node) in self.nodes.iter().enumerate() {
+            for &(input_id, _, _) in node.inputs.iter() {
+                if recomputed[node_id] && recomputed[input_id] {
+                    let (a, b) = (find(&mut segments, node_id), find(&mut segments, input_id));
+                    segments[a] = b
+                }
+            }
+        }
+
+        let mut name_dict: BTreeMap<String, usize> = target.pb.node.iter().enumerate().map(|(i, x)| (x.name.clone(), i)).collect();
+        let mut succs: Vec<Vec<usize>> = vec![vec![]; target.pb.node.len()];
+        for (i, node) in target.pb.node.iter().enumerate() {
+            for input in node.input.iter() {
+                succs[name_dict[input_node_name(input)]].push(i)
+            }
+        }
+
+        // 1. copy the replicas. copies: the name of a replica => the name of its copy
+        let mut copies: BTreeMap<String, String> = BTreeMap::new();
+        let mut units: BTreeMap<(usize, String), Vec<usize>> = BTreeMap::new(); // (segment, device) => the copies that have no copied inputs
+        for (node_id, node) in self.nodes.iter().enumerate() {
+            if !recomputed[node_id] {
+                continue
+            }
+            for replica_index in 0..node.form.ndev() {
+                let name = node.replica(replica_index);
+                let mut copy = target.pb.node[name_dict[&name]].clone();
+                copy.name = format!("{}/aux_recompute", name);
+                let mut is_root = true;
+                for input in copy.input.iter_mut() {
+                    if let Some(x) = copies.get(input_node_name(input)) {
+                        *input = input.replacen(input_node_name(input), x, 1);
+                        is_root = false
+                    }
+                }
+                let id = target.pb.node.len();
+                for input in copy.input.iter() {
+                    succs[name_dict[input_node_name(input)]].push(id)
+                }
+                if is_root {
+                    units.entry((find(&mut segments, node_id), copy.device.clone())).or_default().push(id)
+                }
+                copies.insert(name, copy.name.clone());
+                name_dict.insert(copy.name.clone(), id);
+                succs.push(vec![]);
+                target.pb.node.push(copy)
+            }
+        }
+
+        // 2. let the backward nodes use the copies. triggers: the copy => the other inputs of the backward nodes that use it
+        let mut triggers: BTreeMap<usize, BTreeSet<usize>> = BTreeMap::new();
+        for node in self.nodes.iter() {
+            if !node.is_backward() || node.inputs.iter().all(|&(input_id, _, _)| !recomputed[input_id]) {
+                continue
+            }
+            for replica_index in 0..node.form.ndev() {
+                let id = name_dict[&node.replica(replica_index)];
+                let mut used = vec![];
+                let mut others = vec![];
+                for input in target.pb.node[id].input.iter_mut() {
+                    if input.starts_with('^') {
+                        continue
+                    }
+                    match copies.get(input_node_name(input)) {
+                        Some(x) => {
+                            let copy_id = name_dict[x];
+                            *input = input.replacen(input_node_name(input), x, 1);
+                            succs[copy_id].push(id);
+                            used.push(copy_id)
+                        }
+                        None => others.push(name_dict[input_node_name(input)])
+                    }
+                }
+                for copy_id in used {
+                    triggers.entry(copy_id).or_default().extend(others.iter().copied())
+                }
+            }
+        }
+
+        // 3. delay the roots of each segment until the gradients arrive
+        for (_, roots) in units {
+            // the triggers of a unit are the triggers of all copies that descend from its roots
+            let mut descendants = BTreeSet::new();
+            let mut stack = roots.clone();
+            while let Some(i) = stack.pop() {
+                if descendants.insert(i) {
+                    stack.extend(succs[i].iter().copied())
+                }
+            }
+            let unit_triggers: BTreeSet<usize> = descendants.iter().filter_map(|i| triggers.get(i)).flatten().copied()
+                .filter(|i| !descendants.contains(i) && is_backward_name(origin_of(&target.pb.node[*i]))).collect();
+            for &root in roots.iter() {
+                for &trigger in unit_triggers.iter() {
+                    let dep = format!("^{}", target.pb.node[trigger].name);
+                    target.pb.node[root].input.push(dep);
+                    succs[trigger].push(root)
+                }
+            }
+        }
+    }
+
+    /// pack the all-reduces of the same devices and dtype into buckets of at most `bucket_size` bytes, i.e. flatten and concat the
+    /// tensors, all-reduce the buffer with one CollectiveReduce and split it back. The instances are sorted by the depth of their inputs in the
+    /// graph, which approximates the order that the gradients become ready in the backward pass, and the buckets take consecutive instances.
+    /// The instances are also chained in this order later. The original CollectiveReduce nodes become the Reshape nodes at the end, so their
+    /// consumers are kept.
+    fn bucket_collective_nodes(&mut self, target: &mut Target, bucket_size: u64) {
+        let edges = target.edges();
+        let (succ_offsets, succs) = edges.successors();
+        let mut indegrees: Vec<_> = (0..edges.len()).map(|i| edges.inputs(i).len()).collect();
+        let mut depths = vec![0; edges.len()];
+        let mut queue: Vec<_> = (0..indegrees.len()).filter(|&i| indegrees[i] == 0).collect();
+        while let Some(i) = queue.pop() {
+            for &j in &succs[succ_offsets[i]..succ_offsets[i+1]] {
+                depths[j] = cmp::max(depths[j], depths[i] + 1);
+                indegrees[j] -= 1;
+                if indegrees[j] == 0 {
+                    queue.push(j)
+                }
+            }
+        }
+
+        let instances = core::mem::take(&mut self.collective_state.instances);
+        let mut order: Vec<_> = (0..instances.len()).collect();
+        order.sort_by_key(|&k| (instances[k].iter().map(|&i| depths[i]).max().unwrap(), k));
+
+        // instances whose nodes lack any of the attributes used below (e.g. collectives in the input GraphDef) are left alone
+        let bucketable = |k: usize| instances[k].iter().all(|&i| ["group_key", "group_size", "final_op", "merge_op", "subdiv_offsets", "T", "_tge_input_sizes", "_tge_belong_to"].iter().all(|attr| target.pb.node[i].attr.contains_key(*attr)));
+
+        // (group_key, dtype) => the open bucket
+        let mut open: BTreeMap<(i64, i32), (Vec<usize>, u64)> = BTreeMap::new();
+        let mut units = vec![]; // the instances in each bucket, in the order of readiness
+        for k in order {
+            if !bucketable(k) {
+                units.push(vec![k]);
+                continue
+            }
+            let node = &target.pb.node[instances[k][0]];
+            let key = (node.attr["group_key"].get_i(), node.attr["T"].get_field_type() as i32);
+            let size = node.attr["_tge_input_sizes"].get_list().i[0] as u64;
+            let bucket = open.entry(key).or_insert_with(|| (vec![], 0));
+            if !bucket.0.is_empty() && bucket.1 + size > bucket_size {
+                units.push(core::mem::take(&mut bucket.0));
+                bucket.1 = 0
+            }
+            bucket.0.push(k);
+            bucket.1 += size
+        }
+        units.extend(open.into_iter().map(|(_, (bucket, _))| bucket));
+        units.sort_by_key(|unit| (unit.iter().map(|&k| instances[k].iter().map(|&i| depths[i]).max().unwrap()).max().unwrap(), unit[0]));
+
+        let int32 = || AttrValue::new().apply(|x| x.set_field_type(DataType::DT_INT32));
+        let mut result = vec![];
+        for unit in units {
+            if unit.len() == 1 {
+                result.push(instances[unit[0]].clone());
+                continue
+            }
+
+            let bucket_instance_key = instances.len() + result.len();
+            let mut bucket_instance = vec![];
+            for (d, &first) in instances[unit[0]].iter().enumerate() {
+                let members: Vec<usize> = unit.iter().map(|&k| instances[k][d]).collect();
+                let sizes: Vec<u64> = members.iter().map(|&i| target.pb.node[i].attr["_tge_input_sizes"].get_list().i[0] as u64).collect();
+                let template = target.pb.node[first].clone(); // the members are turned into Reshape below
+                let dtype = template.attr["T"].clone();
+                let base = format!("{}/aux_bucket", template.name);
+                let (device, belong_to) = (template.device.clone(), template.attr["_tge_belong_to"].clone());
+                let aux = |op: &str, name: &str| {
+                    let mut node = NodeDef::new();
+                    node.op = op.to_string();
+                    node.name = format!("{}/{}", base, name);
+                    node.device = device.clone();
+                    node.attr.insert("_tge_belong_to".into(), belong_to.clone());
+                    node
+                };
+
+                let mut flat_shape = aux("Const", "flat_shape");
+                flat_shape.attr.insert("dtype".into(), int32());
+                flat_shape.attr.insert("value".into(), AttrValue::new().apply(|x| x.set_tensor(crate::proto::tensor::TensorProto::new().apply(|x| {
+                    x.set_dtype(DataType::DT_INT32);
+                    x.set_tensor_shape(crate::proto::tensor_shape::TensorShapeProto::new().apply(|s| s.dim.push(crate::proto::tensor_shape::TensorShapeProto_Dim::new().apply(|x| x.size = 1))));
+                    x.int_val.push(-1)
+                }))));
+                let mut axis = aux("Const", "axis");
+                axis.attr.insert("dtype".into(), int32());
+                axis.attr.insert("value".into(), AttrValue::new().apply(|x| x.set_tensor(crate::proto::tensor::TensorProto::new().apply(|x| {
+                    x.set_dtype(DataType::DT_INT32);
+                    x.int_val.push(0)
+                }))));
+
+                let mut concat = aux("ConcatV2", "concat");
+                let mut lengths = aux("Pack", "lengths");
+                let mut new_nodes = vec![];
+                for (j, &member) in members.iter().enumerate() {
+                    let input = target.pb.node[member].input[0].clone();
+                    let mut flat = aux("Reshape", &format!("flat_{}", j));
+                    flat.input.push(input.clone());
+                    flat.input.push(flat_shape.name.clone());
+                    flat.attr.insert("T".into(), dtype.clone());
+                    flat.attr.insert("Tshape".into(), int32());
+                    set_input_size(&mut flat, 0, sizes[j]);
+                    let mut length = aux("Size", &format!("length_{}", j));
+                    length.input.push(flat.name.clone());
+                    length.attr.insert("T".into(), dtype.clone());
+                    length.attr.insert("out_type".into(), int32());
+                    let mut shape = aux("Shape", &format!("shape_{}", j));
+                    shape.input.push(input);
+                    shape.attr.insert("T".into(), dtype.clone());
+                    shape.attr.insert("out_type".into(), int32());
+                    concat.input.push(flat.name.clone());
+                    set_input_size(&mut concat, j, sizes[j]);
+                    lengths.input.push(length.name.clone());
+
+                    // the original CollectiveReduce node reshapes its part of the buffer back
+                    let original = &mut target.pb.node[member];
+                    let original_belong_to = original.attr["_tge_belong_to"].clone();
+                    original.op = "Reshape".to_string();
+                    original.input = vec![format!("{}/split:{}", base, j), shape.name.clone()].into();
+                    original.attr.clear();
+                    original.attr.insert("_tge_belong_to".into(), original_belong_to);
+                    original.attr.insert("T".into(), dtype.clone());
+                    original.attr.insert("Tshape".into(), int32());
+                    set_input_size(original, 0, sizes[j]);
+                    new_nodes.extend(vec![flat, length, shape]);
+                }
+                let total_size = sizes.iter().sum();
+                concat.input.push(axis.name.clone());
+                concat.attr.insert("N".into(), AttrValue::new().apply(|x| x.set_i(members.len() as _)));
+                concat.attr.insert("T".into(), dtype.clone());
+                concat.attr.insert("Tidx".into(), int32());
+                lengths.attr.insert("N".into(), AttrValue::new().apply(|x| x.set_i(members.len() as _)));
+                lengths.attr.insert("T".into(), int32());
+                lengths.attr.insert("axis".into(), AttrValue::new().apply(|x| x.set_i(0)));
+
+                let mut collective = aux("CollectiveReduce", "collective");
+                for name in ["group_key", "group_size", "final_op", "merge_op", "subdiv_offsets"].iter() {
+                    collective.attr.insert(name.to_string(), template.attr[*name].clone());
+                }
+                collective.attr.insert("T".into(), dtype.clone());
+                collective.attr.insert("instance_key".into(), AttrValue::new().apply(|x| x.set_i(bucket_instance_key as _)));
+                collective.input.push(concat.name.clone());
+                set_input_size(&mut collective, 0, total_size);
+
+                let mut split = aux("SplitV", "split");
+                split.input.push(collective.name.clone());
+                split.input.push(lengths.name.clone());
+                split.input.push(axis.name.clone());
+                split.attr.insert("T".into(), dtype.clone());
+                split.attr.insert("Tlen".into(), int32());
+                split.attr.insert("num_split".into(), AttrValue::new().apply(|x| x.set_i(members.len() as _)));
+                set_input_size(&mut split, 0, total_size);
+
+                bucket_instance.push(target.pb.node.len() + new_nodes.len() + 4);
+                new_nodes.extend(vec![flat_shape, axis, concat, lengths, collective, split]);
+                for node in new_nodes {
+                    target.pb.node.push(node)
+                }
+            }
+            result.push(bucket_instance)
+        }
+
+        // the later instances run first, see add_control_dependencies_for_collective_nodes
+        result.reverse();
+        self.collective_state.instances = result;
+    }
+
     fn add_control_dependencies_for_collective_nodes(&mut self, target: &mut Target) {
         // TODO: findout existing dependencies (added by fusing iterations) and avoid dead lock
-        for pair in self.collective_state.instances.windows(2) {
-            for &i in &pair[0] {
-                for &j in &pair[1] {
-                    let input = format!("^{}", target.pb.node.get(j).unwrap().name);
-                    target.pb.node.get_mut(i).unwrap().input.push(input)
+        // each instance waits for the next instance on each of its devices, so instances run in the same order on all devices.
+        // Instances on disjoint devices are not chained and can run concurrently.
+        let mut next_on_device: BTreeMap<String, usize> = BTreeMap::new();
+        for (k, instance) in self.collective_state.instances.iter().enumerate().rev() {
+            let devices: BTreeSet<_> = instance.iter().map(|&i| target.pb.node[i].device.clone()).collect();
+            let nexts: BTreeSet<_> = devices.iter().filter_map(|device| next_on_device.get(device).copied()).collect();
+            for next in nexts {
+                for &i in instance {
+                    for &j in &self.collective_state.instances[next] {
+                        let input = format!("^{}", target.pb.node.get(j).unwrap().name);
+                        target.pb.node.get_mut(i).unwrap().input.push(input)
+                    }
                 }
             }
+            for device in devices {
+                next_on_device.insert(device, k);
+            }
         }
     }
 }
@@ -301,6 +702,8 @@ pub struct Node {
     pub outputs: Vec<Tensor>,
     pub form: Form, // the form of the node, which is also a tensor form for all its outputs
     pub group: Option<Group>,
+    pub recompute: bool, // recompute the outputs in the backward pass instead of keeping them (strategy 5)
+    pub generation: u64, // the generation of the graph that form, recompute and the input kinds are decided in
 }
 
 impl Node {
@@ -321,7 +724,7 @@ impl Node {
         Self {
             graph, raw_node, controls, inputs, outputs: vec![],
             form: Form { kind: FormKind::Full, devices: vec![] },
-            group: None
+            group: None, recompute: false, generation: graph.generation
         }
     }
 
@@ -380,7 +783,7 @@ impl Node {
                     let mut random_node = NodeDef::new().apply(|x| x.op = "RandomUniform".to_string());
                     random_node.name = self.replica(replica_index);
                     random_node.device = target.devices[*device_id].clone();
-                    set_origin(&mut random_node, &self.raw_node.name);
+                    set_origin(&mut random_node, self.origin());
                     set_form(&mut random_node, &self.form.code());
                     random_node.input.push(shape_node.name.clone());
                     random_node.attr.insert("T".into(), AttrValue::new().apply(|x| x.set_field_type(DataType::DT_INT32)));
@@ -396,7 +799,7 @@ impl Node {
             let mut node = self.raw_node.clone();
             node.name = self.replica(replica_index);
             node.device = target.devices[*device_id].clone();
-            set_origin(&mut node, &self.raw_node.name);
+            set_origin(&mut node, self.origin());
             set_form(&mut node, &self.form.code());
 
             // 2. link inputs and set size
@@ -433,6 +836,24 @@ impl Node {
         self.raw_node.op == "Placeholder" || self.raw_node.op == "IteratorGetNext"
     }
 
+    /// if the node is created by tf.gradients
+    pub fn is_backward(&self) -> bool {
+        is_backward_name(self.origin())
+    }
+
+    /// the name of the node before polishing::fuse_mini_batch
+    pub fn origin(&self) -> &str {
+        origin_of(&self.raw_node)
+    }
+
+    /// if running the node again gives the same outputs and has no side effects
+    pub fn recomputable(&self) -> bool {
+        let op = &self.raw_node.op[..];
+        !(self.is_input() || self.is_backward() || op.starts_with("Apply") || op.starts_with("Random") || op.starts_with("Collective") || matches!(op,
+            "VariableV2" | "Variable" | "VarHandleOp" | "Const" | "NoOp" | "Assign" | "ScatterSub" | "ReadVariableOp" | "TruncatedNormal"
+        ))
+    }
+
     /**************************************
     * following are graph editing methods *
     **************************************/
@@ -445,6 +866,19 @@ impl Node {
         node
     }
 
+    /// clear the decisions made in an earlier generation, see editor::reset
+    pub fn renew(&mut self) {
+        let generation = self.graph().generation;
+        if self.generation != generation {
+            self.form = Form { kind: FormKind::Full, devices: vec![] };
+            self.recompute = false;
+            for (_, _, kind) in self.inputs.iter_mut() {
+                *kind = FormKind::Full
+            }
+            self.generation = generation
+        }
+    }
+
     pub fn put_on_devices(&mut self, devices: &[usize]) {
         assert!(self.replicated().is_none(), "already set replicas!");
         self.form.devices.extend_from_slice(devices);
@@ -454,7 +888,8 @@ impl Node {
 pub struct Tensor {
     pub node: *const Node,
     pub index: usize,
-    pub forms: BTreeMap<Form, Box<[String]>>,
+    pub forms: BTreeMap<Form, Box<[String]>>, // use forms_mut, which drops the names of an earlier generation
+    pub generation: u64,
     pub flags: u8, // flags indicate the types and roles of a tensor. It affects how the tensor is treated when changing forms
 }
 
@@ -465,7 +900,16 @@ impl Tensor {
     pub const IS_FIXED: u8 = 0x80; // this tensor's form is provided by strategy and should not be altered
 
     pub fn new(node: &Node, index: usize) -> Self {
-        Tensor { node, index, forms: BTreeMap::new(), flags: 0 }
+        Tensor { node, index, forms: BTreeMap::new(), generation: node.graph().generation, flags: 0 }
+    }
+
+    pub fn forms_mut(&mut self) -> &mut BTreeMap<Form, Box<[String]>> {
+        let generation = self.node().graph().generation;
+        if self.generation != generation {
+            self.forms.clear();
+            self.generation = generation
+        }
+        &mut self.forms
     }
 
     pub fn original_name(&self) -> String {
@@ -512,7 +956,7 @@ impl Tensor {
 
     // get the names as the specified form
     pub fn as_form(&mut self, form: &Form, target: &mut Target) -> &[String] {
-        if !self.forms.contains_key(form) {
+        if !self.forms_mut().contains_key(form) {
             if self.has_flag(Self::IS_FIXED) {
                 panic!("BUG: no form {:?} provided for {}", form, self.original_name())
             }
@@ -869,6 +1313,93 @@ impl Tensor {
         from.devices.iter().map(|device_id| local_reduced[device_id].clone()).collect()
     }
 
+    /// sum the replicas on each task (machine) to the first device of the task, all-reduce these sums among the tasks with a collective
+    /// operator, then copy the result back to the other devices of each task. The first and last steps use the links inside the tasks.
+    pub fn all_reduce_sum_hierarchical(&mut self, from: &Form, to: &Form, target: &mut Target) -> Box<[String]> {
+        assert!(from.valid() && to.valid() && from.is_part() && to.is_full() && from.devices == to.devices);
+
+        let part_size = self.get_size() / from.ndev() as u64;
+        let dtype = get_dtype(&self.node().raw_node, self.index);
+        let list = self.as_form(from, target).to_vec();
+
+        // the replicas on each task. The devices are sorted, so the first replica is on the first device of the task.
+        // The tasks are ordered by that device rather than by name, which would put "task:10" before "task:2"
+        let mut tasks: BTreeMap<String, Vec<usize>> = BTreeMap::new();
+        for (i, device_id) in from.devices.iter().copied().enumerate() {
+            tasks.entry(task_name(&target.devices[device_id])).or_default().push(i)
+        }
+        let tasks: Vec<Vec<usize>> = tasks.into_iter().map(|(_, replicas)| replicas).collect::<Vec<_>>().apply(|x| x.sort_by_key(|replicas| from.devices[replicas[0]]));
+
+        // 1. intra-task reduce
+        let leaders: Vec<(usize, String)> = tasks.iter().map(|replicas| {
+            let leader = from.devices[replicas[0]];
+            if replicas.len() == 1 {
+                return (leader, list[replicas[0]].clone())
+            }
+            let mut addn = self.node().make_node("AddN".to_string());
+            addn.name += &format!("/{}_{}/aux_hierarchical/sum_{}", to.code(), self.index, leader);
+            addn.device = target.devices[leader].clone();
+            addn.attr.insert("N".into(), AttrValue::new().apply(|x| x.set_i(replicas.len() as _)));
+            addn.attr.insert("T".into(), dtype.clone());
+            addn.input = replicas.iter().map(|&i| list[i].clone()).collect();
+            for i in 0..replicas.len() {
+                set_input_size(&mut addn, i, part_size)
+            }
+            let name = addn.name.clone();
+            target.pb.node.push(addn);
+            (leader, name)
+        }).collect();
+
+        // 2. inter-task all-reduce among the leaders
+        let reduced: Vec<String> = if leaders.len() == 1 {
+            vec![leaders[0].1.clone()]
+        } else {
+            let state = &mut self.node().graph().collective_state;
+            let group_key = state.get_group(&leaders.iter().map(|(leader, _)| *leader).collect::<Vec<_>>());
+            let (instance, instance_key) = state.new_instance();
+            leaders.iter().map(|(leader, local_name)| {
+                let mut node = self.node().make_node("CollectiveReduce".to_string());
+                node.name += &format!("/{}_{}/aux_hierarchical/collective_{}", to.code(), self.index, leader);
+                node.device = target.devices[*leader].clone();
+                node.attr.insert("T".into(), dtype.clone());
+                node.attr.insert("final_op".into(), AttrValue::new().apply(|x| x.set_s(b"Id".to_vec())));
+                node.attr.insert("merge_op".into(), AttrValue::new().apply(|x| x.set_s(b"Add".to_vec())));
+                node.attr.insert("group_key".into(), AttrValue::new().apply(|x| x.set_i(group_key as _)));
+                node.attr.insert("group_size".into(), AttrValue::new().apply(|x| x.set_i(leaders.len() as _)));
+                node.attr.insert("instance_key".into(), AttrValue::new().apply(|x| x.set_i(instance_key as _)));
+                node.attr.insert("subdiv_offsets".into(), AttrValue::new().apply(|x| x.mut_list().i = vec![0]));
+                node.input.push(local_name.clone());
+                set_input_size(&mut node, 0, part_size);
+
+                instance.push(target.pb.node.len());
+                let name = node.name.clone();
+                target.pb.node.push(node);
+                name
+            }).collect()
+        };
+
+        // 3. intra-task broadcast
+        let mut result = vec![String::new(); from.ndev()];
+        for (replicas, reduced) in tasks.iter().zip(reduced) {
+            for &i in replicas.iter() {
+                let device_id = from.devices[i];
+                if device_id == from.devices[replicas[0]] {
+                    result[i] = reduced.clone();
+                    continue
+                }
+                let mut identity = self.node().make_node("Identity".to_string());
+                identity.name += &format!("/{}_{}/aux_hierarchical/broadcast_{}", to.code(), self.index, i);
+                identity.device = target.devices[device_id].clone();
+                identity.attr.insert("T".into(), dtype.clone());
+                identity.input.push(reduced.clone());
+                set_input_size(&mut identity, 0, part_size);
+                result[i] = identity.name.clone();
+                target.pb.node.push(identity);
+            }
+        }
+        result.into_boxed_slice()
+    }
+
     pub fn all_reduce_sum_ring(&mut self, from: &Form, to: &Form, target: &mut Target) -> Box<[String]> {
         assert!(from.valid() && to.valid() && from.is_part() && to.is_full() && from.devices == to.devices);
 
@@ -1034,6 +1565,10 @@ fn set_origin(node: &mut NodeDef, origin: &str) {
     node.attr.insert("_tge_origin".to_string(), AttrValue::new().apply(|x| x.set_s(origin.as_bytes().to_vec())));
 }
 
+pub(crate) fn origin_of(node: &NodeDef) -> &str {
+    node.attr.get("_tge_origin").map(|x| core::str::from_utf8(x.get_s()).unwrap()).unwrap_or(&node.name)
+}
+
 fn set_belong_to(node: &mut NodeDef, belong_to: &str) {
     node.attr.insert("_tge_belong_to".to_string(), AttrValue::new().apply(|x| x.set_s(belong_to.as_bytes().to_vec())));
 }
@@ -1051,7 +1586,7 @@ fn set_form(node: &mut NodeDef, form_code: &str) {
 }
 
 // TODO: This function is currently a stub. Need to parse ops.pbtxt and follow type or type_attr.
-fn get_dtype(x: &NodeDef, i: usize) -> AttrValue {
+pub(crate) fn get_dtype(x: &NodeDef, i: usize) -> AttrValue {
     match &x.op[..] {
         "Greater" | "GreaterEqual" => AttrValue::new().apply(|x| x.set_field_type(DataType::DT_BOOL)),
         "Shape" | "ShapeN" => x.attr.get("out_type").cloned().unwrap_or_else(|| AttrValue::new().apply(|x| x.set_field_type(DataType::DT_INT32))),
@@ -1061,13 +1596,66 @@ fn get_dtype(x: &NodeDef, i: usize) -> AttrValue {
     }
 }
 
-fn parse_input(x: &str) -> (&str, usize) {
+/// returns the indexes of nodes in an order that inputs appear earlier than descendants. It is the same order as repeatedly scanning the
+/// nodes and taking the ones whose inputs are all taken, i.e. sorted by the scan that takes a node, then by the index. A node is taken in
+/// the same scan as an input that comes before it, or in the scan after an input that comes after it.
+pub fn sort_nodes(nodes: &[NodeDef]) -> Vec<usize> {
+    let edges = crate::misc::Edges::new(nodes);
+    let (succ_offsets, succs) = edges.successors();
+
+    let mut indegrees: Vec<_> = nodes.iter().map(|x| x.input.len()).collect();
+    let mut scans = vec![0; nodes.len()];
+    let mut queue: Vec<_> = (0..nodes.len()).filter(|&i| indegrees[i] == 0).collect();
+    let mut nsorted = 0;
+    while let Some(j) = queue.pop() {
+        nsorted += 1;
+        for &i in &succs[succ_offsets[j]..succ_offsets[j+1]] {
+            scans[i] = cmp::max(scans[i], scans[j] + (j > i) as usize);
+            indegrees[i] -= 1;
+            if indegrees[i] == 0 {
+                queue.push(i)
+            }
+        }
+    }
+    assert!(nsorted == nodes.len(), "the graph has a cycle");
+
+    // counting sort by scan. The indexes in each scan stay increasing
+    let mut scan_offsets = vec![0; scans.iter().max().map(|x| x + 2).unwrap_or(1)];
+    for &scan in scans.iter() {
+        scan_offsets[scan + 1] += 1
+    }
+    for i in 1..scan_offsets.len() {
+        scan_offsets[i] += scan_offsets[i - 1]
+    }
+    let mut result = vec![0; nodes.len()];
+    for (i, &scan) in scans.iter().enumerate() {
+        result[scan_offsets[scan]] = i;
+        scan_offsets[scan] += 1
+    }
+    result
+}
+
+pub(crate) fn parse_input(x: &str) -> (&str, usize) {
     match x.find(':') {
         Some(i) => (&x[..i], x[i+1..].parse().unwrap()),
         None => (x, 0)
     }
 }
 
+fn input_node_name(x: &str) -> &str {
+    if x.starts_with('^') {
+        &x[1..]
+    } else {
+        parse_input(x).0
+    }
+}
+
+/// tf.gradients puts the nodes under the "gradients" name scope, which is uniquified as "gradients_1" etc.
+pub(crate) fn is_backward_name(name: &str) -> bool {
+    let scope = name.split('/').next().unwrap();
+    name.contains('/') && (scope == "gradients" || scope.strip_prefix("gradients_").map(|x| x.parse::<usize>().is_ok()).unwrap_or(false))
+}
+
 // TODO: use task id?
 fn task_name(x: &str) -> String {
     let p = x.rfind('/').expect("unrecognized device name");
@@ -5,11 +5,14 @@
 #![warn(clippy::all)]
 
 use oh_my_rust::*;
-use protobuf::{Message, parse_from_bytes};
+use core::cmp;
+use protobuf::{Message, ProtobufError, parse_from_bytes};
 use simulator::Simulator;
-use std::collections::BTreeMap;
+use std::collections::{BTreeMap, HashMap};
+use std::sync::Mutex;
 use graph::Graph;
 use misc::{Target, DataProfiler};
+use simulator::Timeline;
 
 pub mod misc;
 pub mod proto;
@@ -19,6 +22,9 @@ pub mod polishing;
 pub mod simulator;
 pub mod scheduler;
 
+#[cfg(test)]
+mod tests;
+
 #[no_mangle]
 unsafe extern fn create_graph(pb: *const u8, pb_len: u32) -> *mut Graph {
     let pb = core::slice::from_raw_parts(pb, pb_len as usize);
@@ -27,6 +33,31 @@ unsafe extern fn create_graph(pb: *const u8, pb_len: u32) -> *mut Graph {
     Box::leak(Graph::new(&g.node))
 }
 
+/// analysis: the result of export_analysis of a graph created from the same GraphDef
+#[no_mangle]
+unsafe extern fn create_graph_with_analysis(pb: *const u8, pb_len: u32, analysis: *const u32, analysis_len: u32) -> *mut Graph {
+    let pb = core::slice::from_raw_parts(pb, pb_len as usize);
+    let g: proto::graph::GraphDef = parse_from_bytes(pb).unwrap();
+    let analysis = core::slice::from_raw_parts(analysis, analysis_len as usize);
+
+    Box::leak(Graph::with_analysis(&g.node, analysis))
+}
+
+#[no_mangle]
+unsafe extern fn clone_graph(graph: *const Graph) -> *mut Graph {
+    Box::leak((*graph).duplicate())
+}
+
+/// result_len is set to the length of the analysis, so it can be called with a null result first to get the length.
+#[no_mangle]
+unsafe extern fn export_analysis(graph: *const Graph, result: *mut u32, result_len: *mut u32) {
+    let analysis = (*graph).export_analysis();
+    if !result.is_null() && analysis.len() <= *result_len as usize {
+        core::slice::from_raw_parts_mut(result, analysis.len()).copy_from_slice(&analysis)
+    }
+    *result_len = analysis.len() as _
+}
+
 #[no_mangle]
 unsafe extern fn destroy_graph(graph: *mut Graph) {
     free(graph)
@@ -66,10 +97,35 @@ unsafe extern fn edit_graph(graph: *mut Graph, target: *mut Target, strategy_raw
         let method = line[1].parse().unwrap();
         let places = line[2..].iter().map(|x| x.parse().unwrap()).collect(); // assume sorted
         (name, (places, method))
-    }).collect();
+    }).collect::<BTreeMap<_, _>>();
+    let strategy: Vec<_> = (*graph).nodes.iter().map(|node| strategy.get(&node.raw_node.name[..]).cloned()).collect();
     editor::edit(&mut *graph, &mut *target, &strategy)
 }
 
+/// methods: i8[nnode], placements: u8[nnode, ndev], both indexed by the node order in the original GraphDef.
+/// each element of placements is the number of replicas on that device. A row of all zeros means no decision for that node.
+#[no_mangle]
+unsafe extern fn edit_graph_v2(graph: *mut Graph, target: *mut Target, methods: *const i8, placements: *const u8, ndev: u32) {
+    let graph = &mut *graph;
+    let n = graph.nodes.len();
+    let methods = core::slice::from_raw_parts(methods, n);
+    let placements = core::slice::from_raw_parts(placements, n * ndev as usize);
+    let strategy = strategy_from_arrays(graph, methods, placements, ndev as _);
+    editor::edit(graph, &mut *target, &strategy)
+}
+
+fn strategy_from_arrays(graph: &Graph, methods: &[i8], placements: &[u8], ndev: usize) -> Vec<Option<(Vec<usize>, i8)>> {
+    let mut strategy = vec![None; graph.nodes.len()];
+    for (raw_id, (method, places)) in methods.iter().zip(placements.chunks(ndev)).enumerate() {
+        if places.iter().all(|&x| x == 0) {
+            continue
+        }
+        let devices = places.iter().enumerate().flat_map(|(device_id, &count)| core::iter::repeat(device_id).take(count as _)).collect();
+        strategy[graph.raw_order[raw_id]] = Some((devices, *method))
+    }
+    strategy
+}
+
 #[no_mangle]
 unsafe extern fn reset_graph(graph: *mut Graph) {
     editor::reset(&mut *graph)
@@ -83,11 +139,8 @@ unsafe extern fn create_target(
     sinks_raw: *const u8, sinks_len: u32,
     nccls_raw: *const u8, nccls_len: u32
 ) -> *mut Target {
-    let links_str = core::str::from_utf8(core::slice::from_raw_parts(links_raw, links_len as usize)).unwrap();
-    let links = links_str.split_ascii_whitespace().map(|x| x.parse().unwrap()).collect();
-
-    let paths_str = core::str::from_utf8(core::slice::from_raw_parts(paths_raw, paths_len as usize)).unwrap();
-    let paths = paths_str.lines().map(|x| x.split_ascii_whitespace().map(|x| x.parse().unwrap()).collect()).collect();
+    let links = parse_links(links_raw, links_len);
+    let paths = parse_paths(paths_raw, paths_len);
 
     let devices_str = core::str::from_utf8(core::slice::from_raw_parts(devices_raw, devices_len as usize)).unwrap();
     let devices = devices_str.split_ascii_whitespace().map(|x| x.to_owned()).collect();
@@ -95,18 +148,52 @@ unsafe extern fn create_target(
     let sinks_str = core::str::from_utf8(core::slice::from_raw_parts(sinks_raw, sinks_len as usize)).unwrap();
     let sinks = sinks_str.split_ascii_whitespace().map(|x| x.to_string()).collect();
 
+    let nccls = parse_nccls(nccls_raw, nccls_len);
+
+    let target = Target::new(proto::graph::GraphDef::new(), devices, links, paths, sinks, nccls);
+    leak(target)
+}
+
+/// replace the topology of a (possibly compiled) target. The compiled graph does not depend on it, so it can be changed between evaluations.
+#[no_mangle]
+unsafe extern fn set_topology(target: *mut Target, links_raw: *const u8, links_len: u32, paths_raw: *const u8, paths_len: u32) {
+    let target = &mut *target;
+    target.links = parse_links(links_raw, links_len);
+    target.paths = parse_paths(paths_raw, paths_len);
+}
+
+#[no_mangle]
+unsafe extern fn set_target_option(target: *mut Target, name: *const u8, name_len: u32, value: *const u8, value_len: u32) {
+    let name = core::str::from_utf8(core::slice::from_raw_parts(name, name_len as usize)).unwrap();
+    let value = core::str::from_utf8(core::slice::from_raw_parts(value, value_len as usize)).unwrap();
+    (*target).options.insert(name.to_string(), value.to_string());
+}
+
+#[no_mangle]
+unsafe extern fn set_nccl_model(target: *mut Target, nccls_raw: *const u8, nccls_len: u32) {
+    (*target).nccls = parse_nccls(nccls_raw, nccls_len);
+}
+
+unsafe fn parse_links(links_raw: *const u8, links_len: u32) -> Box<[u64]> {
+    let links_str = core::str::from_utf8(core::slice::from_raw_parts(links_raw, links_len as usize)).unwrap();
+    links_str.split_ascii_whitespace().map(|x| x.parse().unwrap()).inspect(|&x: &u64| assert!(x > 0, "links must have positive bandwidth")).collect()
+}
+
+unsafe fn parse_paths(paths_raw: *const u8, paths_len: u32) -> Box<[Box<[usize]>]> {
+    let paths_str = core::str::from_utf8(core::slice::from_raw_parts(paths_raw, paths_len as usize)).unwrap();
+    paths_str.lines().map(|x| x.split_ascii_whitespace().map(|x| x.parse().unwrap()).collect()).collect()
+}
+
+unsafe fn parse_nccls(nccls_raw: *const u8, nccls_len: u32) -> BTreeMap<String, [f64; 4]> {
     let nccls_str = core::str::from_utf8(core::slice::from_raw_parts(nccls_raw, nccls_len as usize)).unwrap();
-    let nccls = nccls_str.lines().filter(|x| !x.is_empty()).map(|line| {
+    nccls_str.lines().filter(|x| !x.is_empty()).map(|line| {
         let mut m = [0., 0., 0., 0.];
         let line: Vec<_> = line.split_ascii_whitespace().collect();
         for i in 0..4 {
             m[i] = line[i+1].parse().unwrap()
         }
         (line[0].to_string(), m)
-    }).collect();
-
-    let target = Target::new(proto::graph::GraphDef::new(), devices, links, paths, sinks, nccls);
-    leak(target)
+    }).collect()
 }
 
 #[no_mangle]
@@ -125,6 +212,34 @@ unsafe extern fn read_protobuf(target: *mut Target, dest: *mut u8) {
     (*target).pb.write_to_writer(&mut ptr).unwrap()
 }
 
+/// write the GraphDef to a file in the binary format, which can be read with GraphDef.ParseFromString. The path is the raw bytes of
+/// the file name (os.fsencode). Returns 0 on success, the errno if an IO error has one, or -1 for other errors.
+#[no_mangle]
+unsafe extern fn write_protobuf(target: *mut Target, path: *const u8, path_len: u32) -> i32 {
+    let path = os_path(core::slice::from_raw_parts(path, path_len as usize));
+    let result = std::fs::File::create(path).map_err(ProtobufError::from).and_then(|file| {
+        let mut file = std::io::BufWriter::new(file);
+        (*target).pb.write_to_writer(&mut file)?;
+        std::io::Write::flush(&mut file)?; // dropping the BufWriter would ignore the error of the last write
+        Ok(())
+    });
+    match result {
+        Ok(()) => 0,
+        Err(ProtobufError::IoError(e)) => e.raw_os_error().unwrap_or(-1),
+        Err(_) => -1
+    }
+}
+
+#[cfg(unix)]
+fn os_path(raw: &[u8]) -> std::path::PathBuf {
+    <std::ffi::OsStr as std::os::unix::ffi::OsStrExt>::from_bytes(raw).into()
+}
+
+#[cfg(not(unix))]
+fn os_path(raw: &[u8]) -> std::path::PathBuf {
+    String::from_utf8_lossy(raw).into_owned().into()
+}
+
 #[no_mangle]
 unsafe extern fn compile(graph: *mut Graph, target: *mut Target) {
     (*graph).compile(&mut *target)
@@ -143,7 +258,18 @@ unsafe extern fn create_profiler(profile_data: *const u8, profile_len: u32) -> *
         let pos = v.binary_search_by_key(&nrep, |x| x.0).unwrap_or_else(|e| e);
         v.insert(pos, (nrep, times))
     };
-    leak(DataProfiler { data: profile_dict })
+    leak(DataProfiler::from_dict(profile_dict))
+}
+
+/// the rows of times are the nodes of graph in the order of its GraphDef. nreps: u32[nnrep], sorted. times: u64[nnode, nnrep, ndev], where u64::MAX marks missing entries.
+/// times is borrowed rather than copied, so the caller must keep it alive and unchanged until the profiler is destroyed. The graph can be destroyed right after.
+#[no_mangle]
+unsafe extern fn create_profiler_v2(graph: *const Graph, nreps: *const u32, nnrep: u32, times: *const u64, ndev: u32) -> *mut DataProfiler {
+    let graph = &*graph;
+    let nreps = core::slice::from_raw_parts(nreps, nnrep as usize).iter().map(|&x| x as usize).collect::<Vec<_>>();
+    let times = core::slice::from_raw_parts(times, graph.raw_order.len() * nreps.len() * ndev as usize);
+    let rows = graph.raw_order.iter().enumerate().map(|(i, &id)| (graph.nodes[id].raw_node.name.clone(), i)).collect();
+    leak(DataProfiler { rows, nreps, times: std::borrow::Cow::Borrowed(times), ndev: ndev as _ })
 }
 
 #[no_mangle]
@@ -157,35 +283,211 @@ unsafe extern fn heft_rank(target: *mut Target, profiler: *const DataProfiler) {
 }
 
 #[no_mangle]
-unsafe extern fn heft_control(target: *mut Target, profiler: *const DataProfiler) { // this automatically calls rank inside
-    scheduler::heft_control(&mut *target, &*profiler)
+unsafe extern fn heft_control(target: *mut Target, profiler: *const DataProfiler) -> u32 { // this automatically calls rank inside. Returns the number of elided dependencies
+    scheduler::heft_control(&mut *target, &*profiler) as _
+}
+
+/// algorithm is one of "cpop", "peft" and "lookahead". Returns the number of elided dependencies if add_control_dependency is not 0
+/// memory_limits is either null or u64[ndev]
+#[no_mangle]
+unsafe extern fn list_schedule(target: *mut Target, profiler: *const DataProfiler, algorithm: *const u8, algorithm_len: u32, lookahead: u32, add_control_dependency: u8, memory_limits: *const u64) -> u32 {
+    let name = core::str::from_utf8(core::slice::from_raw_parts(algorithm, algorithm_len as usize)).unwrap();
+    let algorithm = scheduler::Algorithm::from_name(name, lookahead as _).unwrap_or_else(|| panic!("unknown scheduling algorithm {}", name));
+    let target = &mut *target;
+    let memory_limits = if memory_limits.is_null() { None } else { Some(core::slice::from_raw_parts(memory_limits, target.devices.len())) };
+    scheduler::list_schedule(target, &*profiler, algorithm, add_control_dependency != 0, memory_limits) as _
+}
+
+/// schedule is either "gpipe" or "1f1b". Returns the number of elided dependencies
+#[no_mangle]
+unsafe extern fn pipeline_schedule(target: *mut Target, schedule: *const u8, schedule_len: u32) -> u32 {
+    let name = core::str::from_utf8(core::slice::from_raw_parts(schedule, schedule_len as usize)).unwrap();
+    let schedule = scheduler::PipelineSchedule::from_name(name).unwrap_or_else(|| panic!("unknown pipeline schedule {}", name));
+    scheduler::pipeline_schedule(&mut *target, schedule) as _
+}
+
+/// write the GraphDef with `times` micro-batches (see polishing::fuse_mini_batch) to result if it fits in result_len bytes.
+/// result_len is set to the size of the fused GraphDef, so it can be called with a null result first to get the size.
+#[no_mangle]
+unsafe extern fn fuse_mini_batch(pb: *const u8, pb_len: u32, times: u32, result: *mut u8, result_len: *mut u32) {
+    let pb = core::slice::from_raw_parts(pb, pb_len as usize);
+    let mut g: proto::graph::GraphDef = parse_from_bytes(pb).unwrap();
+    g.node = polishing::fuse_mini_batch(&g.node, times as _).into();
+
+    let size = g.compute_size();
+    if !result.is_null() && size <= *result_len {
+        let mut result = core::slice::from_raw_parts_mut(result, size as usize);
+        g.write_to_writer(&mut result).unwrap()
+    }
+    *result_len = size
 }
 
+/// the target is only borrowed, so it can be evaluated again later
+/// if op_makespan is not null, the feedback is written to op_makespan, op_idle_after, op_slack and op_critical_time: u64[nnode] in the node order of the GraphDef that the graph is created from,
+/// device_busy_time and device_critical_time: u64[ndev], and link_critical_time: u64[nlinks]
 #[no_mangle]
 unsafe extern fn evaluate(
-    target: *mut Target, profiler: *const DataProfiler,
+    target: *const Target, profiler: *const DataProfiler,
     chrome_path: *const u8, chrome_len: u32,
     dump_path: *const u8, dump_len: u32,
-    memory: *mut u64
+    memory: *mut u64,
+    graph: *const Graph, op_makespan: *mut u64, op_idle_after: *mut u64, op_slack: *mut u64, op_critical_time: *mut u64,
+    device_busy_time: *mut u64, device_critical_time: *mut u64, link_critical_time: *mut u64
 ) -> u64 {
-    let target = reclaim(target);
-    let mut simulator = simulator::SimpleSimulator::new(&target);
-    simulator.simulate(&*profiler, *target);
+    let mut simulator = simulator::SimpleSimulator::new(&*target);
+    simulator.simulate(&*profiler);
     for (i, m) in simulator.get_peak_memories().iter().enumerate() {
         core::ptr::write(memory.offset(i as _), *m)
     }
 
     if chrome_len > 0 {
-        simulator.write_chrome(&mut std::fs::File::create(&core::str::from_utf8(core::slice::from_raw_parts(chrome_path, chrome_len as _)).unwrap()).unwrap())
+        write_chrome(&simulator, core::str::from_utf8(core::slice::from_raw_parts(chrome_path, chrome_len as _)).unwrap())
     }
 
     if dump_len > 0 {
         simulator.dump_records(&mut std::fs::File::create(&core::str::from_utf8(core::slice::from_raw_parts(dump_path, dump_len as _)).unwrap()).unwrap())
     }
 
+    if !op_makespan.is_null() {
+        let (graph, target) = (&*graph, &*target);
+        let (n, ndev, nlinks) = (graph.nodes.len(), target.ndev(), target.links.len());
+        let op_index = op_index(graph.raw_order.iter().map(|&id| &graph.nodes[id].raw_node));
+        simulator.write_feedback(&op_index, simulator::Feedback {
+            op_makespan: core::slice::from_raw_parts_mut(op_makespan, n),
+            op_idle_after: core::slice::from_raw_parts_mut(op_idle_after, n),
+            op_slack: core::slice::from_raw_parts_mut(op_slack, n),
+            op_critical_time: core::slice::from_raw_parts_mut(op_critical_time, n),
+            device_busy_time: core::slice::from_raw_parts_mut(device_busy_time, ndev),
+            device_critical_time: core::slice::from_raw_parts_mut(device_critical_time, ndev),
+            link_critical_time: core::slice::from_raw_parts_mut(link_critical_time, nlinks)
+        })
+    }
+
     simulator.get_total_time()
 }
 
+/// the trace is gzipped if the path ends with ".gz"
+fn write_chrome<'a>(simulator: &impl Simulator<'a>, path: &str) {
+    let file = std::io::BufWriter::new(std::fs::File::create(path).unwrap());
+    if path.ends_with(".gz") {
+        let mut encoder = flate2::write::GzEncoder::new(file, flate2::Compression::default());
+        simulator.write_chrome(&mut encoder);
+        encoder.finish().unwrap();
+    } else {
+        simulator.write_chrome(&mut { file })
+    }
+}
+
+/// edit, compile and evaluate many strategies of the same graph in parallel. Each strategy is compiled on a copy of `target`, which provides the devices, topology, sinks and nccl models.
+/// graph: an unedited graph, whose analysis is reused by every thread. options: lines of "name value" that are set to the graph. methods: i8[nstrategy, nnode], placements: u8[nstrategy, nnode, ndev], where each strategy is the same as edit_graph_v2.
+/// outputs: times: u64[nstrategy], memory: u64[nstrategy, ndev], and the feedback of each strategy like `evaluate`:
+/// op_makespan, op_idle_after, op_slack and op_critical_time: u64[nstrategy, nnode] in the node order of the GraphDef,
+/// device_busy_time and device_critical_time: u64[nstrategy, ndev], link_critical_time: u64[nstrategy, nlinks].
+/// nthreads: 0 means using all cores. timeline: if not null, each simulation resumes from it when possible (see `record_timeline`).
+#[no_mangle]
+unsafe extern fn evaluate_batch(
+    graph: *const Graph,
+    options_raw: *const u8, options_len: u32,
+    target: *const Target, profiler: *const DataProfiler, timeline: *const Timeline,
+    methods: *const i8, placements: *const u8, nstrategy: u32, nthreads: u32,
+    times: *mut u64, memory: *mut u64,
+    op_makespan: *mut u64, op_idle_after: *mut u64, op_slack: *mut u64, op_critical_time: *mut u64,
+    device_busy_time: *mut u64, device_critical_time: *mut u64, link_critical_time: *mut u64
+) {
+    // Graph is not Send, so the threads build their own from the raw nodes and the analysis of it instead of analyzing again
+    let graph = &*graph;
+    let (nodes, analysis): (Vec<_>, _) = (graph.raw_order.iter().map(|&id| graph.nodes[id].raw_node.clone()).collect(), graph.export_analysis());
+    let options_str = core::str::from_utf8(core::slice::from_raw_parts(options_raw, options_len as usize)).unwrap();
+    let options: BTreeMap<String, String> = options_str.lines().filter(|x| !x.is_empty()).map(|line| {
+        let line: Vec<_> = line.split_ascii_whitespace().collect();
+        (line[0].to_string(), line[1].to_string())
+    }).collect();
+    let (template, profiler, timeline) = (&*target, &*profiler, timeline.as_ref());
+    let (nnode, ndev, nlinks, nstrategy) = (nodes.len(), template.ndev(), template.links.len(), nstrategy as usize);
+    let op_index = op_index(nodes.iter());
+
+    let methods = core::slice::from_raw_parts(methods, nstrategy * nnode);
+    let placements = core::slice::from_raw_parts(placements, nstrategy * nnode * ndev);
+    let times = core::slice::from_raw_parts_mut(times, nstrategy);
+    let memory = core::slice::from_raw_parts_mut(memory, nstrategy * ndev);
+    let chunks = |x: *mut u64, size: usize| core::slice::from_raw_parts_mut(x, nstrategy * size).chunks_mut(cmp::max(size, 1));
+    let (mut op_makespan, mut op_idle_after, mut op_slack, mut op_critical_time) = (chunks(op_makespan, nnode), chunks(op_idle_after, nnode), chunks(op_slack, nnode), chunks(op_critical_time, nnode));
+    let (mut device_busy_time, mut device_critical_time, mut link_critical_time) = (chunks(device_busy_time, ndev), chunks(device_critical_time, ndev), chunks(link_critical_time, nlinks));
+    let feedbacks: Vec<_> = (0..nstrategy).map(|_| simulator::Feedback {
+        op_makespan: op_makespan.next().unwrap_or_default(),
+        op_idle_after: op_idle_after.next().unwrap_or_default(),
+        op_slack: op_slack.next().unwrap_or_default(),
+        op_critical_time: op_critical_time.next().unwrap_or_default(),
+        device_busy_time: device_busy_time.next().unwrap_or_default(),
+        device_critical_time: device_critical_time.next().unwrap_or_default(),
+        link_critical_time: link_critical_time.next().unwrap_or_default()
+    }).collect();
+
+    // each job is a strategy along with its output slots. Threads take jobs from the queue until it is empty.
+    let jobs = Mutex::new(methods.chunks(nnode).zip(placements.chunks(nnode * ndev)).zip(times.iter_mut()).zip(memory.chunks_mut(ndev)).zip(feedbacks));
+
+    let nthreads = match nthreads {
+        0 => std::thread::available_parallelism().map(|x| x.get()).unwrap_or(1),
+        n => n as usize
+    };
+
+    std::thread::scope(|scope| {
+        for _ in 0..cmp::min(nthreads, nstrategy) {
+            scope.spawn(|| {
+                // each thread resets its graph between strategies
+                let mut graph = Graph::with_analysis(&nodes, &analysis);
+                graph.options = options.clone();
+                let mut edited = false;
+                loop {
+                    let job = jobs.lock().unwrap().next();
+                    let ((((methods, placements), time), memory), feedback) = match job {
+                        Some(job) => job,
+                        None => break
+                    };
+
+                    if edited {
+                        editor::reset(&mut graph)
+                    }
+                    let mut target = template.clone();
+                    let strategy = strategy_from_arrays(&graph, methods, placements, ndev);
+                    editor::edit(&mut graph, &mut target, &strategy);
+                    edited = true;
+                    graph.compile(&mut target);
+                    polishing::remove_colocation_hint(&mut target);
+                    polishing::remove_shape_hint(&mut target);
+                    polishing::remove_dangling_nodes(&mut target);
+
+                    let mut simulator = simulator::SimpleSimulator::new(&target);
+                    match timeline {
+                        Some(timeline) => simulator.simulate_from(profiler, timeline),
+                        None => simulator.simulate(profiler)
+                    }
+                    *time = simulator.get_total_time();
+                    memory.copy_from_slice(simulator.get_peak_memories());
+                    simulator.write_feedback(&op_index, feedback);
+                }
+            });
+        }
+    })
+}
+
+/// the index in the GraphDef of the node that gets the feedback recorded under each original name (see Node::origin).
+/// For a graph fused by polishing::fuse_mini_batch, it is the last replica of each node
+fn op_index<'a>(nodes: impl Iterator<Item=&'a proto::node_def::NodeDef>) -> HashMap<&'a str, usize> {
+    nodes.enumerate().map(|(i, node)| (graph::origin_of(node), i)).collect()
+}
+
+/// simulate a compiled target and keep the timeline, so evaluations of similar strategies can resume from it
+#[no_mangle]
+unsafe extern fn record_timeline(target: *const Target, profiler: *const DataProfiler) -> *mut Timeline {
+    leak(simulator::SimpleSimulator::new(&*target).simulate_and_record(&*profiler))
+}
+
+#[no_mangle]
+unsafe extern fn destroy_timeline(timeline: *mut Timeline) {
+    free(timeline)
+}
+
 #[no_mangle]
 unsafe extern fn remove_colocation_hint(target: *mut Target) {
     polishing::remove_colocation_hint(&mut *target)
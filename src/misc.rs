@@ -1,25 +1,99 @@
 use crate::graph::Form;
 use crate::proto::{graph::GraphDef, node_def::NodeDef, attr_value::AttrValue, types::DataType};
-use std::collections::BTreeMap;
+use std::collections::{BTreeMap, HashMap};
+use std::borrow::Cow;
 
-#[derive(Debug, Default)]
+#[derive(Debug, Default, Clone)]
 pub struct Target {
     pub pb: GraphDef,
     pub devices: Box<[String]>,
     pub links: Box<[u64]>, // the bandwidth of each link
     pub paths: Box<[Box<[usize]>]>, // the i*n+j element is the links that i->j uses (currently only one path between each pair)
     pub sinks: Box<[String]>, // sink nodes
-    pub nccls: BTreeMap<String, [f64; 4]> // the key is a comma separated sorted list of device names, the values are [coef1, interc1, coef2, interc2]. The model is time = max( coef1 * size + interc1, coef2 * size + interc2 ). The size unit is KB.
+    pub nccls: BTreeMap<String, [f64; 4]>, // the key is a comma separated sorted list of device names, the values are [coef1, interc1, coef2, interc2]. The model is time = max( coef1 * size + interc1, coef2 * size + interc2 ). The size unit is KB.
+    pub options: BTreeMap<String, String> // options for the simulator, like Graph.options for the compiler
 }
 
 impl Target {
     pub fn new(pb: GraphDef, devices: Box<[String]>, links: Box<[u64]>, paths: Box<[Box<[usize]>]>, sinks: Box<[String]>, nccls: BTreeMap<String, [f64; 4]>) -> Self {
-        Target { pb, devices, links, paths, sinks, nccls }
+        Target { pb, devices, links, paths, sinks, nccls, options: BTreeMap::new() }
     }
 
     pub fn ndev(&self) -> usize {
         self.devices.len()
     }
+
+    pub fn edges(&self) -> Edges<'_> {
+        Edges::new(&self.pb.node)
+    }
+}
+
+/// the inputs of a list of nodes with the names resolved into indices, so the passes work on integer edges instead of parsing the
+/// "name:index" and "^name" strings. It borrows the nodes, so build it again after changing them.
+pub struct Edges<'a> {
+    pub names: HashMap<&'a str, usize>, // name => index in the list
+    offsets: Vec<usize>, // the inputs of node i are inputs[offsets[i]..offsets[i+1]], in the same order as NodeDef.input
+    inputs: Vec<Input>
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub struct Input {
+    pub node: usize,
+    pub index: Option<usize> // the output index, or None for a control dependency
+}
+
+impl<'a> Edges<'a> {
+    pub fn new(nodes: &'a [NodeDef]) -> Self {
+        let names: HashMap<&str, usize> = nodes.iter().enumerate().map(|(i, x)| (&x.name[..], i)).collect();
+        let mut offsets = Vec::with_capacity(nodes.len() + 1);
+        let mut inputs = vec![];
+        offsets.push(0);
+        for node in nodes.iter() {
+            for input in node.input.iter() {
+                let (name, index) = if input.starts_with('^') {
+                    (&input[1..], None)
+                } else {
+                    match input.find(':') {
+                        Some(i) => (&input[..i], Some(input[i+1..].parse().unwrap())),
+                        None => (&input[..], Some(0))
+                    }
+                };
+                let node = *names.get(name).unwrap_or_else(|| panic!("{} has an unknown input {}", node.name, input));
+                inputs.push(Input { node, index })
+            }
+            offsets.push(inputs.len())
+        }
+        Edges { names, offsets, inputs }
+    }
+
+    pub fn len(&self) -> usize {
+        self.offsets.len() - 1
+    }
+
+    pub fn inputs(&self, i: usize) -> &[Input] {
+        &self.inputs[self.offsets[i]..self.offsets[i+1]]
+    }
+
+    /// the nodes that use each node, as (offsets, successors) like the inputs. A node appears once for each of its inputs from the same node.
+    pub fn successors(&self) -> (Vec<usize>, Vec<usize>) {
+        let n = self.len();
+        let mut offsets = vec![0; n + 1];
+        for input in self.inputs.iter() {
+            offsets[input.node + 1] += 1
+        }
+        for i in 0..n {
+            offsets[i + 1] += offsets[i]
+        }
+        let mut successors = vec![0; self.inputs.len()];
+        let mut cursor = offsets.clone();
+        for i in 0..n {
+            for input in self.inputs(i) {
+                successors[cursor[input.node]] = i;
+                cursor[input.node] += 1
+            }
+        }
+        (offsets, successors)
+    }
 }
 
 pub trait Profiler {
@@ -27,8 +101,33 @@ pub trait Profiler {
 }
 
 pub struct DataProfiler {
-    /// the value is a binary sorted array contains replica_number and the time required on each device given replicated by that number
-    pub data: BTreeMap<String, Vec<(usize, Vec<u64>)>>
+    /// the row in `times` of each node
+    pub rows: HashMap<String, usize>,
+    /// the sorted replica numbers
+    pub nreps: Vec<usize>,
+    /// shaped [row, nrep, device]. A nrep of a node is missing if its time on the first device is u64::MAX.
+    /// It is borrowed from the caller when created through the FFI (see create_profiler_v2)
+    pub times: Cow<'static, [u64]>,
+    pub ndev: usize
+}
+
+impl DataProfiler {
+    /// data: the value is a binary sorted array contains replica_number and the time required on each device given replicated by that number
+    pub fn from_dict(data: BTreeMap<String, Vec<(usize, Vec<u64>)>>) -> Self {
+        let mut nreps: Vec<_> = data.values().flat_map(|x| x.iter().map(|(nrep, _)| *nrep)).collect();
+        nreps.sort_unstable();
+        nreps.dedup();
+        let ndev = data.values().flat_map(|x| x.first()).map(|(_, times)| times.len()).next().unwrap_or(0);
+        let mut times = vec![core::u64::MAX; data.len() * nreps.len() * ndev];
+        let rows = data.into_iter().enumerate().map(|(i, (name, prof))| {
+            for (nrep, t) in prof {
+                let offset = (i * nreps.len() + nreps.binary_search(&nrep).unwrap()) * ndev;
+                times[offset..offset+ndev].copy_from_slice(&t)
+            }
+            (name, i)
+        }).collect();
+        DataProfiler { rows, nreps, times: Cow::Owned(times), ndev }
+    }
 }
 
 impl Profiler for DataProfiler {
@@ -41,16 +140,14 @@ impl Profiler for DataProfiler {
         } else {
             1
         };
+        let nrep = nrep * node.attr.get("_tge_micro_batches").map(|x| x.get_i() as usize).unwrap_or(1); // see polishing::fuse_mini_batch
 
-        let prof = self.data.get(&String::from_utf8(origin_name.to_vec()).unwrap())?;
-        let time = match prof.binary_search_by_key(&nrep, |x| x.0) {
-            Ok(i) => prof[i].1[device_id],
-            Err(i) => if i >= prof.len() {
-                prof[i - 1].1[device_id]
-            } else {
-                prof[i].1[device_id]
-            }
-        };
+        let row = *self.rows.get(core::str::from_utf8(origin_name).unwrap())?;
+        let prof = &self.times[row * self.nreps.len() * self.ndev..(row + 1) * self.nreps.len() * self.ndev];
+        let available = || self.nreps.iter().zip(prof.chunks(self.ndev.max(1))).filter(|(_, times)| times.first() != Some(&core::u64::MAX));
+        // the smallest profiled replica number that is not less than nrep, or the largest one
+        let (_, times) = available().find(|(&x, _)| x >= nrep).or_else(|| available().last())?;
+        let time = times[device_id];
 
         Some(time)
     }
@@ -3,6 +3,7 @@ use crate::misc::*;
 use crate::graph::*;
 use crate::proto::graph::GraphDef;
 use crate::proto::node_def::NodeDef;
+use crate::proto::attr_value::AttrValue;
 
 // if we do not remove these, we need to modify this field so that it has the correct node name of replicated operators
 pub fn remove_colocation_hint(target: &mut Target) {
@@ -23,29 +24,21 @@ pub fn remove_shape_hint(target: &mut Target) {
 
 pub fn remove_dangling_nodes(target: &mut Target) {
     // note: don't forget control dependency
-    let input_node_dict: std::collections::HashMap<_, Vec<_>> = target.pb.node.iter().map(|node| {
-        (&node.name[..], node.input.iter().map(|x| {
-            if x.starts_with('^') {
-                return &x[1..]
-            }
-            match x.find(':') {
-                Some(i) => &x[..i],
-                None => x
-            }
-        }).collect())
-    }).collect();
-    let mut keep = std::collections::HashSet::new();
-    let mut queue: std::collections::VecDeque<_> = target.sinks.iter().map(|x| &x[..]).collect();
-
-    while let Some(x) = queue.pop_front() {
-        if keep.insert(x.to_string()) {
-            queue.extend(&input_node_dict[x]);
+    let edges = target.edges();
+    let mut keep = vec![false; edges.len()];
+    let mut queue: std::collections::VecDeque<_> = target.sinks.iter().map(|x| edges.names[&x[..]]).collect();
+
+    while let Some(i) = queue.pop_front() {
+        if !keep[i] {
+            keep[i] = true;
+            queue.extend(edges.inputs(i).iter().map(|input| input.node));
         }
     }
 
     // hacky way to avoid clone
     let mut x = std::mem::replace(&mut target.pb.node, vec![].into()).into_vec();
-    x.retain(|x| keep.contains(&x.name[..]));
+    let mut keep = keep.into_iter();
+    x.retain(|_| keep.next().unwrap());
     target.pb.node = x.into()
 }
 
@@ -58,24 +51,99 @@ pub fn destruct_names(target: &mut Target) {
     }
 }
 
+/// split each batch into `times` micro-batches, i.e. replicate the nodes that depend on the batch inputs for each micro-batch, and sum their
+/// outputs that are used by the other nodes (mostly the gradients used by the apply nodes) like the all-reduce does. The batch size of the
+/// inputs should be filled by the replace_placeholder or fill_batchsize option with the micro-batch size.
+/// The replicas are named `tge_fuse_batch_{i}/{name}`, and they record the original name and the number of micro-batches for the profiler.
 pub fn fuse_mini_batch(nodes: &[NodeDef], times: usize) -> Vec<NodeDef> {
+    let edges = Edges::new(nodes);
+    let name_dict = &edges.names;
+    let is_update = |node: &NodeDef| node.op.starts_with("Apply") || node.op.starts_with("Assign") || node.op == "ScatterSub";
+
+    // the nodes that depend on the batch through data inputs, without going through the update nodes
+    let mut data_succs = vec![vec![]; nodes.len()];
+    for i in 0..nodes.len() {
+        for input in edges.inputs(i).iter().filter(|x| x.index.is_some()) {
+            data_succs[input.node].push(i)
+        }
+    }
+    let mut batched = vec![false; nodes.len()];
+    let mut queue: std::collections::VecDeque<_> = (0..nodes.len()).filter(|&i| nodes[i].op == "Placeholder" || nodes[i].op == "IteratorGetNext").collect();
+    while let Some(i) = queue.pop_front() {
+        if !batched[i] && !is_update(&nodes[i]) {
+            batched[i] = true;
+            queue.extend(&data_succs[i])
+        }
+    }
+
+    let batched_name = |i: usize, name: &str| format!("tge_fuse_batch_{}/{}", i, name);
     let mut result = Vec::with_capacity(nodes.len() * times);
 
     for i in 0..times {
-        for mut node in nodes.iter().cloned() {
-            node.name = format!("tge_fuse_batch_{}/{}", i, node.name);
+        for (node, _) in nodes.iter().zip(&batched).filter(|(_, &b)| b) {
+            let mut node = node.clone();
+            node.attr.insert("_tge_origin".into(), AttrValue::new().apply(|x| x.set_s(node.name.as_bytes().to_vec())));
+            node.attr.insert("_tge_micro_batches".into(), AttrValue::new().apply(|x| x.set_i(times as _)));
+            node.name = batched_name(i, &node.name);
             for input in node.input.iter_mut() {
-                if input.starts_with('^') {
-                    *input = format!("^tge_fuse_batch_{}/{}", i, &input[1..]);
-                } else {
-                    *input = format!("tge_fuse_batch_{}/{}", i, input);
+                let (name, is_control) = if input.starts_with('^') { (&input[1..], true) } else { (parse_input(input).0, false) };
+                if batched[name_dict[name]] {
+                    *input = if is_control { format!("^{}", batched_name(i, &input[1..])) } else { batched_name(i, input) }
                 }
             }
             result.push(node)
         }
     }
 
-    todo!()
+    let mut sums = std::collections::BTreeSet::new();
+    for (node, _) in nodes.iter().zip(&batched).filter(|(_, &b)| !b) {
+        let mut node = node.clone();
+        let mut controls = vec![];
+        for input in node.input.iter_mut() {
+            if input.starts_with('^') {
+                if batched[name_dict[&input[1..]]] {
+                    controls.extend((1..times).map(|i| format!("^{}", batched_name(i, &input[1..]))));
+                    *input = format!("^{}", batched_name(0, &input[1..]))
+                }
+                continue
+            }
+
+            let (name, index) = parse_input(input);
+            let producer = &nodes[name_dict[name]];
+            if !batched[name_dict[name]] {
+                continue
+            }
+
+            if times == 1 { // the sum of a single micro-batch is itself
+                *input = batched_name(0, input);
+                continue
+            }
+
+            let sum_name = format!("tge_fuse_batch_sum/{}_{}", name, index);
+            if sums.insert(sum_name.clone()) {
+                let mut addn = NodeDef::new();
+                addn.op = "AddN".into();
+                addn.name = sum_name.clone();
+                addn.device = producer.device.clone();
+                addn.input = (0..times).map(|i| batched_name(i, input)).collect();
+                addn.attr.insert("N".into(), AttrValue::new().apply(|x| x.set_i(times as _)));
+                addn.attr.insert("T".into(), get_dtype(producer, index));
+                if let Some(shape) = producer.attr.get("_output_shapes").and_then(|x| x.get_list().shape.get(index)) {
+                    let mut list = crate::proto::attr_value::AttrValue_ListValue::new();
+                    list.shape.push(shape.clone());
+                    addn.attr.insert("_output_shapes".into(), AttrValue::new().apply(|x| x.set_list(list)));
+                }
+                result.push(addn)
+            }
+            *input = sum_name
+        }
+        for control in controls {
+            node.input.push(control)
+        }
+        result.push(node)
+    }
+
+    result
 }
 
 // remove identity nodes, NoOp nodes, and control dependencies, except for sinks
@@ -11,100 +11,553 @@ use crate::proto::node_def::NodeDef;
 use crate::proto::tensor::TensorProto;
 use crate::simulator::{GRPC_LATENCY, FALLBACK_NCCL_MODEL};
 
-pub fn heft_control(target: &mut Target, profiler: &impl Profiler) {
-    heft_rank(target, profiler, true);
+/// add control dependencies so that the nodes on each device run in the order of their ranks. A dependency is skipped when it is
+/// already implied by the existing edges. Returns the number of skipped dependencies.
+pub fn heft_control(target: &mut Target, profiler: &impl Profiler) -> usize {
+    let dag = Dag::new(target);
+    let ranks = compute_ranks(target, &dag, profiler, true);
+    let non_dangling_nodes = dag.non_dangling_nodes();
+    set_priorities(target, &ranks, &non_dangling_nodes);
+    add_control_dependencies(target, &dag, &ranks, &non_dangling_nodes)
+}
+
+pub fn heft_rank(target: &mut Target, profiler: &impl Profiler, break_tie: bool) {
+    let dag = Dag::new(target);
+    let ranks = compute_ranks(target, &dag, profiler, break_tie);
+    set_priorities(target, &ranks, &dag.non_dangling_nodes())
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Algorithm {
+    /// critical path on a processor: the priority is the sum of the upward and downward ranks, so nodes on the critical path go first
+    Cpop,
+    /// predict earliest finish time: the priority is the optimistic cost table, i.e. the longest path after a node excluding itself
+    Peft,
+    /// try each of the ready nodes with the highest upward ranks, schedule k more steps after it, and pick the one that gives the
+    /// smallest estimated makespan
+    Lookahead(usize)
+}
+
+impl Algorithm {
+    pub fn from_name(name: &str, lookahead: usize) -> Option<Self> {
+        match name {
+            "cpop" => Some(Algorithm::Cpop),
+            "peft" => Some(Algorithm::Peft),
+            "lookahead" => Some(Algorithm::Lookahead(lookahead)),
+            _ => None
+        }
+    }
+}
+
+/// the number of ready nodes that the lookahead scheduler compares at each step
+const LOOKAHEAD_WIDTH: usize = 8;
+
+/// the number of ready nodes that the memory-constrained scheduler looks for one that fits
+const MEMORY_SCAN_WIDTH: usize = 64;
+
+/// run a list scheduler on the compiled graph and set the `_priority` of each node to its position in the schedule. The placement is
+/// decided by the strategy, so the schedulers only decide the order on each device. Returns the number of skipped control dependencies
+/// if `add_control_dependency` is set (see heft_control), otherwise 0.
+/// If `memory_limits` is given, a ready node whose allocations exceed the limit of its device is deferred when another ready node fits.
+pub fn list_schedule(target: &mut Target, profiler: &impl Profiler, algorithm: Algorithm, add_control_dependency: bool, memory_limits: Option<&[u64]>) -> usize {
+    let dag = Dag::new(target);
+    let n = dag.len();
+    let order = dag.topological_order();
+    let times: Vec<u64> = (0..n).map(|i| profiler.profile(&target.pb.node[i], dag.devices[i]).unwrap_or(0)).collect();
+
+    // the longest path after each node, excluding itself
+    let mut tails = vec![0; n];
+    for &i in order.iter().rev() {
+        tails[i] = dag.succs(i).iter().map(|&(j, cost)| cost + times[j] + tails[j]).max().unwrap_or(0)
+    }
 
-    let name_dict: BTreeMap<String, usize> = target.pb.node.iter().enumerate().map(|(i, x)| (x.name.clone(), i)).collect();
-    let non_dangling_nodes = mark_non_dangling_nodes(target);
+    let priorities: Vec<u64> = match algorithm {
+        Algorithm::Cpop => {
+            let mut heads = vec![0; n]; // the longest path before each node, excluding itself
+            for &i in order.iter() {
+                heads[i] = dag.preds(i).iter().map(|&(j, cost)| heads[j] + times[j] + cost).max().unwrap_or(0)
+            }
+            (0..n).map(|i| heads[i] + times[i] + tails[i]).collect()
+        }
+        Algorithm::Peft => tails.clone(),
+        Algorithm::Lookahead(_) => (0..n).map(|i| times[i] + tails[i]).collect()
+    };
+
+    let mut indegrees: Vec<_> = (0..n).map(|i| dag.preds(i).len()).collect();
+    let mut arrivals = vec![0; n]; // the time that all inputs of a node arrive
+    let mut device_available_time = vec![0; target.devices.len()];
+    let mut ready: BinaryHeap<_> = (0..n).filter(|&i| indegrees[i] == 0).map(|i| (priorities[i], cmp::Reverse(i))).collect();
+    let mut memory = memory_limits.map(|limits| MemoryTracker::new(target, &dag, limits));
+    let width = match algorithm {
+        Algorithm::Lookahead(_) => LOOKAHEAD_WIDTH,
+        _ => 1
+    };
+    let width = if memory.is_some() { cmp::max(width, MEMORY_SCAN_WIDTH) } else { width };
+
+    let mut positions = vec![0; n];
+    let mut candidates = vec![];
+    for position in 0..n {
+        candidates.clear();
+        while candidates.len() < width {
+            match ready.pop() {
+                Some((_, cmp::Reverse(i))) => candidates.push(i),
+                None => break
+            }
+        }
+        assert!(!candidates.is_empty(), "the graph has a cycle");
+
+        // the candidates are in the order of priorities
+        let mut chosen = candidates.clone();
+        if let Some(memory) = &memory {
+            chosen.retain(|&i| memory.fits(&dag, i));
+            if chosen.is_empty() { // nothing fits, take the one that increases the memory the least
+                chosen.push(candidates.iter().copied().min_by_key(|&i| memory.net_increase(&dag, i)).unwrap())
+            }
+        }
+        let i = match algorithm {
+            Algorithm::Lookahead(k) if chosen.len() > 1 => {
+                chosen.truncate(LOOKAHEAD_WIDTH);
+                let estimate = |i| rollout(&dag, &times, &tails, &priorities, &arrivals, &device_available_time, &indegrees, &chosen, i, k);
+                chosen.iter().copied().min_by_key(|&i| (estimate(i), cmp::Reverse(priorities[i]), i)).unwrap()
+            }
+            _ => chosen[0]
+        };
+        ready.extend(candidates.iter().filter(|&&x| x != i).map(|&x| (priorities[x], cmp::Reverse(x))));
+        if let Some(memory) = &mut memory {
+            memory.execute(&dag, i)
+        }
+
+        let device_id = dag.devices[i];
+        let eft = cmp::max(device_available_time[device_id], arrivals[i]) + times[i];
+        device_available_time[device_id] = eft;
+        positions[i] = position as u64;
+        for &(j, cost) in dag.succs(i) {
+            arrivals[j] = cmp::max(arrivals[j], eft + cost);
+            indegrees[j] -= 1;
+            if indegrees[j] == 0 {
+                ready.push((priorities[j], cmp::Reverse(j)))
+            }
+        }
+    }
 
-    for dev in target.devices.iter() {
-        let mut list: Vec<_> = (0..name_dict.len()).filter(|&i| {
-            let node = &target.pb.node[i];
-            non_dangling_nodes.contains(&node.name) && *dev == node.device
+    let non_dangling_nodes = dag.non_dangling_nodes();
+    set_priorities(target, &positions, &non_dangling_nodes);
+    if add_control_dependency {
+        add_control_dependencies(target, &dag, &positions, &non_dangling_nodes)
+    } else {
+        0
+    }
+}
+
+/// the memory usage of each device when the nodes run in the order of a list schedule. Tensors are allocated when they are produced
+/// or transferred and freed after the last consumer runs. The outputs of variables are never freed, as in the persistent memory model
+/// of the simulator.
+struct MemoryTracker<'a> {
+    limits: &'a [u64],
+    live: Vec<u64>,
+    persistent: Vec<bool>,
+    outputs: Vec<Vec<usize>>, // the indexes of the outputs of each node that are consumed
+    sizes: HashMap<(usize, usize), u64>, // (node, index) => the largest size that the consumers see
+    ref_counts: HashMap<(usize, usize, usize), usize>, // (node, index, device) => the number of consumers that have not run
+    allocated: std::collections::HashSet<(usize, usize, usize)>
+}
+
+impl<'a> MemoryTracker<'a> {
+    fn new(target: &Target, dag: &Dag, limits: &'a [u64]) -> Self {
+        assert!(limits.len() == target.devices.len());
+        let n = dag.len();
+        let persistent = target.pb.node.iter().map(|node| match &node.op[..] {
+            "VariableV2" | "Variable" | "VarHandleOp" => true,
+            _ => false
         }).collect();
 
-        list.sort_unstable_by_key(|&i| target.pb.node[i].attr.get("_priority").unwrap().get_i());
-        for window in list.windows(2) {
-            let dep = format!("^{}", target.pb.node[window[0]].name);
-            target.pb.node[window[1]].input.push(dep)
-            // TODO: skip unnecessary dependencies by depth-first search?
+        let mut sizes: HashMap<(usize, usize), u64> = HashMap::new();
+        let mut ref_counts = HashMap::new();
+        for i in 0..n {
+            for (j, index, size) in dag.input_tensors(i) {
+                let entry = sizes.entry((j, index)).or_insert(0);
+                *entry = cmp::max(*entry, size);
+                *ref_counts.entry((j, index, dag.devices[j])).or_insert(0) += 1;
+                if dag.devices[i] != dag.devices[j] {
+                    *ref_counts.entry((j, index, dag.devices[i])).or_insert(0) += 1;
+                }
+            }
+        }
+        let mut outputs = vec![vec![]; n];
+        for &(j, index) in sizes.keys() {
+            outputs[j].push(index)
+        }
+
+        MemoryTracker { limits, live: vec![0; limits.len()], persistent, outputs, sizes, ref_counts, allocated: Default::default() }
+    }
+
+    /// the memory allocated on the device of node i when it runs: its outputs and the inputs transferred from other devices
+    fn allocation(&self, dag: &Dag, i: usize) -> u64 {
+        let d = dag.devices[i];
+        let outputs: u64 = self.outputs[i].iter().map(|&index| self.sizes[&(i, index)]).sum();
+        let mut transferred = BTreeSet::new();
+        let inputs: u64 = dag.input_tensors(i)
+            .filter(|&(j, index, _)| dag.devices[j] != d && !self.allocated.contains(&(j, index, d)) && transferred.insert((j, index)))
+            .map(|(j, index, _)| self.sizes[&(j, index)]).sum();
+        outputs + inputs
+    }
+
+    fn fits(&self, dag: &Dag, i: usize) -> bool {
+        let d = dag.devices[i];
+        self.live[d] + self.allocation(dag, i) <= self.limits[d]
+    }
+
+    /// the allocation minus the inputs on the same device that are freed after node i runs
+    fn net_increase(&self, dag: &Dag, i: usize) -> i64 {
+        let d = dag.devices[i];
+        let mut uses: BTreeMap<(usize, usize), usize> = BTreeMap::new();
+        for (j, index, _) in dag.input_tensors(i) {
+            *uses.entry((j, index)).or_insert(0) += 1
+        }
+        let freed: u64 = uses.iter().filter(|&(&(j, index), &count)| {
+            (dag.devices[j] != d || !self.persistent[j]) && self.ref_counts.get(&(j, index, d)) == Some(&count)
+        }).map(|(tensor, _)| self.sizes[tensor]).sum();
+        self.allocation(dag, i) as i64 - freed as i64
+    }
+
+    fn execute(&mut self, dag: &Dag, i: usize) {
+        let d = dag.devices[i];
+        self.live[d] += self.allocation(dag, i);
+        for &index in self.outputs[i].iter() {
+            self.allocated.insert((i, index, d));
+        }
+        for (j, index, _) in dag.input_tensors(i) {
+            self.allocated.insert((j, index, d));
+            let devices = if dag.devices[j] == d { vec![d] } else { vec![dag.devices[j], d] };
+            for device in devices {
+                let count = self.ref_counts.get_mut(&(j, index, device)).unwrap();
+                *count -= 1;
+                if *count == 0 && !(self.persistent[j] && device == dag.devices[j]) {
+                    self.live[device] -= self.sizes[&(j, index)];
+                    self.allocated.remove(&(j, index, device));
+                }
+            }
         }
     }
 }
 
-pub fn heft_rank(target: &mut Target, profiler: &impl Profiler, break_tie: bool) {
-    let name_dict: BTreeMap<String, usize> = target.pb.node.iter().enumerate().map(|(i, x)| (x.name.clone(), i)).collect();
-    let device_dict: BTreeMap<&String, usize> = target.devices.iter().enumerate().map(|(i, x)| (x, i)).collect();
-    let mut ranks = vec![Option::<u64>::None; name_dict.len()];
-    let mut succs = vec![BTreeSet::<usize>::new(); name_dict.len()];
-
-    for (node, succ) in target.pb.node.iter().zip(succs.iter_mut()) {
-        for input in node.input.iter() {
-            let input = if input.starts_with('^') {
-                &input[1..]
-            } else {
-                parse_input(input).0
-            };
+/// estimate the makespan if node `first` of the candidates is scheduled now: schedule it and then k more nodes from the rest of the
+/// candidates and the nodes that become ready, in the order of priorities. The nodes that are not scheduled in k steps contribute the
+/// earliest time that they can finish plus the longest path after them.
+fn rollout(
+    dag: &Dag, times: &[u64], tails: &[u64], priorities: &[u64], arrivals: &[u64], device_available_time: &[u64], indegrees: &[usize],
+    candidates: &[usize], first: usize, k: usize
+) -> u64 {
+    let mut device_available_time = device_available_time.to_vec();
+    let mut arrivals_overlay: BTreeMap<usize, u64> = BTreeMap::new();
+    let mut indegrees_overlay: BTreeMap<usize, usize> = BTreeMap::new();
+    let mut ready: BinaryHeap<_> = candidates.iter().filter(|&&i| i != first).map(|&i| (priorities[i], cmp::Reverse(i))).collect();
+    let mut result = 0;
+    let mut next = Some(first);
+    for _ in 0..=k {
+        let i = match next.take().or_else(|| ready.pop().map(|(_, cmp::Reverse(i))| i)) {
+            Some(i) => i,
+            None => break
+        };
+        let arrival = arrivals_overlay.get(&i).copied().unwrap_or(arrivals[i]);
+        let eft = cmp::max(device_available_time[dag.devices[i]], arrival) + times[i];
+        device_available_time[dag.devices[i]] = eft;
+        result = cmp::max(result, eft + tails[i]);
+        for &(j, cost) in dag.succs(i) {
+            let arrival = arrivals_overlay.entry(j).or_insert(arrivals[j]);
+            *arrival = cmp::max(*arrival, eft + cost);
+            let indegree = indegrees_overlay.entry(j).or_insert(indegrees[j]);
+            *indegree -= 1;
+            if *indegree == 0 {
+                ready.push((priorities[j], cmp::Reverse(j)))
+            }
+        }
+    }
 
-            succ.insert(name_dict[input]);
+    for (_, cmp::Reverse(i)) in ready {
+        let arrival = arrivals_overlay.get(&i).copied().unwrap_or(arrivals[i]);
+        result = cmp::max(result, cmp::max(device_available_time[dag.devices[i]], arrival) + times[i] + tails[i])
+    }
+    result
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum PipelineSchedule {
+    /// the forward passes of all micro-batches, then the backward passes
+    GPipe,
+    /// after the forward passes needed to fill the pipeline, each stage alternates between one forward pass and one backward pass, so
+    /// fewer micro-batches keep their activations alive at the same time
+    OneForwardOneBackward
+}
+
+impl PipelineSchedule {
+    pub fn from_name(name: &str) -> Option<Self> {
+        match name {
+            "gpipe" => Some(PipelineSchedule::GPipe),
+            "1f1b" => Some(PipelineSchedule::OneForwardOneBackward),
+            _ => None
         }
     }
 
-    let mut stack: Vec<_> = (0..name_dict.len()).collect();
-    while let Some(i) = stack.pop() {
-        if ranks[i].is_some() {
-            continue
+    /// the position of the forward or backward pass of a micro-batch among the passes on a stage
+    fn slot(self, backward: bool, micro_batch: usize, stage: usize, nstages: usize, nmicro_batches: usize) -> usize {
+        let warmup = cmp::min(nstages - stage, nmicro_batches);
+        match (self, backward) {
+            (PipelineSchedule::GPipe, false) => micro_batch,
+            (PipelineSchedule::GPipe, true) => nmicro_batches + micro_batch,
+            (PipelineSchedule::OneForwardOneBackward, false) if micro_batch < warmup => micro_batch,
+            (PipelineSchedule::OneForwardOneBackward, false) => warmup + 2 * (micro_batch - warmup) + 1,
+            (PipelineSchedule::OneForwardOneBackward, true) if micro_batch < nmicro_batches - warmup => warmup + 2 * micro_batch,
+            (PipelineSchedule::OneForwardOneBackward, true) => nmicro_batches + micro_batch
         }
+    }
+}
+
+/// order the micro-batches of a graph fused by polishing::fuse_mini_batch with a pipeline schedule, by chaining the nodes on each device
+/// with control dependencies (see heft_control). The stages are the devices in the order that the forward pass of the first micro-batch
+/// reaches them, and the backward nodes are the ones under the "gradients" scope. The nodes that are shared by the micro-batches run
+/// as soon as they are ready. Returns the number of skipped control dependencies.
+pub fn pipeline_schedule(target: &mut Target, schedule: PipelineSchedule) -> usize {
+    let dag = Dag::new(target);
+    let n = dag.len();
+    let order = dag.topological_order();
 
-        if succs[i].iter().any(|&j| ranks[j].is_none()) {
-            stack.push(i);
-            stack.extend(succs[i].iter());
-            continue
+    // (micro-batch, is backward) of each node, parsed from the names so the auxiliary nodes are included
+    let passes: Vec<Option<(usize, bool)>> = target.pb.node.iter().map(|node| {
+        let rest = node.name.strip_prefix("tge_fuse_batch_")?;
+        let i = rest.find('/')?;
+        Some((rest[..i].parse().ok()?, crate::graph::is_backward_name(&rest[i+1..])))
+    }).collect();
+    let nmicro_batches = passes.iter().flatten().map(|&(m, _)| m + 1).max().unwrap_or(1);
+
+    let mut stages = vec![None; target.devices.len()];
+    let mut nstages: usize = 0;
+    for &i in order.iter() {
+        if passes[i] == Some((0, false)) && stages[dag.devices[i]].is_none() {
+            stages[dag.devices[i]] = Some(nstages);
+            nstages += 1
         }
+    }
 
-        let device_id = device_dict[&target.pb.node[i].device];
-        let time = succs[i].iter().map(|&j| ranks[j].unwrap()).max().unwrap_or(0) +
-                   profiler.profile(&target.pb.node[i], device_id).unwrap_or(0) +
-                   break_tie as u64; // additional rank to prevent ties on zero-time op which may cause dead locks
-        ranks[i] = Some(time)
+    let keys: Vec<usize> = (0..n).map(|i| match passes[i] {
+        Some((micro_batch, backward)) => {
+            let stage = stages[dag.devices[i]].unwrap_or(nstages.saturating_sub(1));
+            schedule.slot(backward, micro_batch, stage, cmp::max(nstages, 1), nmicro_batches)
+        }
+        None => 0
+    }).collect();
+
+    // a topological order that follows the keys when possible, so chaining the nodes in it never forms a cycle
+    let mut positions = vec![0; n];
+    for (position, &i) in order.iter().enumerate() {
+        positions[i] = position
+    }
+    let mut indegrees: Vec<_> = (0..n).map(|i| dag.preds(i).len()).collect();
+    let mut heap: BinaryHeap<_> = (0..n).filter(|&i| indegrees[i] == 0).map(|i| cmp::Reverse((keys[i], positions[i], i))).collect();
+    let mut ranks = vec![0; n];
+    let mut rank = 0;
+    while let Some(cmp::Reverse((_, _, i))) = heap.pop() {
+        ranks[i] = rank;
+        rank += 1;
+        for &(j, _) in dag.succs(i) {
+            indegrees[j] -= 1;
+            if indegrees[j] == 0 {
+                heap.push(cmp::Reverse((keys[j], positions[j], j)))
+            }
+        }
     }
 
-    let non_dangling_nodes = mark_non_dangling_nodes(target);
-    for (node, rank) in target.pb.node.iter_mut().zip(ranks) {
-        if non_dangling_nodes.contains(&node.name) {
-            node.attr.insert("_priority".to_string(), AttrValue::new().apply(|x| x.set_i(rank.unwrap() as _))).ignore();
+    let non_dangling_nodes = dag.non_dangling_nodes();
+    set_priorities(target, &ranks, &non_dangling_nodes);
+    add_control_dependencies(target, &dag, &ranks, &non_dangling_nodes)
+}
+
+/// chain the non-dangling nodes on each device in the order of `ranks`, which must strictly increase along edges. Dependencies that are
+/// already implied by the graph are skipped. Returns the number of skipped dependencies.
+fn add_control_dependencies(target: &mut Target, dag: &Dag, ranks: &[u64], non_dangling_nodes: &[bool]) -> usize {
+    // this is a topological order of the graph with the new dependencies
+    let mut order: Vec<_> = (0..ranks.len()).filter(|&i| non_dangling_nodes[i]).collect();
+    order.sort_unstable_by_key(|&i| (ranks[i], i));
+
+    // clocks[i * ndev + d] is one plus the position of the last node on device d that reaches node i, or 0 if none. The nodes on a device
+    // form a chain after adding the dependencies, so node i is reachable from the p-th node on device d iff clocks[i * ndev + d] > p.
+    let ndev = target.devices.len();
+    let mut clocks = vec![0u32; ranks.len() * ndev];
+    let mut last_of_devices = vec![None; ndev]; // (node, position)
+    let mut deps = vec![];
+    let mut nelided = 0;
+    for &i in order.iter() {
+        let d = dag.devices[i];
+        for &(j, _) in dag.preds(i) {
+            merge_clock(&mut clocks, ndev, j, i)
         }
+        if let Some((prev, position)) = last_of_devices[d] {
+            if clocks[i * ndev + d] > position {
+                nelided += 1
+            } else {
+                deps.push((prev, i));
+                merge_clock(&mut clocks, ndev, prev, i)
+            }
+        }
+        let position = last_of_devices[d].map(|(_, p)| p + 1).unwrap_or(0);
+        clocks[i * ndev + d] = position + 1;
+        last_of_devices[d] = Some((i, position))
+    }
+
+    for (prev, i) in deps {
+        let dep = format!("^{}", target.pb.node[prev].name);
+        target.pb.node[i].input.push(dep)
     }
+
+    nelided
 }
 
-fn parse_input(x: &str) -> (&str, usize) {
-    match x.find(':') {
-        Some(i) => (&x[..i], x[i+1..].parse().unwrap()),
-        None => (x, 0)
+fn merge_clock(clocks: &mut [u32], ndev: usize, from: usize, to: usize) {
+    for d in 0..ndev {
+        clocks[to * ndev + d] = cmp::max(clocks[to * ndev + d], clocks[from * ndev + d])
     }
 }
 
-pub fn mark_non_dangling_nodes(target: &Target) -> std::collections::HashSet<String> {
-    // note: don't forget control dependency
-    let dict: std::collections::HashMap<_, Vec<_>> = target.pb.node.iter().map(|node| {
-        (&node.name[..], node.input.iter().map(|x| {
-            if x.starts_with('^') {
-                return &x[1..]
+/// the graph of a target with node names resolved into indices
+struct Dag {
+    devices: Vec<usize>,
+    /// the inputs of node i are preds[pred_offsets[i]..pred_offsets[i+1]], each with the time of transferring it to i
+    pred_offsets: Vec<usize>,
+    preds: Vec<(usize, u64)>,
+    /// the output index and the size of the tensor of each input in `preds`, or None for control dependencies
+    pred_tensors: Vec<Option<(usize, u64)>>,
+    /// the same edges indexed by the source
+    succ_offsets: Vec<usize>,
+    succs: Vec<(usize, u64)>,
+    sinks: Vec<usize>
+}
+
+impl Dag {
+    fn new(target: &Target) -> Self {
+        let n = target.pb.node.len();
+        let edges = target.edges();
+        let device_dict: HashMap<&str, usize> = target.devices.iter().enumerate().map(|(i, x)| (&x[..], i)).collect();
+        let devices: Vec<usize> = target.pb.node.iter().map(|node| device_dict[&node.device[..]]).collect();
+
+        let mut pred_offsets = Vec::with_capacity(n + 1);
+        let mut preds = vec![];
+        let mut pred_tensors = vec![];
+        pred_offsets.push(0);
+        for (i, node) in target.pb.node.iter().enumerate() {
+            let sizes = node.attr.get("_tge_input_sizes").map(|x| &x.get_list().i[..]).unwrap_or(&[]);
+            for (input_index, input) in edges.inputs(i).iter().enumerate() {
+                match input.index {
+                    None => {
+                        preds.push((input.node, 0));
+                        pred_tensors.push(None)
+                    }
+                    Some(index) => {
+                        let size = sizes.get(input_index).copied().unwrap_or(0) as _;
+                        preds.push((input.node, transfer_time(target, devices[input.node], devices[i], size)));
+                        pred_tensors.push(Some((index, size)))
+                    }
+                }
+            }
+            pred_offsets.push(preds.len());
+        }
+
+        let mut succ_offsets = vec![0; n + 1];
+        for &(j, _) in preds.iter() {
+            succ_offsets[j + 1] += 1
+        }
+        for i in 0..n {
+            succ_offsets[i + 1] += succ_offsets[i]
+        }
+        let mut succs = vec![(0, 0); preds.len()];
+        let mut cursor = succ_offsets.clone();
+        for i in 0..n {
+            for &(j, cost) in &preds[pred_offsets[i]..pred_offsets[i+1]] {
+                succs[cursor[j]] = (i, cost);
+                cursor[j] += 1
             }
-            match x.find(':') {
-                Some(i) => &x[..i],
-                None => x
+        }
+
+        let sinks = target.sinks.iter().map(|x| edges.names[&x[..]]).collect();
+        Dag { devices, pred_offsets, preds, pred_tensors, succ_offsets, succs, sinks }
+    }
+
+    fn len(&self) -> usize {
+        self.devices.len()
+    }
+
+    fn preds(&self, i: usize) -> &[(usize, u64)] {
+        &self.preds[self.pred_offsets[i]..self.pred_offsets[i+1]]
+    }
+
+    /// the data inputs of node i as (input node, output index, size)
+    fn input_tensors(&self, i: usize) -> impl Iterator<Item=(usize, usize, u64)> + '_ {
+        let range = self.pred_offsets[i]..self.pred_offsets[i+1];
+        self.preds[range.clone()].iter().zip(&self.pred_tensors[range]).filter_map(|(&(j, _), tensor)| tensor.map(|(index, size)| (j, index, size)))
+    }
+
+    fn succs(&self, i: usize) -> &[(usize, u64)] {
+        &self.succs[self.succ_offsets[i]..self.succ_offsets[i+1]]
+    }
+
+    fn topological_order(&self) -> Vec<usize> {
+        let n = self.len();
+        let mut indegrees: Vec<_> = (0..n).map(|i| self.preds(i).len()).collect();
+        let mut queue: VecDeque<_> = (0..n).filter(|&i| indegrees[i] == 0).collect();
+        let mut order = Vec::with_capacity(n);
+        while let Some(i) = queue.pop_front() {
+            order.push(i);
+            for &(j, _) in self.succs(i) {
+                indegrees[j] -= 1;
+                if indegrees[j] == 0 {
+                    queue.push_back(j)
+                }
             }
-        }).collect())
-    }).collect();
-    let mut keep = std::collections::HashSet::new();
-    let mut queue: std::collections::VecDeque<_> = target.sinks.iter().map(|x| &x[..]).collect();
+        }
+        assert!(order.len() == n, "the graph has a cycle");
+        order
+    }
+
+    /// the nodes that the sinks depend on. Note: don't forget control dependency
+    fn non_dangling_nodes(&self) -> Vec<bool> {
+        let mut keep = vec![false; self.len()];
+        let mut queue: VecDeque<_> = self.sinks.iter().copied().collect();
+        while let Some(i) = queue.pop_front() {
+            if !keep[i] {
+                keep[i] = true;
+                queue.extend(self.preds(i).iter().map(|&(j, _)| j))
+            }
+        }
+        keep
+    }
+}
 
-    while let Some(x) = queue.pop_front() {
-        if keep.insert(x.to_string()) {
-            queue.extend(&dict[x]);
+/// the rank of a node is the length of the longest path from the sources to the end of it, including the transfer time of the inputs
+/// that come from other devices. The ranks strictly increase along edges when `break_tie` is set.
+fn compute_ranks(target: &Target, dag: &Dag, profiler: &impl Profiler, break_tie: bool) -> Vec<u64> {
+    let mut ranks = vec![0; dag.len()];
+    for i in dag.topological_order() {
+        ranks[i] = dag.preds(i).iter().map(|&(j, cost)| ranks[j] + cost).max().unwrap_or(0) +
+                   profiler.profile(&target.pb.node[i], dag.devices[i]).unwrap_or(0) +
+                   break_tie as u64; // additional rank to prevent ties on zero-time op which may cause dead locks
+    }
+    ranks
+}
+
+fn set_priorities(target: &mut Target, ranks: &[u64], non_dangling_nodes: &[bool]) {
+    for ((node, &rank), &keep) in target.pb.node.iter_mut().zip(ranks).zip(non_dangling_nodes) {
+        if keep {
+            node.attr.insert("_priority".to_string(), AttrValue::new().apply(|x| x.set_i(rank as _))).ignore();
         }
     }
+}
 
-    keep
+/// the time of sending `size` bytes from one device to another, the same as the simulator charges when the link is idle
+fn transfer_time(target: &Target, from: usize, to: usize, size: u64) -> u64 {
+    let path = &target.paths[from * target.ndev() + to];
+    if path.is_empty() {
+        return 0
+    }
+    let bandwidth = path.iter().fold(core::u64::MAX, |min, link| cmp::min(min, target.links[*link]));
+    size / bandwidth + GRPC_LATENCY
 }
+
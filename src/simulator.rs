@@ -2,6 +2,8 @@ use oh_my_rust::*;
 use serde_json::json;
 use core::{cmp, convert::TryInto, fmt::Write};
 use std::collections::{BTreeMap, BTreeSet, BinaryHeap, VecDeque, HashMap};
+use std::collections::hash_map::DefaultHasher;
+use core::hash::{Hash, Hasher};
 use std::sync::{Arc, Mutex};
 use crate::misc::{Target, Profiler};
 use crate::graph::Form;
@@ -15,53 +17,198 @@ pub const GRPC_LATENCY: u64 = 12;
 #[allow(clippy::unreadable_literal)]
 pub const FALLBACK_NCCL_MODEL: [f64; 4] = [0.043420241077615454, 368.2013618677043, 0.27766802543921265, 211.91926070037152];
 
-pub trait Simulator {
-    fn new(target: &Target) -> Self;
-    fn simulate(&mut self, profiler: &impl Profiler, target: Target);
+pub trait Simulator<'a> {
+    fn new(target: &'a Target) -> Self;
+    fn simulate(&mut self, profiler: &impl Profiler);
     fn get_total_time(&self) -> u64;
     fn get_peak_memories(&self) -> &[u64];
     fn write_chrome<W: std::io::Write>(&self, output: &mut W);
     fn dump_records<W: std::io::Write>(&self, output: &mut W);
 }
 
+/// filters of the chrome trace, read from `target.options`
+struct ChromeOptions {
+    devices: Option<BTreeSet<usize>>, // "chrome_devices": comma separated device indices
+    start: u64, // "chrome_start" and "chrome_end": only tasks overlapping this window are written
+    end: u64,
+    min_duration: u64, // "chrome_min_duration": shorter tasks are omitted. Defaults to 1 so zero-length tasks are skipped
+    aggregate_links: bool // "chrome_aggregate_links": merge overlapping transfers on each link into one event
+}
+
+impl ChromeOptions {
+    fn from_target(target: &Target) -> Self {
+        let get = |name: &str, default: u64| target.options.get(name).map(|x| x.parse().unwrap()).unwrap_or(default);
+        ChromeOptions {
+            devices: target.options.get("chrome_devices").map(|x| x.split(',').map(|d| d.trim().parse().unwrap()).collect()),
+            start: get("chrome_start", 0),
+            end: get("chrome_end", u64::MAX),
+            min_duration: get("chrome_min_duration", 1),
+            aggregate_links: target.options.get("chrome_aggregate_links").map(|x| x == "True").unwrap_or(false)
+        }
+    }
+
+    fn keep_device(&self, gpu: usize) -> bool {
+        self.devices.as_ref().map(|x| x.contains(&gpu)).unwrap_or(true)
+    }
+
+    fn keep_span(&self, start: u64, end: u64) -> bool {
+        end - start >= self.min_duration && end >= self.start && start <= self.end
+    }
+}
+
+/// the output arrays of `write_feedback`. Ops are in the order of `op_index`, devices and links are in the order of the target.
+pub struct Feedback<'s> {
+    pub op_makespan: &'s mut [u64],
+    pub op_idle_after: &'s mut [u64],
+    pub op_slack: &'s mut [u64], // the least slack of the nodes that come from each op
+    pub op_critical_time: &'s mut [u64], // the time that the tasks of each op (including the transfers to it) take on the critical path
+    pub device_busy_time: &'s mut [u64],
+    pub device_critical_time: &'s mut [u64], // the time that computations and all-reduces on each device take on the critical path
+    pub link_critical_time: &'s mut [u64] // the time that transfers through each link take on the critical path
+}
+
+#[derive(Debug, Default)]
+struct CriticalPath<'a> {
+    path: Vec<usize>, // task ids from the first to the last
+    op_slack: BTreeMap<&'a str, u64>,
+    op_critical_time: BTreeMap<&'a str, u64>,
+    device_critical_time: Vec<u64>,
+    link_critical_time: Vec<u64>
+}
+
+/// the memory model, read from `target.options`. By default only the activations (tensorbufs) are counted.
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+struct MemoryOptions {
+    persistent: bool, // "memory_persistent": variables, including optimizer states like the Adam slots, reside on their devices for the whole step
+    fragmentation: bool, // "memory_fragmentation": place tensorbufs with a best-fit allocator like BFC and report the peak footprint instead of the peak of live bytes
+    timeline: bool // "memory_timeline": record the memory usage of each device over time. Simulations with it never resume from a timeline.
+}
+
+impl MemoryOptions {
+    fn from_target(target: &Target) -> Self {
+        let get = |name: &str| target.options.get(name).map(|x| x == "True").unwrap_or(false);
+        MemoryOptions { persistent: get("memory_persistent"), fragmentation: get("memory_fragmentation"), timeline: get("memory_timeline") }
+    }
+}
+
+/// allocation sizes are rounded up to this, as the BFC allocator of Tensorflow does
+const ALLOCATION_GRANULARITY: u64 = 256;
+
+/// a best-fit allocator with coalescing, like the BFC allocator of Tensorflow. It only tracks the address space of a device
+/// and the footprint is the highest address ever used, so the difference to the live bytes is the fragmentation.
+#[derive(Debug, Clone, Default)]
+struct Allocator {
+    free_chunks: BTreeSet<(u64, u64)>, // (size, offset), so the best fit is the first chunk that is large enough
+    free_offsets: BTreeMap<u64, u64>, // offset => size of the same free chunks, for coalescing
+    top: u64, // the end of the used address space. There is never a free chunk right below it.
+    footprint: u64
+}
+
+impl Allocator {
+    fn alloc(&mut self, size: u64) -> u64 {
+        let size = round_up(size, ALLOCATION_GRANULARITY);
+        if let Some(&(chunk_size, offset)) = self.free_chunks.range((size, 0)..).next() {
+            self.remove_free_chunk(offset, chunk_size);
+            if chunk_size > size {
+                self.insert_free_chunk(offset + size, chunk_size - size)
+            }
+            return offset
+        }
+
+        let offset = self.top;
+        self.top += size;
+        self.footprint = cmp::max(self.footprint, self.top);
+        offset
+    }
+
+    fn free(&mut self, mut offset: u64, size: u64) {
+        let mut size = round_up(size, ALLOCATION_GRANULARITY);
+        if let Some(&next_size) = self.free_offsets.get(&(offset + size)) {
+            self.remove_free_chunk(offset + size, next_size);
+            size += next_size
+        }
+        if let Some((&prev_offset, &prev_size)) = self.free_offsets.range(..offset).next_back() {
+            if prev_offset + prev_size == offset {
+                self.remove_free_chunk(prev_offset, prev_size);
+                offset = prev_offset;
+                size += prev_size
+            }
+        }
+
+        if offset + size == self.top {
+            self.top = offset
+        } else {
+            self.insert_free_chunk(offset, size)
+        }
+    }
+
+    fn insert_free_chunk(&mut self, offset: u64, size: u64) {
+        self.free_chunks.insert((size, offset));
+        self.free_offsets.insert(offset, size);
+    }
+
+    fn remove_free_chunk(&mut self, offset: u64, size: u64) {
+        self.free_chunks.remove(&(size, offset));
+        self.free_offsets.remove(&offset);
+    }
+}
+
+/// record the memory usage at a time. Multiple changes at the same time are merged into one record.
+fn push_memory_record(records: &mut Vec<(u64, u64)>, time: u64, bytes: u64) {
+    match records.last_mut() {
+        Some(last) if last.0 == time => last.1 = bytes,
+        _ => records.push((time, bytes))
+    }
+}
+
+fn round_up(x: u64, granularity: u64) -> u64 {
+    (x + granularity - 1) / granularity * granularity
+}
+
 #[derive(Debug, Default)]
 struct CollectiveGroup {
     devices: Vec<usize>,
+    links: Vec<usize>, // the links used by the ring among the devices
     model: [f64; 4]
 }
 
-#[derive(Debug)]
+/// tensor fusion of all-reduces like Horovod, read from `target.options`
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+struct FusionOptions {
+    threshold: u64, // "collective_fusion_threshold": the max bytes of a fused all-reduce. 0 (default) disables fusion. With fusion, the order of all-reduces in the graph is ignored
+    cycle: u64 // "collective_fusion_cycle": all-reduces only start at multiples of this, so the ones ready in the same cycle are fused
+}
+
+impl FusionOptions {
+    fn from_target(target: &Target) -> Self {
+        let get = |name: &str| target.options.get(name).map(|x| x.parse().unwrap()).unwrap_or(0);
+        FusionOptions { threshold: get("collective_fusion_threshold"), cycle: get("collective_fusion_cycle") }
+    }
+}
+
+/// the latest fused all-reduce of a group. All-reduces that become ready before it starts join it if it is not full.
+#[derive(Debug, Clone)]
+struct Bucket {
+    start: u64,
+    size: u64,
+    members: Vec<usize> // task ids
+}
+
+#[derive(Debug, Clone, Copy)]
 enum TaskType {
     Computation { id: usize, gpu: usize },
-    Transfer { size: u64, path: Box<[usize]> },
+    Transfer { size: u64, from: usize, to: usize }, // the path is looked up in target.paths when scheduling
     Collective { instance_key: usize, group_key: usize, size: u64 }
 }
 
 #[derive(Debug)]
 struct Task {
     pub content: TaskType,
-    pub wait_for: Vec<usize>,
-    pub notify: Vec<usize>,
-    pub in_tensors: Vec<TensorBuf>, // note: in_tensors might be less than wait_for because of control dependencies
-    pub out_tensors: Vec<TensorBuf>,
-
     pub eft: u64,
     pub duration: u64
 }
 
-impl Task {
-    fn create(list: &mut Vec<Task>, content: TaskType, wait_for: &[usize], in_tensors: Vec<TensorBuf>, out_tensors: Vec<TensorBuf>) -> usize {
-        let task = Task { content, wait_for: wait_for.to_vec(), in_tensors, out_tensors, notify: vec![], eft: 0, duration: 0 };
-        let id = list.len();
-        for i in wait_for {
-            list[*i].notify.push(id);
-        }
-        list.push(task);
-        id
-    }
-}
-
-#[derive(Eq, PartialEq)]
+#[derive(Debug, Clone, Eq, PartialEq)]
 struct OngoingTask { id: usize, eft: u64 }
 
 impl Ord for OngoingTask {
@@ -76,129 +223,564 @@ impl PartialOrd for OngoingTask {
     }
 }
 
-type TensorBuf = (usize, usize, usize); // id, index, gpu
+#[derive(Debug, Clone)]
+struct TensorBuf {
+    node: usize,
+    index: usize,
+    gpu: usize,
+    size: u64
+}
+
+/// compressed sparse rows: the i-th row is `values[offsets[i]..offsets[i+1]]`
+#[derive(Debug, Default)]
+struct Csr {
+    offsets: Vec<usize>,
+    values: Vec<usize>
+}
+
+impl Csr {
+    /// build from (row, value) pairs. The values in each row keep the order they appear in `pairs`.
+    fn new(nrows: usize, pairs: &[(usize, usize)]) -> Self {
+        let mut offsets = vec![0; nrows + 1];
+        for &(row, _) in pairs {
+            offsets[row + 1] += 1
+        }
+        for i in 0..nrows {
+            offsets[i + 1] += offsets[i]
+        }
+        let mut cursor = offsets.clone();
+        let mut values = vec![0; pairs.len()];
+        for &(row, value) in pairs {
+            values[cursor[row]] = value;
+            cursor[row] += 1
+        }
+        Csr { offsets, values }
+    }
+
+    fn row(&self, i: usize) -> &[usize] {
+        &self.values[self.offsets[i]..self.offsets[i+1]]
+    }
+}
 
 // track all tensors, have two fields: activate (the transfer op that receives it) and deactivate (list of ops that use it)
 // implementation: transfer task save activate tensor id, tensors is an array contains sizes and ref counts, computation save deactivate tensor id
 // consume memory when the activate op is finished, and deactivate when all deactivate ops are done
 // TODO: ensure every tensor being transferred, even if the path is empty
 
-#[derive(Debug, Default)]
-pub struct SimpleSimulator {
-    target: Target,
+/// the number of checkpoints saved in a timeline
+pub const TIMELINE_CHECKPOINTS: usize = 16;
+
+/// the mutable state of a simulation. Checkpoints in a timeline are copies of it.
+#[derive(Debug, Clone)]
+struct SimState {
+    event: usize, // the number of processed events. An event is either scheduling a ready task or finishing an ongoing task
+    time: u64,
+    ready_list: VecDeque<usize>,
+    ongoing_tasks: BinaryHeap<OngoingTask>,
+    n_waiting: Vec<usize>, // the number of unfinished predecessors
+    ref_counts: Vec<usize>, // the number of unfinished tasks that use each tensorbuf
+    activated: Vec<bool>,
+    gpu_available_time: Vec<u64>,
+    link_available_time: Vec<u64>,
+    current_memory: Vec<u64>,
+    max_memory: Vec<u64>,
+    allocators: Vec<Allocator>, // only used when modeling fragmentation
+    offsets: Vec<u64>, // the address of each activated tensorbuf in the allocator of its device
+    collective_state: BTreeMap<usize, Vec<usize>>, // instance_key => [ready task_id]
+    collective_device_time: Vec<u64>, // when the communication stream of each device is available for the next all-reduce
+    collective_link_time: Vec<u64>, // when each link is available for the next all-reduce. All-reduces do not share links with transfers.
+    buckets: BTreeMap<usize, Bucket>, // group_key => the latest bucket, only used with fusion
+    flows: Vec<Flow>, // ongoing transfers that share links, only used with the fair share link model
+    flow_time: u64, // the time that the remaining bytes of the flows are counted at
+    schedule: Vec<(u64, u64)> // (eft, duration) of each task. Only filled in checkpoints since the live values are in the tasks
+}
+
+/// a transfer that shares the bandwidth of the links on its path with other flows
+#[derive(Debug, Clone)]
+struct Flow {
+    task: usize,
+    path: usize, // the index in target.paths
+    start: u64,
+    remaining: f64, // bytes
+    rate: f64 // bytes per time unit
+}
+
+impl SimState {
+    /// start the all-reduce of an instance whose tasks are all ready, or fuse it into the pending bucket of the group.
+    /// All-reduces of groups that use disjoint devices and links run concurrently.
+    fn schedule_collective(&mut self, group_key: usize, group: &CollectiveGroup, members: &[usize], size: u64, tasks: &mut [Task], fusion: FusionOptions) {
+        let (device_time, link_time) = (&self.collective_device_time, &self.collective_link_time);
+        if let Some(bucket) = self.buckets.get_mut(&group_key) {
+            let end = bucket.start + nccl_time(bucket.size, &group.model);
+            let last_in_group = group.devices.iter().all(|&x| device_time[x] == end) && group.links.iter().all(|&x| link_time[x] == end);
+            if bucket.start >= self.time && bucket.size + size <= fusion.threshold && last_in_group {
+                bucket.size += size;
+                let (start, eft) = (bucket.start, bucket.start + nccl_time(bucket.size, &group.model));
+                // the earlier members get new entries in ongoing_tasks only if their eft moves, which supersedes the old ones (see drop_superseded)
+                let n_earlier = bucket.members.len();
+                bucket.members.extend_from_slice(members);
+                let bucket_members = core::mem::take(&mut bucket.members);
+                self.occupy_collective(group, start, eft, &bucket_members, if eft == end { n_earlier } else { 0 }, tasks);
+                self.buckets.get_mut(&group_key).unwrap().members = bucket_members;
+                return
+            }
+        }
+
+        let mut start = group.devices.iter().map(|&x| self.collective_device_time[x])
+            .chain(group.links.iter().map(|&x| self.collective_link_time[x]))
+            .fold(self.time, cmp::max);
+        if fusion.cycle > 0 {
+            start = cmp::max(start, round_up(self.time, fusion.cycle))
+        }
+        let eft = start + nccl_time(size, &group.model);
+        self.occupy_collective(group, start, eft, members, 0, tasks);
+        if fusion.threshold > 0 {
+            self.buckets.insert(group_key, Bucket { start, size, members: members.to_vec() });
+        }
+    }
+
+    /// the members before `scheduled` already have their entries in ongoing_tasks
+    fn occupy_collective(&mut self, group: &CollectiveGroup, start: u64, eft: u64, members: &[usize], scheduled: usize, tasks: &mut [Task]) {
+        for &device in group.devices.iter() {
+            self.collective_device_time[device] = eft
+        }
+        for &link in group.links.iter() {
+            self.collective_link_time[link] = eft
+        }
+        for (i, &task_id) in members.iter().enumerate() {
+            tasks[task_id].duration = eft - start;
+            tasks[task_id].eft = eft;
+            if i >= scheduled {
+                self.ongoing_tasks.push(OngoingTask { id: task_id, eft })
+            }
+        }
+    }
+
+    /// pop the entries of ongoing_tasks that are superseded by a later eft of the same task, so the top is the next task to finish
+    fn drop_superseded(&mut self, tasks: &[Task]) {
+        while let Some(x) = self.ongoing_tasks.peek() {
+            if x.eft == tasks[x.id].eft {
+                break
+            }
+            self.ongoing_tasks.pop();
+        }
+    }
+
+    /// the earliest time that a flow has less than one time unit of bytes left, which is when it finishes since the times are
+    /// rounded down like the FIFO model does. Flows without bandwidth never finish
+    fn next_drain_time(&self) -> Option<u64> {
+        self.flows.iter().filter(|flow| flow.rate > 0.).map(|flow| self.flow_time.saturating_add((flow.remaining / flow.rate).max(0.).floor() as u64)).min()
+    }
+
+    fn advance_flows(&mut self, time: u64) {
+        let elapsed = (time - self.flow_time) as f64;
+        for flow in self.flows.iter_mut() {
+            flow.remaining -= flow.rate * elapsed
+        }
+        self.flow_time = time;
+    }
+
+    /// max-min fair share by progressive filling: repeatedly find the link that gives the least share to its unassigned flows,
+    /// and fix the rates of these flows to the share.
+    fn share_bandwidth(&mut self, target: &Target) {
+        let mut capacity: Vec<_> = target.links.iter().map(|&x| x as f64).collect();
+        let mut assigned = vec![false; self.flows.len()];
+        let mut n_unassigned = vec![0usize; target.links.len()];
+        for flow in self.flows.iter() {
+            for &link in target.paths[flow.path].iter() {
+                n_unassigned[link] += 1
+            }
+        }
+
+        loop {
+            let bottleneck = (0..capacity.len()).filter(|&link| n_unassigned[link] > 0)
+                .map(|link| (capacity[link] / n_unassigned[link] as f64, link))
+                .fold(None, |min: Option<(f64, usize)>, x| match min { Some(min) if min.0 <= x.0 => Some(min), _ => Some(x) });
+            let (share, bottleneck) = match bottleneck {
+                Some(x) => x,
+                None => break
+            };
+
+            for (i, flow) in self.flows.iter_mut().enumerate() {
+                let path = &target.paths[flow.path];
+                if assigned[i] || !path.contains(&bottleneck) {
+                    continue
+                }
+                assigned[i] = true;
+                flow.rate = share;
+                for &link in path.iter() {
+                    capacity[link] -= share;
+                    n_unassigned[link] -= 1
+                }
+            }
+        }
+    }
+
+
+    fn checkpoint(&self, tasks: &[Task]) -> SimState {
+        let mut checkpoint = self.clone();
+        checkpoint.schedule = tasks.iter().map(|task| (task.eft, task.duration)).collect();
+        checkpoint
+    }
+}
+
+type TaskKey = (String, usize); // the name of the node that the task comes from, and the second element of `task_origins`
+type TensorBufKey = (String, usize, usize); // the name of the node, output index, gpu
+
+/// a recorded simulation with checkpoints. A simulation of a similar target (e.g. compiled with a strategy that differs in a few nodes)
+/// can resume from the latest checkpoint before the first event that involves a changed task, since the simulation is deterministic.
+/// Tasks are matched by the names of their nodes, and a task is considered changed if its signature (the content, successors and tensorbufs) differs.
+#[derive(Debug)]
+pub struct Timeline {
+    ndev: usize,
+    nlinks: usize,
+    keys: Vec<TaskKey>,
+    signatures: Vec<u64>,
+    involvement: Vec<usize>, // the first event that involves each task, i.e. scheduling it, finishing it or finishing one of its predecessors
+    indegrees: Vec<usize>,
+    initial_ready: Vec<usize>,
+    tensorbufs: Vec<TensorBufKey>,
+    initial_ref_counts: Vec<usize>,
+    options_signature: u64, // the memory options, persistent tensorbufs (which are allocated before any event) and link model
+    checkpoints: Vec<SimState> // ordered by event
+}
+
+impl Timeline {
+    /// the latest checkpoint that the simulation of `keys` and `signatures` can resume from, and the mapping from the task ids of this timeline to the new ones
+    fn find_checkpoint(&self, keys: &[TaskKey], signatures: &[u64], initial_ready: &[usize]) -> Option<(&SimState, Vec<Option<usize>>)> {
+        let key_dict: HashMap<_, _> = keys.iter().enumerate().map(|(i, x)| (x, i)).collect();
+        let mapping: Vec<_> = self.keys.iter().map(|key| key_dict.get(key).copied()).collect();
+
+        let mut first_change = core::usize::MAX;
+        for (old, new) in mapping.iter().enumerate() {
+            if new.map(|new| signatures[new] != self.signatures[old]).unwrap_or(true) {
+                first_change = cmp::min(first_change, self.involvement[old])
+            }
+        }
+
+        // the initial ready tasks are scheduled in order as the first events. Tasks that are added without predecessors are only found here.
+        // Before they are all scheduled, the ready list is simply the rest of them, so we only need the scheduled ones to be the same (see `restore`).
+        let n_same = self.initial_ready.iter().zip(initial_ready.iter()).take_while(|(&old, &new)| self.keys[old] == keys[new]).count();
+        if n_same < cmp::max(self.initial_ready.len(), initial_ready.len()) {
+            first_change = cmp::min(first_change, n_same)
+        }
+
+        let checkpoint = self.checkpoints.iter().rev().find(|x| x.event <= first_change)?;
+        if checkpoint.event == 0 {
+            return None
+        }
+        Some((checkpoint, mapping))
+    }
+}
+
+/// the simulator only borrows the target, so a compiled target can be evaluated many times (e.g. with different profilers or topologies)
+/// Tasks are connected with integer indexes: `succs`, `in_tensors` and `out_tensors` are CSR tables indexed by task id, and the latter two point into `tensorbufs`.
+#[derive(Debug)]
+pub struct SimpleSimulator<'a> {
+    target: &'a Target,
     max_memory: Box<[u64]>,
+    persistent_memory: Vec<u64>, // the part of max_memory that resides for the whole step
+    peak_live_memory: Vec<u64>, // the peak of the live bytes, which is the same as max_memory unless modeling fragmentation
+    memory_timeline: Vec<Vec<(u64, u64)>>, // (time, live bytes) of each device, only recorded with the "memory_timeline" option
     tasks: Vec<Task>,
-    task_dict: Vec<usize>, // the i-th element is the computation task of the i-th node
-    tensorbufs: BTreeMap::<TensorBuf, (u64, usize, bool)>, // TensorBuf -> (size, ref count, activated)
-    total_time: u64
+    task_dict: Vec<usize>, // the i-th element is the computation task of the i-th node in target.pb
+    task_origins: Vec<(usize, usize)>, // the node in target.pb that each task comes from, and 0 for the node itself or 1 + input index for the transfer of that input
+    succs: Csr, // tasks that wait for this task
+    in_tensors: Csr, // note: in_tensors might be less than the predecessors because of control dependencies
+    out_tensors: Csr,
+    tensorbufs: Vec<TensorBuf>,
+    total_time: u64,
+    resumed_event: Option<usize> // the event of the checkpoint that the last simulation resumed from
 }
 
-impl Simulator for SimpleSimulator {
-    fn new(target: &Target) -> Self {
+impl<'a> Simulator<'a> for SimpleSimulator<'a> {
+    fn new(target: &'a Target) -> Self {
         Self {
+            target,
             max_memory: vec![0; target.ndev()].into_boxed_slice(),
-            ..Default::default()
+            persistent_memory: vec![0; target.ndev()],
+            peak_live_memory: vec![0; target.ndev()],
+            memory_timeline: vec![],
+            tasks: vec![],
+            task_dict: vec![],
+            task_origins: vec![],
+            succs: Csr::default(),
+            in_tensors: Csr::default(),
+            out_tensors: Csr::default(),
+            tensorbufs: vec![],
+            total_time: 0,
+            resumed_event: None
         }
     }
 
-    fn simulate(&mut self, profiler: &impl Profiler, mut target: Target) {
-        task!("evaluating graph of {} nodes...", target.pb.node.len());
+    fn simulate(&mut self, profiler: &impl Profiler) {
+        self.run(profiler, None, false);
+    }
 
-        target.pb.node = sort_nodes(core::mem::take(&mut target.pb.node).into_vec()).into();
-        self.target = target;
-        let target = &self.target;
-        let nodes = &target.pb.node;
+    fn get_total_time(&self) -> u64 {
+        self.total_time
+    }
 
-        let node_dict: HashMap<_, _> = nodes.iter().enumerate().map(|(i, x)| (&x.name[..], i)).collect();
-        let device_dict: BTreeMap<_, _> = target.devices.iter().enumerate().map(|(i, x)| (&x[..], i)).collect();
-        let collective_groups = analyze_collective_groups(&nodes, &device_dict, &target.nccls);
+    fn get_peak_memories(&self) -> &[u64] {
+        &self.max_memory[..]
+    }
 
-        // build tasks
-        let tasks = &mut self.tasks;
-        let task_dict = &mut self.task_dict;
-        let tensorbufs = &mut self.tensorbufs;
-        for (i, node) in nodes.iter().enumerate() {
-            let mut in_tensors = vec![];
-            let wait_for: Vec<_> = node.input.iter().enumerate().map(|(input_index_of_this_node, input)| {
-                if input.starts_with('^') {
-                    return task_dict[node_dict[&input[1..]]]
+    fn write_chrome<W: std::io::Write>(&self, output: &mut W) {
+        let options = ChromeOptions::from_target(self.target);
+        let nodes = &self.target.pb.node;
+        let mut first = true;
+        let mut emit = |event: serde_json::Value| {
+            output.write_all(if first { b"[\n" } else { b",\n" }).expect("fail to write log");
+            serde_json::to_writer(&mut *output, &event).expect("fail to write log");
+            first = false;
+        };
+
+        emit(json!({ "name": "process_name", "ph": "M", "pid": 0, "args": { "name": "devices" } }));
+        emit(json!({ "name": "process_name", "ph": "M", "pid": 1, "args": { "name": "links" } }));
+        for (gpu, device) in self.target.devices.iter().enumerate().filter(|(gpu, _)| options.keep_device(*gpu)) {
+            emit(json!({ "name": "thread_name", "ph": "M", "pid": 0, "tid": gpu, "args": { "name": device } }));
+        }
+
+        for (gpu, records) in self.memory_timeline.iter().enumerate().filter(|(gpu, _)| options.keep_device(*gpu)) {
+            let name = format!("memory {}", self.target.devices[gpu]);
+            for &(time, bytes) in records.iter().filter(|(time, _)| *time >= options.start && *time <= options.end) {
+                emit(json!({ "name": name, "ph": "C", "ts": time, "pid": 0, "args": { "bytes": bytes } }))
+            }
+        }
+
+        let mut link_transfers: Vec<Vec<(u64, u64, u64)>> = vec![vec![]; self.target.links.len()]; // (start, end, size), only used when aggregating
+        for (id, task) in self.tasks.iter().enumerate() {
+            let (start, end) = (task.eft - task.duration, task.eft);
+            if !options.keep_span(start, end) {
+                continue
+            }
+
+            let (node_id, tag) = self.task_origins[id];
+            match task.content {
+                TaskType::Computation { gpu, .. } => if options.keep_device(gpu) {
+                    emit(json!({ "name": nodes[node_id].name, "cat": "computation", "ph": "X", "ts": start, "dur": task.duration, "pid": 0, "tid": gpu }))
                 }
+                TaskType::Collective { instance_key, .. } => {
+                    let gpu = self.tensorbufs[self.in_tensors.row(id)[0]].gpu;
+                    if options.keep_device(gpu) {
+                        emit(json!({ "name": nodes[node_id].name, "cat": "collective", "ph": "X", "ts": start, "dur": task.duration, "pid": 0, "tid": gpu, "args": { "instance_key": instance_key } }))
+                    }
+                }
+                TaskType::Transfer { size, from, to } => if options.keep_device(from) || options.keep_device(to) {
+                    for &link in self.target.paths[from * self.target.ndev() + to].iter() {
+                        if !options.aggregate_links {
+                            let name = format!("{}->{}", nodes[node_id].input[tag - 1], nodes[node_id].name);
+                            emit(json!({ "name": name, "cat": "transfer", "ph": "X", "ts": start, "dur": task.duration, "pid": 1, "tid": link, "args": { "size": size, "from": from, "to": to } }));
+                            continue
+                        }
 
-                let (name, index) = parse_input(&input);
-                let input_id = node_dict[name];
-                let from = device_dict[&nodes[input_id].device[..]];
-                let to = device_dict[&node.device[..]];
-                let size = node.attr.get("_tge_input_sizes").and_then(|x| x.get_list().i.get(input_index_of_this_node)).copied().unwrap_or(0) as _;
+                        link_transfers[link].push((start, end, size))
+                    }
+                }
+            }
+        }
+
+        for (link, transfers) in link_transfers.iter_mut().enumerate() {
+            transfers.sort_unstable();
+            let mut spans: Vec<(u64, u64, u64, u64)> = vec![]; // (start, end, count, bytes) of contiguous transfers
+            for &(start, end, size) in transfers.iter() {
+                match spans.last_mut() {
+                    Some(span) if span.1 >= start => {
+                        span.1 = cmp::max(span.1, end);
+                        span.2 += 1;
+                        span.3 += size
+                    }
+                    _ => spans.push((start, end, 1, size))
+                }
+            }
+            for (start, end, count, bytes) in spans {
+                emit(json!({ "name": format!("{} transfers", count), "cat": "transfer", "ph": "X", "ts": start, "dur": end - start, "pid": 1, "tid": link, "args": { "count": count, "bytes": bytes } }))
+            }
+        }
 
-                // info!("{}:{} {}->{} {}", name, index, from, to, size);
+        drop(emit);
+        output.write_all(b"\n]\n").expect("fail to write log")
+    }
 
-                tensorbufs.entry((input_id, index, from)).and_modify(|x| x.1 += 1).or_insert((size, 1, false));
-                tasks[task_dict[input_id]].out_tensors.push((input_id, index, from));
+    fn dump_records<W: std::io::Write>(&self, output: &mut W) {
+        let (op_makespan, op_idle_after) = self.op_records();
+        let device_busy_time = self.device_busy_time();
+        let device_total_utilization: Vec<_> = device_busy_time.iter().map(|&x| x as f64 / self.total_time as f64).collect();
 
-                tensorbufs.entry((input_id, index, to)).and_modify(|x| x.1 += 1).or_insert((size, 1, false));
-                in_tensors.push((input_id, index, to));
+        let device_peak_memory = self.max_memory.clone();
+        let analysis = self.critical_path();
+        let critical_path: Vec<_> = analysis.path.iter().map(|&id| {
+            let (node, tag) = self.task_origins[id];
+            match tag {
+                0 => self.target.pb.node[node].name.clone(),
+                _ => format!("{}->{}", self.target.pb.node[node].input[tag - 1], self.target.pb.node[node].name)
+            }
+        }).collect();
+        let device_fragmentation: Vec<_> = self.max_memory.iter().zip(self.peak_live_memory.iter()).map(|(x, y)| x - y).collect();
 
-                // note for memory calculation when from == to: we ignore activation of tensorbuf when it is already activated, and count ref for every transfer, so the calculation is correct.
-                Task::create(tasks, TaskType::Transfer {
-                    size, path: target.paths[from * target.devices.len() + to].clone()
-                }, &[task_dict[input_id]], vec![(input_id, index, from)], vec![(input_id, index, to)])
-            }).collect();
+        serde_json::to_writer(output, &json!({
+            "op_makespan": op_makespan,
+            "op_idle_after": op_idle_after,
 
-            let id = if node.op == "CollectiveReduce" {
-                let instance_key = node.attr["instance_key"].get_i() as _;
-                let group_key = node.attr["group_key"].get_i() as _;
-                let size = node.attr.get("_tge_input_sizes").and_then(|x| x.get_list().i.get(0)).copied().unwrap_or(0) as _;
-                Task::create(tasks, TaskType::Collective { instance_key, group_key, size }, &wait_for, in_tensors, vec![])
-            } else {
-                Task::create(tasks, TaskType::Computation { id: i, gpu: device_dict[&node.device[..]] }, &wait_for, in_tensors, vec![])
-            };
-            task_dict.push(id);
+            "device_busy_time": device_busy_time,
+            "device_total_utilization": device_total_utilization,
+            "device_peak_memory": device_peak_memory,
+            "device_persistent_memory": self.persistent_memory,
+            "device_fragmentation": device_fragmentation,
+            "device_memory_timeline": self.memory_timeline,
+
+            "op_slack": analysis.op_slack,
+            "op_critical_time": analysis.op_critical_time,
+            "device_critical_time": analysis.device_critical_time,
+            "link_critical_time": analysis.link_critical_time,
+            "critical_path": critical_path,
+        })).expect("fail to write log");
+    }
+}
+
+impl<'a> SimpleSimulator<'a> {
+    /// simulate and record a timeline that simulations of similar targets can resume from
+    pub fn simulate_and_record(&mut self, profiler: &impl Profiler) -> Timeline {
+        self.run(profiler, None, true).expect("bug: no timeline recorded")
+    }
+
+    /// simulate by resuming from a timeline recorded on a similar target. The result is the same as `simulate`.
+    pub fn simulate_from(&mut self, profiler: &impl Profiler, timeline: &Timeline) {
+        self.run(profiler, Some(timeline), false);
+    }
+
+    /// the event that the last `simulate_from` resumed from, or None if the timeline does not fit and it simulated from the start
+    pub fn resumed_event(&self) -> Option<usize> {
+        self.resumed_event
+    }
+
+    fn run(&mut self, profiler: &impl Profiler, resume: Option<&Timeline>, record: bool) -> Option<Timeline> {
+        let target = self.target;
+        let nodes = &target.pb.node;
+        task!("evaluating graph of {} nodes...", nodes.len());
+
+        let fusion = FusionOptions::from_target(target);
+        let initial_ref_counts = self.build_tasks(fusion.threshold > 0);
+        let memory = MemoryOptions::from_target(target);
+        let persistent = self.persistent_tensorbufs(memory);
+        let fair_share = target.options.get("link_model").map(|x| x == "fair_share").unwrap_or(false); // otherwise each link is held by a single transfer at a time
+        let device_dict: BTreeMap<_, _> = target.devices.iter().enumerate().map(|(i, x)| (&x[..], i)).collect();
+        let collective_groups = analyze_collective_groups(&nodes, &device_dict, target);
+
+        let mut indegrees = vec![0; self.tasks.len()];
+        for &succ in self.succs.values.iter() {
+            indegrees[succ] += 1
         }
 
-        let mut time = 0;
-        let mut ongoing_tasks = BinaryHeap::new();
-        let mut ready_list: VecDeque<_> = tasks.iter().enumerate().filter(|(_, task)| task.wait_for.is_empty()).map(|(i, _)| i).collect();
-        let mut gpu_available_time = vec![0; target.ndev()];
-        let mut link_available_time = vec![0; target.links.len()];
-        let mut current_memory = vec![0; target.ndev()];
-        let mut collective_state: BTreeMap<usize, Vec<usize>> = BTreeMap::new(); // instance_key => [ready task_id]
-        let mut collective_available_time = 0;
+        let mut state = SimState {
+            event: 0,
+            time: 0,
+            ready_list: (0..self.tasks.len()).filter(|&i| indegrees[i] == 0).collect(),
+            ongoing_tasks: BinaryHeap::new(),
+            n_waiting: indegrees.clone(),
+            ref_counts: initial_ref_counts.clone(),
+            activated: vec![false; self.tensorbufs.len()],
+            gpu_available_time: vec![0; target.ndev()],
+            link_available_time: vec![0; target.links.len()],
+            current_memory: vec![0; target.ndev()],
+            max_memory: vec![0; target.ndev()],
+            allocators: vec![Allocator::default(); target.ndev()],
+            offsets: vec![0; self.tensorbufs.len()],
+            collective_state: BTreeMap::new(),
+            collective_device_time: vec![0; target.ndev()],
+            collective_link_time: vec![0; target.links.len()],
+            buckets: BTreeMap::new(),
+            flows: vec![],
+            flow_time: 0,
+            schedule: vec![]
+        };
+
+        // persistent tensorbufs are allocated in the order of their names, so the layout does not depend on the positions of the tasks
+        let mut persistent_bufs: Vec<_> = (0..self.tensorbufs.len()).filter(|&buf| persistent[buf]).collect();
+        persistent_bufs.sort_unstable_by_key(|&buf| { let TensorBuf { node, index, gpu, .. } = self.tensorbufs[buf]; (&nodes[node].name, index, gpu) });
+        for &buf in persistent_bufs.iter() {
+            let TensorBuf { gpu, size, .. } = &self.tensorbufs[buf];
+            state.activated[buf] = true;
+            state.current_memory[*gpu] += size;
+            state.max_memory[*gpu] = state.current_memory[*gpu];
+            if memory.fragmentation {
+                state.offsets[buf] = state.allocators[*gpu].alloc(*size)
+            }
+        }
+        self.persistent_memory = state.current_memory.clone();
+        self.memory_timeline = if memory.timeline { state.current_memory.iter().map(|&x| vec![(0, x)]).collect() } else { vec![] };
+
+        let (keys, signatures, options_signature) = if record || resume.is_some() {
+            let keys = self.task_keys();
+            let signatures = self.signatures(&keys, profiler, &collective_groups, &initial_ref_counts);
+            let mut hasher = DefaultHasher::new();
+            (memory, fair_share, fusion, target.options.get("collective_model")).hash(&mut hasher);
+            for &buf in persistent_bufs.iter() {
+                let TensorBuf { node, index, gpu, size } = &self.tensorbufs[buf];
+                (&nodes[*node].name, index, gpu, size).hash(&mut hasher)
+            }
+            (keys, signatures, hasher.finish())
+        } else {
+            (vec![], vec![], 0)
+        };
+        let initial_ready: Vec<_> = state.ready_list.iter().copied().collect();
 
+        self.resumed_event = None;
+        if let Some(timeline) = resume.filter(|x| x.ndev == target.ndev() && x.nlinks == target.links.len() && x.options_signature == options_signature && !memory.timeline) {
+            if let Some((checkpoint, mapping)) = timeline.find_checkpoint(&keys, &signatures, &initial_ready) {
+                debug!("resuming from event {}", checkpoint.event);
+                self.resumed_event = Some(checkpoint.event);
+                self.restore(&mut state, timeline, checkpoint, &mapping, &indegrees, &initial_ready, &initial_ref_counts)
+            }
+        }
+
+        let interval = cmp::max(1, 2 * self.tasks.len() / TIMELINE_CHECKPOINTS); // each task is scheduled once and finished once
+        let mut involvement = if record { vec![core::usize::MAX; self.tasks.len()] } else { vec![] };
+        let mut checkpoints = vec![];
+
+        let tasks = &mut self.tasks;
+        let tensorbufs = &self.tensorbufs;
         loop {
             // schedule ready tasks. Note the scheduled task may or may not start immediately depending on the GPU/link queue. There may be other tasks become ready before some tasks schedualed earlier actually start.
-            while let Some(task_id) = ready_list.pop_front() {
-                let task = &mut tasks[task_id];
-                match &task.content {
+            while let Some(&task_id) = state.ready_list.front() {
+                if record {
+                    if state.event % interval == 0 {
+                        checkpoints.push(state.checkpoint(tasks))
+                    }
+                    involvement[task_id] = cmp::min(involvement[task_id], state.event);
+                }
+                state.ready_list.pop_front();
+                state.event += 1;
+
+                match tasks[task_id].content {
                     TaskType::Computation { id: node_id, gpu } => {
-                        debug!("{:?} {:?} {:?} {:?} {:?}", gpu, gpu_available_time[*gpu], time, nodes[*node_id].name, profiler.profile(&nodes[*node_id], *gpu).unwrap_or(0));
-                        task.duration = profiler.profile(&nodes[*node_id], *gpu).unwrap_or(0);
-                        task.eft = cmp::max(gpu_available_time[*gpu], time) + task.duration;
-                        gpu_available_time[*gpu] = task.eft;
-                        ongoing_tasks.push(OngoingTask { id: task_id, eft: task.eft });
+                        let task = &mut tasks[task_id];
+                        debug!("{:?} {:?} {:?} {:?} {:?}", gpu, state.gpu_available_time[gpu], state.time, nodes[node_id].name, profiler.profile(&nodes[node_id], gpu).unwrap_or(0));
+                        task.duration = profiler.profile(&nodes[node_id], gpu).unwrap_or(0);
+                        task.eft = cmp::max(state.gpu_available_time[gpu], state.time) + task.duration;
+                        state.gpu_available_time[gpu] = task.eft;
+                        state.ongoing_tasks.push(OngoingTask { id: task_id, eft: task.eft });
                     }
                     TaskType::Collective { instance_key, group_key, size } => {
-                        let ready_list = collective_state.entry(*instance_key).or_default();
+                        let ready_list = state.collective_state.entry(instance_key).or_default();
                         let group = &collective_groups[&group_key];
                         ready_list.push(task_id);
                         if ready_list.len() == group.devices.len() { // all ready
                             debug!("all ready {}", instance_key);
-                            // let barrier = group.devices.iter().map(|gpu| gpu_available_time[*gpu]).max().expect("bug");
-                            // let eft = barrier + nccl_time(size, &collective_groups[&group_key].model);
-                            // for gpu in group.devices.iter() {
-                            //     gpu_available_time[*gpu] = eft;
-                            // }
-                            let duration = nccl_time(*size, &collective_groups[&group_key].model);
-                            let eft = cmp::max(time, collective_available_time) + duration;
-                            collective_available_time = eft;
-                            for &mut task_id in ready_list {
-                                tasks[task_id].duration = duration;
-                                tasks[task_id].eft = eft;
-                                ongoing_tasks.push(OngoingTask { id: task_id, eft })
-                            }
+                            let members = ready_list.clone();
+                            state.schedule_collective(group_key, group, &members, size, tasks, fusion)
                         }
                     }
-                    TaskType::Transfer { size, path } => {
-                        let est = path.iter().fold(time, |max, link| cmp::max(max, link_available_time[*link]));
+                    TaskType::Transfer { size, from, to } if fair_share && !target.paths[from * target.ndev() + to].is_empty() => {
+                        // the eft is decided when the flow drains
+                        state.advance_flows(state.time);
+                        state.flows.push(Flow { task: task_id, path: from * target.ndev() + to, start: state.time, remaining: size as f64, rate: 0. });
+                        state.share_bandwidth(target);
+                    }
+                    TaskType::Transfer { size, from, to } => {
+                        let task = &mut tasks[task_id];
+                        let path = &target.paths[from * target.ndev() + to];
+                        let est = path.iter().fold(state.time, |max, link| cmp::max(max, state.link_available_time[*link]));
                         task.duration = if !path.is_empty() {
                             let bandwidth = path.iter().fold(core::u64::MAX, |min, link| cmp::min(min, target.links[*link]));
                             size / bandwidth + GRPC_LATENCY
@@ -208,55 +790,94 @@ impl Simulator for SimpleSimulator {
                         task.eft = est + task.duration;
 
                         for link in path.iter() {
-                            link_available_time[*link] = task.eft
+                            state.link_available_time[*link] = task.eft
                         }
-                        ongoing_tasks.push(OngoingTask { id: task_id, eft: task.eft });
+                        state.ongoing_tasks.push(OngoingTask { id: task_id, eft: task.eft });
                     }
                 }
             }
 
+            state.drop_superseded(tasks);
+            if record && !state.ongoing_tasks.is_empty() && state.event % interval == 0 {
+                checkpoints.push(state.checkpoint(tasks))
+            }
+
+            // finish the flows that drain before the next task finishes. The latency is paid after the data is sent.
+            while let Some(time) = state.next_drain_time() {
+                if state.ongoing_tasks.peek().map(|x| x.eft < time).unwrap_or(false) {
+                    break
+                }
+                state.advance_flows(time);
+                let (drained, flows) = core::mem::take(&mut state.flows).into_iter().partition(|flow| flow.remaining < flow.rate);
+                state.flows = flows;
+                for flow in drained {
+                    let task = &mut tasks[flow.task];
+                    task.eft = time + GRPC_LATENCY;
+                    task.duration = task.eft - flow.start;
+                    state.ongoing_tasks.push(OngoingTask { id: flow.task, eft: task.eft })
+                }
+                state.share_bandwidth(target);
+            }
+
             // move a time step forward
-            if let Some(OngoingTask { id, eft }) = ongoing_tasks.pop() {
-                // remove used tensorbufs
-                for in_tensor in &tasks[id].in_tensors {
-                    let tensor_buf = tensorbufs.get_mut(in_tensor);
-                    if tensor_buf.is_none() {
-                        warn!("bug in memory tracking: use freed tensor {:?}", in_tensor);
-                        continue
+            if let Some(OngoingTask { id, eft }) = state.ongoing_tasks.pop() {
+                if record {
+                    involvement[id] = cmp::min(involvement[id], state.event);
+                    for &succ in self.succs.row(id) {
+                        involvement[succ] = cmp::min(involvement[succ], state.event)
                     }
-                    let (size, ref_count, _) = tensor_buf.unwrap();
-                    if *ref_count == 1 { // free
-                        current_memory[in_tensor.2] -= *size;
-                        debug!("memory of {}:{} {} {} -{} {}", nodes[in_tensor.0].name, in_tensor.1, in_tensor.2, time, *size, current_memory[in_tensor.2]);
-                        tensorbufs.remove(in_tensor);
-                    } else {
-                        *ref_count -= 1;
+                }
+                state.event += 1;
+
+                // remove used tensorbufs
+                for &buf in self.in_tensors.row(id) {
+                    let TensorBuf { node, index, gpu, size } = tensorbufs[buf];
+                    match state.ref_counts[buf] {
+                        0 => warn!("bug in memory tracking: use freed tensor {:?}", tensorbufs[buf]),
+                        1 => { // free
+                            state.ref_counts[buf] = 0;
+                            if persistent[buf] {
+                                continue
+                            }
+                            state.current_memory[gpu] -= size;
+                            debug!("memory of {}:{} {} {} -{} {}", nodes[node].name, index, gpu, state.time, size, state.current_memory[gpu]);
+                            if memory.fragmentation {
+                                state.allocators[gpu].free(state.offsets[buf], size)
+                            }
+                            if memory.timeline {
+                                push_memory_record(&mut self.memory_timeline[gpu], eft, state.current_memory[gpu])
+                            }
+                        }
+                        _ => state.ref_counts[buf] -= 1
                     }
                 }
 
                 // activate generated tensorbufs
-                for out_tensor in &tasks[id].out_tensors {
-                    let tensor_buf = tensorbufs.get_mut(out_tensor);
-                    if tensor_buf.is_none() {
-                        warn!("bug in memory tracking: use freed tensor {:?}", out_tensor);
+                for &buf in self.out_tensors.row(id) {
+                    let TensorBuf { node, index, gpu, size } = tensorbufs[buf];
+                    if state.ref_counts[buf] == 0 {
+                        warn!("bug in memory tracking: use freed tensor {:?}", tensorbufs[buf]);
                         continue
                     }
-                    let (size, _, activated) = tensorbufs.get_mut(out_tensor).expect("bug in memory tracking: use freed tensor");
-                    if !*activated { // it might already be activated since we allow transfer to the same device
-                        *activated = true;
-                        let gpu = out_tensor.2;
-                        current_memory[gpu] += *size;
-                        debug!("memory of {}:{} {} {} +{} {}", nodes[out_tensor.0].name, out_tensor.1, out_tensor.2, time, *size, current_memory[out_tensor.2]);
-                        self.max_memory[gpu] = cmp::max(current_memory[gpu], self.max_memory[gpu]);
+                    if !state.activated[buf] { // it might already be activated since we allow transfer to the same device
+                        state.activated[buf] = true;
+                        state.current_memory[gpu] += size;
+                        debug!("memory of {}:{} {} {} +{} {}", nodes[node].name, index, gpu, state.time, size, state.current_memory[gpu]);
+                        state.max_memory[gpu] = cmp::max(state.current_memory[gpu], state.max_memory[gpu]);
+                        if memory.fragmentation {
+                            state.offsets[buf] = state.allocators[gpu].alloc(size)
+                        }
+                        if memory.timeline {
+                            push_memory_record(&mut self.memory_timeline[gpu], eft, state.current_memory[gpu])
+                        }
                     }
                 }
 
-                time = eft;
-                for notify in &tasks[id].notify.clone() { // TODO: the cloning sucks
-                    let list = &mut tasks[*notify].wait_for;
-                    list.retain(|x| *x != id);
-                    if list.is_empty() {
-                        ready_list.push_back(*notify)
+                state.time = eft;
+                for &succ in self.succs.row(id) {
+                    state.n_waiting[succ] -= 1;
+                    if state.n_waiting[succ] == 0 {
+                        state.ready_list.push_back(succ)
                     }
                 }
             } else { // finally done
@@ -264,55 +885,239 @@ impl Simulator for SimpleSimulator {
             }
         }
 
-        self.total_time = time
+        self.total_time = state.time;
+        self.max_memory = if memory.fragmentation {
+            state.allocators.iter().map(|x| x.footprint).collect()
+        } else {
+            state.max_memory.clone().into_boxed_slice()
+        };
+        self.peak_live_memory = state.max_memory;
+
+        if !record {
+            return None
+        }
+
+        Some(Timeline {
+            ndev: target.ndev(),
+            nlinks: target.links.len(),
+            keys, signatures, involvement, indegrees, initial_ready,
+            tensorbufs: self.tensorbufs.iter().map(|x| (nodes[x.node].name.clone(), x.index, x.gpu)).collect(),
+            initial_ref_counts, options_signature,
+            checkpoints
+        })
     }
 
+    /// set the state and the tasks to a checkpoint of a timeline, where `mapping` maps the task ids of the timeline to the current ones.
+    /// Counters (waiting predecessors and references of tensorbufs) are restored as differences, since changed tasks that are not yet involved may have different initial values.
+    fn restore(&mut self, state: &mut SimState, timeline: &Timeline, checkpoint: &SimState, mapping: &[Option<usize>], indegrees: &[usize], initial_ready: &[usize], initial_ref_counts: &[usize]) {
+        let map = |old: usize| mapping[old].expect("bug: a removed task is involved before the checkpoint");
 
-    fn get_total_time(&self) -> u64 {
-        self.total_time
+        for (old, new) in mapping.iter().enumerate() {
+            if let Some(new) = *new {
+                state.n_waiting[new] = indegrees[new] - (timeline.indegrees[old] - checkpoint.n_waiting[old]);
+                let (eft, duration) = checkpoint.schedule[old];
+                self.tasks[new].eft = eft;
+                self.tasks[new].duration = duration;
+            }
+        }
+
+        let tensorbuf_dict: HashMap<_, _> = timeline.tensorbufs.iter().enumerate().map(|(i, (name, index, gpu))| ((&name[..], *index, *gpu), i)).collect();
+        for (new, buf) in self.tensorbufs.iter().enumerate() {
+            if let Some(&old) = tensorbuf_dict.get(&(&self.target.pb.node[buf.node].name[..], buf.index, buf.gpu)) {
+                state.ref_counts[new] = initial_ref_counts[new] - (timeline.initial_ref_counts[old] - checkpoint.ref_counts[old]);
+                state.activated[new] = checkpoint.activated[old];
+                state.offsets[new] = checkpoint.offsets[old];
+            }
+        }
+
+        state.event = checkpoint.event;
+        state.time = checkpoint.time;
+        state.ready_list = if checkpoint.event <= timeline.initial_ready.len() { // still scheduling the initial ready tasks
+            initial_ready[checkpoint.event..].iter().copied().collect()
+        } else {
+            checkpoint.ready_list.iter().map(|&x| map(x)).collect()
+        };
+        // keep the layout of the heap so ties are broken in the same way
+        state.ongoing_tasks = BinaryHeap::from(checkpoint.ongoing_tasks.clone().into_vec().into_iter().map(|x| OngoingTask { id: map(x.id), eft: x.eft }).collect::<Vec<_>>());
+        state.gpu_available_time = checkpoint.gpu_available_time.clone();
+        state.link_available_time = checkpoint.link_available_time.clone();
+        state.current_memory = checkpoint.current_memory.clone();
+        state.max_memory = checkpoint.max_memory.clone();
+        state.allocators = checkpoint.allocators.clone();
+        state.collective_state = checkpoint.collective_state.iter().map(|(&k, v)| (k, v.iter().map(|&x| map(x)).collect())).collect();
+        state.collective_device_time = checkpoint.collective_device_time.clone();
+        state.collective_link_time = checkpoint.collective_link_time.clone();
+        state.buckets = checkpoint.buckets.iter().map(|(&k, bucket)| (k, Bucket { members: bucket.members.iter().map(|&x| map(x)).collect(), ..bucket.clone() })).collect();
+        state.flows = checkpoint.flows.iter().map(|flow| Flow { task: map(flow.task), ..flow.clone() }).collect();
+        state.flow_time = checkpoint.flow_time;
     }
 
-    fn get_peak_memories(&self) -> &[u64] {
-        &self.max_memory[..]
+    fn task_keys(&self) -> Vec<TaskKey> {
+        self.task_origins.iter().map(|&(node, tag)| (self.target.pb.node[node].name.clone(), tag)).collect()
     }
 
-    fn write_chrome<W: std::io::Write>(&self, output: &mut W) {
-        write!(output, "[").unwrap();
+    /// hash everything that affects the events involving a task
+    fn signatures(&self, keys: &[TaskKey], profiler: &impl Profiler, collective_groups: &BTreeMap<usize, CollectiveGroup>, ref_counts: &[usize]) -> Vec<u64> {
+        let target = self.target;
+        let nodes = &target.pb.node;
+        let hash_tensorbufs = |bufs: &[usize], hasher: &mut DefaultHasher| {
+            bufs.len().hash(hasher);
+            for &buf in bufs {
+                let TensorBuf { node, index, gpu, size } = self.tensorbufs[buf];
+                (&nodes[node].name, index, gpu, size, ref_counts[buf]).hash(hasher)
+            }
+        };
 
-        for (id, task) in self.tasks.iter().enumerate() {
-            match &task.content {
-                TaskType::Computation { id: node_id, gpu } => {
-                    if task.duration != 0 {
-                        writeln!(output, "{{ \"name\": \"computation_{}\", \"cat\": \"computation\", \"ph\": \"B\", \"ts\": {}, \"pid\": 0, \"tid\": {} }},", node_id, task.eft - task.duration, gpu).expect("fail to write log");
-                        writeln!(output, "{{ \"name\": \"computation_{}\", \"cat\": \"computation\", \"ph\": \"E\", \"ts\": {}, \"pid\": 0, \"tid\": {} }},", node_id, task.eft, gpu).expect("fail to write log");
+        (0..self.tasks.len()).map(|i| {
+            let mut hasher = DefaultHasher::new();
+            match self.tasks[i].content {
+                TaskType::Computation { id, gpu } => (0u8, gpu, profiler.profile(&nodes[id], gpu)).hash(&mut hasher),
+                TaskType::Transfer { size, from, to } => {
+                    let path = &target.paths[from * target.ndev() + to];
+                    (1u8, size, path).hash(&mut hasher);
+                    for &link in path.iter() {
+                        target.links[link].hash(&mut hasher)
                     }
                 }
-                TaskType::Collective { instance_key, .. } => {
-                    let gpu = task.in_tensors[0].2; // hack
-                    if task.duration != 0 {
-                        writeln!(output, "{{ \"name\": \"collective_{}\", \"cat\": \"collective\", \"ph\": \"B\", \"ts\": {}, \"pid\": 0, \"tid\": {} }},", instance_key, task.eft - task.duration, gpu).expect("fail to write log");
-                        writeln!(output, "{{ \"name\": \"collective_{}\", \"cat\": \"collective\", \"ph\": \"E\", \"ts\": {}, \"pid\": 0, \"tid\": {} }},", instance_key, task.eft, gpu).expect("fail to write log");
+                TaskType::Collective { instance_key, group_key, size } => {
+                    let group = &collective_groups[&group_key];
+                    (2u8, instance_key, group_key, size, &group.devices, &group.links).hash(&mut hasher);
+                    for x in group.model.iter() {
+                        x.to_bits().hash(&mut hasher)
                     }
                 }
-                TaskType::Transfer { path, .. } => if !path.is_empty() {
-                    for link in path.iter() {
-                        writeln!(output, "{{ \"name\": \"transfer_{}\", \"cat\": \"transfer\", \"ph\": \"B\", \"ts\": {}, \"pid\": 1, \"tid\": {} }},", id, task.eft - task.duration, link).expect("fail to write log");
-                        writeln!(output, "{{ \"name\": \"transfer_{}\", \"cat\": \"transfer\", \"ph\": \"E\", \"ts\": {}, \"pid\": 1, \"tid\": {} }},", id, task.eft, link).expect("fail to write log");
-                    }
+            }
+            let succs = self.succs.row(i);
+            succs.len().hash(&mut hasher);
+            for &succ in succs {
+                keys[succ].hash(&mut hasher)
+            }
+            hash_tensorbufs(self.in_tensors.row(i), &mut hasher);
+            hash_tensorbufs(self.out_tensors.row(i), &mut hasher);
+            hasher.finish()
+        }).collect()
+    }
+
+    /// write the records into arrays instead of a json. `op_index` maps the names in the original graph to the indexes of the op arrays.
+    /// Ops that have no records (e.g. removed as dangling) are left untouched.
+    pub fn write_feedback(&self, op_index: &HashMap<&str, usize>, feedback: Feedback) {
+        let (makespans, idle_times) = self.op_records();
+        let analysis = self.critical_path();
+        for (records, output) in [(makespans, feedback.op_makespan), (idle_times, feedback.op_idle_after), (analysis.op_slack, feedback.op_slack), (analysis.op_critical_time, feedback.op_critical_time)] {
+            for (name, x) in records {
+                if let Some(&i) = op_index.get(name) {
+                    output[i] = x
                 }
             }
         }
+        feedback.device_busy_time.copy_from_slice(&self.device_busy_time());
+        feedback.device_critical_time.copy_from_slice(&analysis.device_critical_time);
+        feedback.link_critical_time.copy_from_slice(&analysis.link_critical_time);
     }
 
-    fn dump_records<W: std::io::Write>(&self, output: &mut W) {
-        /*****
-        * op *
-        *****/
+    /// find the critical path and the slack of each task in the simulated schedule. A task depends on its predecessors in the graph,
+    /// and on the previous task that occupies the same device, collective stream or link, so the slack is how much a task can be delayed
+    /// without delaying the step if the order on each device and link is kept.
+    fn critical_path(&self) -> CriticalPath<'_> {
+        let (target, tasks, nodes) = (self.target, &self.tasks, &self.target.pb.node);
+        let (ndev, ntasks) = (target.ndev(), tasks.len());
+        let start = |id: usize| tasks[id].eft - tasks[id].duration;
+
+        // resources are the devices, then the collective streams of the devices, then the links
+        let mut occupations = vec![]; // (resource, task)
+        for (id, task) in tasks.iter().enumerate() {
+            match task.content {
+                TaskType::Computation { gpu, .. } => occupations.push((gpu, id)),
+                TaskType::Collective { .. } => occupations.push((ndev + self.tensorbufs[self.in_tensors.row(id)[0]].gpu, id)),
+                TaskType::Transfer { from, to, .. } => occupations.extend(target.paths[from * ndev + to].iter().map(|&link| (2 * ndev + link, id)))
+            }
+        }
+        let resources = Csr::new(2 * ndev + target.links.len(), &occupations);
+
+        let mut edges: Vec<_> = (0..ntasks).flat_map(|id| self.succs.row(id).iter().map(move |&succ| (id, succ))).collect();
+
+        // the tasks of an all-reduce instance start together, so each of them also waits for the predecessors of the others
+        let graph_preds = Csr::new(ntasks, &edges.iter().map(|&(from, to)| (to, from)).collect::<Vec<_>>());
+        let mut instances: BTreeMap<usize, Vec<usize>> = BTreeMap::new();
+        for (id, task) in tasks.iter().enumerate() {
+            if let TaskType::Collective { instance_key, .. } = task.content {
+                instances.entry(instance_key).or_default().push(id)
+            }
+        }
+        for members in instances.values() {
+            for &member in members {
+                for &other in members.iter().filter(|&&x| x != member) {
+                    edges.extend(graph_preds.row(other).iter().map(|&pred| (pred, member)))
+                }
+            }
+        }
+
+        // task ids are in topological order, so they break ties of tasks that take no time consistently with the graph
+        for resource in 0..resources.offsets.len() - 1 {
+            let mut occupants = resources.row(resource).to_vec();
+            occupants.sort_unstable_by_key(|&id| (start(id), tasks[id].eft, id));
+            // overlapping tasks (fused all-reduces or flows sharing a link) do not wait for each other
+            edges.extend(occupants.windows(2).filter(|x| start(x[1]) >= tasks[x[0]].eft).map(|x| (x[0], x[1])));
+        }
+        let succs = Csr::new(ntasks, &edges);
+        let preds = Csr::new(ntasks, &edges.iter().map(|&(from, to)| (to, from)).collect::<Vec<_>>());
+
+        // latest finish times in reversed topological order
+        let mut n_waiting: Vec<_> = (0..ntasks).map(|id| succs.row(id).len()).collect();
+        let mut queue: Vec<_> = (0..ntasks).filter(|&id| n_waiting[id] == 0).collect();
+        let mut latest_finish = vec![self.total_time; ntasks];
+        while let Some(id) = queue.pop() {
+            for &succ in succs.row(id) {
+                latest_finish[id] = cmp::min(latest_finish[id], latest_finish[succ].saturating_sub(tasks[succ].duration))
+            }
+            for &pred in preds.row(id) {
+                n_waiting[pred] -= 1;
+                if n_waiting[pred] == 0 {
+                    queue.push(pred)
+                }
+            }
+        }
+        let slack: Vec<_> = (0..ntasks).map(|id| latest_finish[id].saturating_sub(tasks[id].eft)).collect();
+
+        // walk back from the last task through tight predecessors
+        let mut path = vec![];
+        let mut current = (0..ntasks).find(|&id| tasks[id].eft == self.total_time && slack[id] == 0);
+        while let Some(id) = current {
+            path.push(id);
+            current = preds.row(id).iter().copied().find(|&pred| slack[pred] == 0 && tasks[pred].eft == start(id));
+        }
+        path.reverse();
+
+        let mut analysis = CriticalPath { device_critical_time: vec![0; ndev], link_critical_time: vec![0; target.links.len()], ..Default::default() };
+        for (&task_id, node) in self.task_dict.iter().zip(nodes.iter()) {
+            if let Some(raw_node_name) = raw_node_name(node) {
+                let op_slack = analysis.op_slack.entry(raw_node_name).or_insert(core::u64::MAX);
+                *op_slack = cmp::min(*op_slack, slack[task_id])
+            }
+        }
+        for &id in path.iter() {
+            let duration = tasks[id].duration;
+            if let Some(raw_node_name) = raw_node_name(&nodes[self.task_origins[id].0]) {
+                *analysis.op_critical_time.entry(raw_node_name).or_default() += duration
+            }
+            match tasks[id].content {
+                TaskType::Computation { gpu, .. } => analysis.device_critical_time[gpu] += duration,
+                TaskType::Collective { .. } => analysis.device_critical_time[self.tensorbufs[self.in_tensors.row(id)[0]].gpu] += duration,
+                TaskType::Transfer { from, to, .. } => for &link in target.paths[from * ndev + to].iter() {
+                    analysis.link_critical_time[link] += duration
+                }
+            }
+        }
+        analysis.path = path;
+        analysis
+    }
+
+    /// the makespan and the idle time after each op, keyed by the name in the original graph
+    fn op_records(&self) -> (BTreeMap<&str, u64>, BTreeMap<&str, u64>) {
         let mut op_makespan: BTreeMap<&str, [u64; 2]> = BTreeMap::new();
         for (&task_id, node) in self.task_dict.iter().zip(self.target.pb.node.iter()) {
             let task = &self.tasks[task_id];
-            if let Some(raw_node_name) = node.attr.get("_tge_origin").or_else(|| node.attr.get("_tge_belong_to")) {
-                let raw_node_name = core::str::from_utf8(raw_node_name.get_s()).expect("_tge_origin or _tge_belong_to is not a name");
+            if let Some(raw_node_name) = raw_node_name(node) {
                 let makespan = op_makespan.entry(raw_node_name).or_insert([core::u64::MAX, core::u64::MIN]);
                 makespan[0] = cmp::min(makespan[0], task.eft - task.duration);
                 makespan[1] = cmp::max(makespan[1], task.eft);
@@ -322,77 +1127,143 @@ impl Simulator for SimpleSimulator {
         let mut op_idle_after: BTreeMap<&str, u64> = BTreeMap::new();
         for (&task_id, node) in self.task_dict.iter().zip(self.target.pb.node.iter()) {
             let task = &self.tasks[task_id];
-            if let Some(raw_node_name) = node.attr.get("_tge_origin").or_else(|| node.attr.get("_tge_belong_to")) {
-                let raw_node_name = core::str::from_utf8(raw_node_name.get_s()).expect("_tge_origin or _tge_belong_to is not a name");
+            if let Some(raw_node_name) = raw_node_name(node) {
                 let idle_time = op_idle_after.entry(raw_node_name).or_insert(core::u64::MAX);
-                if task.notify.is_empty() {
+                let succs = self.succs.row(task_id);
+                if succs.is_empty() {
                     *idle_time = 0;
                     continue
                 }
 
-                for &next_task_id in &task.notify {
+                for &next_task_id in succs {
                     let next_task = &self.tasks[next_task_id];
                     *idle_time = cmp::min(*idle_time, next_task.eft - next_task.duration - task.eft)
                 }
             }
         }
 
-        /*********
-        * device *
-        *********/
-        let mut device_busy_time = vec![0; self.target.ndev()]; // note that each device can only run a single node at a time, so the busy time is simply the sum of all computation nodes
+        (op_makespan.into_iter().map(|(k, [start, end])| (k, end - start)).collect(), op_idle_after)
+    }
+
+    /// note that each device can only run a single node at a time, so the busy time is simply the sum of all computation nodes
+    fn device_busy_time(&self) -> Vec<u64> {
+        let mut device_busy_time = vec![0; self.target.ndev()];
         for task in self.tasks.iter() {
             if let TaskType::Computation { gpu, .. } = &task.content {
                 device_busy_time[*gpu] += task.duration
             }
         }
+        device_busy_time
+    }
 
-        let device_total_utilization: Vec<_> = device_busy_time.iter().map(|x| x / self.total_time).collect();
+    /// the tensorbufs of variables on their own devices, which are allocated for the whole step when modeling persistent memory.
+    /// Optimizer states (e.g. the slots of ApplyAdam) are variables too, and editor places them along with the variables.
+    fn persistent_tensorbufs(&self, memory: MemoryOptions) -> Vec<bool> {
+        let nodes = &self.target.pb.node;
+        self.tensorbufs.iter().map(|buf| {
+            memory.persistent && match &nodes[buf.node].op[..] {
+                "VariableV2" | "Variable" | "VarHandleOp" => matches!(self.tasks[self.task_dict[buf.node]].content, TaskType::Computation { gpu, .. } if gpu == buf.gpu),
+                _ => false
+            }
+        }).collect()
+    }
 
-        let device_peak_memory = self.max_memory.clone();
+    /// build the task graph. Returns the initial reference count of each tensorbuf.
+    /// With `runtime_collective_order`, the control dependencies among collective nodes are dropped, since a fusing runtime like Horovod orders the all-reduces itself.
+    fn build_tasks(&mut self, runtime_collective_order: bool) -> Vec<usize> {
+        let target = self.target;
+        let nodes = &target.pb.node;
+        let node_edges = target.edges();
+        let device_dict: BTreeMap<_, _> = target.devices.iter().enumerate().map(|(i, x)| (&x[..], i)).collect();
 
-        serde_json::to_writer(output, &json!({
-            "op_makespan": op_makespan.iter().map(|(k, [start, end])| (k, end - start)).collect::<BTreeMap<_, _>>(),
-            "op_idle_after": op_idle_after,
+        let tasks = &mut self.tasks;
+        let task_dict = &mut self.task_dict;
+        let task_origins = &mut self.task_origins;
+        let tensorbufs = &mut self.tensorbufs;
+        let mut tensorbuf_dict: HashMap<(usize, usize, usize), usize> = HashMap::new(); // (node, index, gpu) -> tensorbuf id
+        let mut ref_counts = vec![];
+        let mut get_tensorbuf = |node, index, gpu, size| {
+            let id = *tensorbuf_dict.entry((node, index, gpu)).or_insert_with(|| {
+                tensorbufs.push(TensorBuf { node, index, gpu, size });
+                ref_counts.push(0);
+                tensorbufs.len() - 1
+            });
+            ref_counts[id] += 1;
+            id
+        };
 
-            "device_busy_time": device_busy_time,
-            "device_total_utilization": device_total_utilization,
-            "device_peak_memory": device_peak_memory,
-        })).expect("fail to write log");
-    }
-}
+        let mut edges = vec![]; // (from task, to task)
+        let mut in_tensors = vec![]; // (task, tensorbuf)
+        let mut out_tensors = vec![];
+        task_dict.resize(nodes.len(), 0);
+        for i in crate::graph::sort_nodes(nodes) {
+            let node = &nodes[i];
+            let mut wait_for = vec![];
+            let mut node_in_tensors = vec![];
+            for (input_index_of_this_node, input) in node_edges.inputs(i).iter().enumerate() {
+                let input_id = input.node;
+                let index = match input.index {
+                    Some(index) => index,
+                    None => {
+                        if !(runtime_collective_order && node.op == "CollectiveReduce" && nodes[input_id].op == "CollectiveReduce") {
+                            wait_for.push(task_dict[input_id])
+                        }
+                        continue
+                    }
+                };
 
-fn parse_input(x: &str) -> (&str, usize) {
-    match x.find(':') {
-        Some(i) => (&x[..i], x[i+1..].parse().unwrap()),
-        None => (x, 0)
-    }
-}
+                let from = device_dict[&nodes[input_id].device[..]];
+                let to = device_dict[&node.device[..]];
+                let size = node.attr.get("_tge_input_sizes").and_then(|x| x.get_list().i.get(input_index_of_this_node)).copied().unwrap_or(0) as _;
 
-fn sort_nodes(x: Vec<NodeDef>) -> Vec<NodeDef> {
-    let mut queue: std::collections::VecDeque<_> = x.into();
-    let mut visited = BTreeSet::new();
-    let mut result = vec![];
-    'outer: while let Some(node) = queue.pop_front() {
-        for input in node.input.iter() {
-            let input = if input.starts_with('^') {
-                &input[1..]
+                // note for memory calculation when from == to: we ignore activation of tensorbuf when it is already activated, and count ref for every transfer, so the calculation is correct.
+                let from_buf = get_tensorbuf(input_id, index, from, size);
+                out_tensors.push((task_dict[input_id], from_buf));
+                let to_buf = get_tensorbuf(input_id, index, to, size);
+
+                let id = tasks.len();
+                tasks.push(Task { content: TaskType::Transfer { size, from, to }, eft: 0, duration: 0 });
+                task_origins.push((i, input_index_of_this_node + 1));
+                edges.push((task_dict[input_id], id));
+                in_tensors.push((id, from_buf));
+                out_tensors.push((id, to_buf));
+                node_in_tensors.push(to_buf);
+                wait_for.push(id);
+            }
+
+            let content = if node.op == "CollectiveReduce" {
+                let instance_key = node.attr["instance_key"].get_i() as _;
+                let group_key = node.attr["group_key"].get_i() as _;
+                let size = node.attr.get("_tge_input_sizes").and_then(|x| x.get_list().i.get(0)).copied().unwrap_or(0) as _;
+                TaskType::Collective { instance_key, group_key, size }
             } else {
-                parse_input(input).0
+                TaskType::Computation { id: i, gpu: device_dict[&node.device[..]] }
             };
-            if !visited.contains(input) {
-                queue.push_back(node);
-                continue 'outer;
-            }
+
+            let id = tasks.len();
+            tasks.push(Task { content, eft: 0, duration: 0 });
+            task_origins.push((i, 0));
+            edges.extend(wait_for.into_iter().map(|x| (x, id)));
+            in_tensors.extend(node_in_tensors.into_iter().map(|x| (id, x)));
+            task_dict[i] = id;
         }
 
-        visited.insert(node.name.clone());
-        result.push(node);
+        self.succs = Csr::new(tasks.len(), &edges);
+        self.in_tensors = Csr::new(tasks.len(), &in_tensors);
+        self.out_tensors = Csr::new(tasks.len(), &out_tensors);
+        ref_counts
     }
-    result
 }
 
-fn analyze_collective_groups(nodes: &[NodeDef], device_dict: &BTreeMap<&str, usize>, nccl_models: &BTreeMap<String, [f64; 4]>) -> BTreeMap<usize, CollectiveGroup> {
+/// the name of the node in the original graph that a node comes from
+fn raw_node_name(node: &NodeDef) -> Option<&str> {
+    node.attr.get("_tge_origin").or_else(|| node.attr.get("_tge_belong_to"))
+        .map(|x| core::str::from_utf8(x.get_s()).expect("_tge_origin or _tge_belong_to is not a name"))
+}
+
+
+fn analyze_collective_groups(nodes: &[NodeDef], device_dict: &BTreeMap<&str, usize>, target: &Target) -> BTreeMap<usize, CollectiveGroup> {
+    let nccl_models = &target.nccls;
     let mut collective_groups: BTreeMap<usize, Vec<&str>> = BTreeMap::new();
     let mut representative_instance: BTreeMap<usize, usize> = BTreeMap::new(); // we use the first instance to represent the group
 
@@ -419,12 +1290,17 @@ fn analyze_collective_groups(nodes: &[NodeDef], device_dict: &BTreeMap<&str, usi
         group.push(&node.device);
     }
 
+    let links_model = target.options.get("collective_model").map(|x| x == "links").unwrap_or(false);
+
     collective_groups.iter_mut().map(|(&k, v)| {
         let devices = v.iter().map(|&x| device_dict[x]).collect::<Vec<_>>().apply(|x| x.sort_unstable());
+        let ring: Vec<_> = (0..devices.len()).flat_map(|i| target.paths[devices[i] * target.ndev() + devices[(i + 1) % devices.len()]].iter().copied()).collect();
 
         v.sort_unstable();
         let model = if let Some(x) = nccl_models.get(&v.join(",")) {
             *x
+        } else if links_model {
+            ring_model(target, devices.len(), &ring)
         } else {
             let mut set: Vec<_> = v.iter().map(|x| tasks[task_name(x)][0]).collect();
             set.sort_unstable();
@@ -437,7 +1313,11 @@ fn analyze_collective_groups(nodes: &[NodeDef], device_dict: &BTreeMap<&str, usi
             }
         };
 
-        (k, CollectiveGroup { devices, model })
+        let mut links = ring;
+        links.sort_unstable();
+        links.dedup();
+
+        (k, CollectiveGroup { devices, links, model })
     }).collect()
 }
 
@@ -445,6 +1325,15 @@ fn task_name(x: &str) -> &str {
     &x[..x.rfind('/').unwrap()]
 }
 
+/// the nccl model of a ring all-reduce among n devices, which sends 2(n-1)/n of the data through each hop of the ring. `ring` is the links of
+/// the hops, and a link used by k hops has 1/k of its bandwidth for each. "collective_model" = "links" uses it for the groups without profiling data.
+fn ring_model(target: &Target, n: usize, ring: &[usize]) -> [f64; 4] {
+    let bandwidth = ring.iter().map(|&link| target.links[link] as f64 / ring.iter().filter(|&&x| x == link).count() as f64).fold(f64::INFINITY, f64::min);
+    let per_kb = if bandwidth.is_finite() { 2. * (n - 1) as f64 / n as f64 * 1024. / bandwidth } else { 0. };
+    let latency = (2 * (n - 1)) as f64 * GRPC_LATENCY as f64;
+    [per_kb, latency, per_kb, latency]
+}
+
 fn nccl_time(x: u64, nccl_model: &[f64; 4]) -> u64 {
     let t1 = nccl_model[0] * (x >> 10) as f64 + nccl_model[1];
     let t2 = nccl_model[2] * (x >> 10) as f64 + nccl_model[3];
@@ -0,0 +1,847 @@
+// invariants of the passes and the simulator, checked on small synthetic graphs
+
+use oh_my_rust::*;
+use protobuf::Message;
+use crate::proto::{node_def::NodeDef, attr_value::{AttrValue, AttrValue_ListValue}, tensor_shape::{TensorShapeProto, TensorShapeProto_Dim}, types::DataType};
+use crate::misc::{Target, DataProfiler};
+use crate::graph::Graph;
+use crate::simulator::{Simulator, SimpleSimulator, Timeline};
+use std::collections::BTreeMap;
+
+fn node(name: &str, op: &str, inputs: &[&str], shapes: &[&[i64]]) -> NodeDef {
+    let mut node = NodeDef::new();
+    node.name = name.into();
+    node.op = op.into();
+    for input in inputs {
+        node.input.push(input.to_string())
+    }
+
+    let mut list = AttrValue_ListValue::new();
+    for dims in shapes {
+        let mut shape = TensorShapeProto::new();
+        for &d in dims.iter() {
+            let mut dim = TensorShapeProto_Dim::new();
+            dim.size = d;
+            shape.dim.push(dim)
+        }
+        list.shape.push(shape)
+    }
+    let mut attr = AttrValue::new();
+    attr.set_list(list);
+    node.attr.insert("_output_shapes".into(), attr);
+
+    let mut attr = AttrValue::new();
+    attr.set_field_type(DataType::DT_FLOAT);
+    node.attr.insert("T".into(), attr);
+    let mut attr = AttrValue::new();
+    attr.set_b(false);
+    node.attr.insert("transpose_a".into(), attr);
+    node
+}
+
+/// an mlp trained with GradientDescent. The backward nodes are under the "gradients" scope
+fn mlp(layers: usize, width: i64) -> Vec<NodeDef> {
+    let mut nodes = vec![node("x", "Placeholder", &[], &[&[-1, width]]), node("lr", "Const", &[], &[&[]])];
+    let mut activations = vec!["x".to_string()];
+    for l in 0..layers {
+        nodes.push(node(&format!("w{}", l), "VariableV2", &[], &[&[width, width]]));
+        nodes.push(node(&format!("mm{}", l), "MatMul", &[&activations[l], &format!("w{}", l)], &[&[-1, width]]));
+        nodes.push(node(&format!("relu{}", l), "Relu", &[&format!("mm{}", l)], &[&[-1, width]]));
+        activations.push(format!("relu{}", l))
+    }
+
+    let mut delta = activations[layers].clone();
+    let mut applies = vec![];
+    for l in (0..layers).rev() {
+        let mut grad_w = node(&format!("gradients/grad_w{}", l), "MatMul", &[&activations[l], &delta], &[&[width, width]]);
+        grad_w.attr.get_mut("transpose_a").unwrap().set_b(true);
+        nodes.push(grad_w);
+        nodes.push(node(&format!("gradients/grad_x{}", l), "MatMul", &[&delta, &format!("w{}", l)], &[&[-1, width]]));
+        nodes.push(node(&format!("apply{}", l), "ApplyGradientDescent", &[&format!("w{}", l), "lr", &format!("gradients/grad_w{}", l)], &[&[width, width]]));
+        applies.push(format!("^apply{}", l));
+        delta = format!("gradients/grad_x{}", l)
+    }
+    nodes.push(node("GradientDescent", "NoOp", &applies.iter().map(|x| &x[..]).collect::<Vec<_>>(), &[]));
+    nodes
+}
+
+/// two devices per task. Devices of the same task share a fast link, and all traffic between tasks goes through link 0
+fn target(ndev: usize) -> Target {
+    let devices = (0..ndev).map(|i| format!("/job:worker/replica:0/task:{}/device:GPU:{}", i / 2, i % 2)).collect();
+    let mut links = vec![1000];
+    let mut paths = vec![];
+    for i in 0..ndev {
+        for j in 0..ndev {
+            if i == j {
+                paths.push(vec![].into())
+            } else if i / 2 == j / 2 {
+                paths.push(vec![links.len()].into());
+                links.push(5000)
+            } else {
+                paths.push(vec![0].into())
+            }
+        }
+    }
+    Target::new(Default::default(), devices, links.into(), paths.into(), vec!["GradientDescent".to_string()].into(), BTreeMap::new())
+}
+
+/// arbitrary but deterministic times
+fn profiler(nodes: &[NodeDef], ndev: usize) -> DataProfiler {
+    let data = nodes.iter().enumerate().map(|(i, node)| {
+        let times = (1..=ndev).map(|nrep| (nrep, (0..ndev).map(|d| ((i * 37 + d * 11) % 50 + 10) as u64 * 8 / nrep as u64).collect())).collect();
+        (node.name.clone(), times)
+    }).collect();
+    DataProfiler::from_dict(data)
+}
+
+/// a strategy mixing data parallelism, PS and model parallelism depending on the seed
+fn strategy(nodes: &[NodeDef], ndev: usize, seed: usize) -> BTreeMap<String, (Vec<usize>, i8)> {
+    nodes.iter().enumerate().map(|(i, node)| {
+        let k = (i * 7 + seed * 13) % 5;
+        let s = match seed % 4 {
+            0 => ((0..ndev).collect(), 1),
+            1 => ((0..ndev).collect(), 2),
+            2 => ((0..ndev).collect(), -1 - (k % ndev) as i8),
+            _ => (if k < 2 { vec![k % ndev] } else { (0..ndev).collect() }, if k == 4 { 2 } else { 1 })
+        };
+        (node.name.clone(), s)
+    }).collect()
+}
+
+fn compile(mut graph: Box<Graph>, target: Target, strategy: &BTreeMap<String, (Vec<usize>, i8)>) -> Target {
+    compile_in(&mut graph, target, strategy)
+}
+
+/// like compile, but the graph is kept for editing again
+fn compile_in(graph: &mut Graph, mut target: Target, strategy: &BTreeMap<String, (Vec<usize>, i8)>) -> Target {
+    graph.options.insert("fill_batchsize".into(), "32".into());
+    graph.options.insert("replace_placeholder".into(), "32".into());
+    let strategy: Vec<_> = graph.nodes.iter().map(|node| strategy.get(&node.raw_node.name).cloned()).collect();
+    crate::editor::edit(graph, &mut target, &strategy);
+    graph.compile(&mut target);
+    crate::polishing::remove_dangling_nodes(&mut target);
+    target
+}
+
+fn simulate(target: &Target, profiler: &DataProfiler) -> (u64, Vec<u64>) {
+    let mut simulator = SimpleSimulator::new(target);
+    simulator.simulate(profiler);
+    (simulator.get_total_time(), simulator.get_peak_memories().to_vec())
+}
+
+#[test]
+fn resume_equals_fresh_simulation() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for options in &[&[][..], &["memory_persistent", "memory_fragmentation"][..]] {
+        let target = || target(ndev).apply(|t| for &x in options.iter() { t.options.insert(x.into(), "True".into()); });
+        let base = strategy(&nodes, ndev, 3);
+        let timeline = SimpleSimulator::new(&compile(Graph::new(&nodes), target(), &base)).simulate_and_record(&prof);
+        for (l, seed) in (0..5).flat_map(|l| (0..4).map(move |seed| (l, seed))) {
+            // change the strategy of one layer
+            let changed = [format!("mm{}", l), format!("relu{}", l), format!("gradients/grad_x{}", l)];
+            let variant = base.clone().apply(|s| for (name, x) in strategy(&nodes, ndev, seed).into_iter().filter(|(name, _)| changed.contains(name)) {
+                s.insert(name, x);
+            });
+            let t = compile(Graph::new(&nodes), target(), &variant);
+            let mut simulator = SimpleSimulator::new(&t);
+            simulator.simulate_from(&prof, &timeline);
+            assert_eq!(simulate(&t, &prof), (simulator.get_total_time(), simulator.get_peak_memories().to_vec()), "layer {} seed {} options {:?}", l, seed, options)
+        }
+    }
+}
+
+#[test]
+fn resume_with_renumbered_tensors() {
+    // swapping two replicas in the GraphDef swaps the numbers of their tensors, including the variables, but does not change the simulation
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let mut t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, 0));
+    t.options.insert("memory_persistent".into(), "True".into());
+    t.options.insert("memory_fragmentation".into(), "True".into());
+    let timeline = SimpleSimulator::new(&t).simulate_and_record(&prof);
+
+    let position = |name: &str| t.pb.node.iter().position(|node| node.name == name).unwrap();
+    let (a, b) = (position("mm0/replica_0"), position("mm0/replica_1"));
+    t.pb.node.swap(a, b);
+    let mut simulator = SimpleSimulator::new(&t);
+    simulator.simulate_from(&prof, &timeline);
+    assert!(simulator.resumed_event().is_some());
+    assert_eq!(simulate(&t, &prof), (simulator.get_total_time(), simulator.get_peak_memories().to_vec()))
+}
+
+#[test]
+fn hierarchical_leaders_in_device_order() {
+    // with more than 10 tasks, sorting the tasks by name would put task:10 before task:2
+    let (nodes, ndev) = (mlp(2, 16), 24);
+    let strategy = nodes.iter().map(|node| (node.name.clone(), ((0..ndev).collect(), 6))).collect();
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    let mut instances: BTreeMap<i64, Vec<usize>> = BTreeMap::new();
+    for node in t.pb.node.iter().filter(|node| node.name.contains("aux_hierarchical/collective")) {
+        instances.entry(node.attr["instance_key"].get_i()).or_default().push(t.devices.iter().position(|d| *d == node.device).unwrap())
+    }
+    assert!(!instances.is_empty());
+    for devices in instances.values() {
+        assert_eq!(devices.len(), ndev / 2);
+        assert!(devices.windows(2).all(|w| w[0] < w[1]), "{:?}", devices)
+    }
+}
+
+fn simulate_with(target: &Target, profiler: &DataProfiler, options: &[(&str, &str)]) -> (u64, Vec<u64>) {
+    let mut target = target.clone();
+    for &(name, value) in options {
+        target.options.insert(name.into(), value.into());
+    }
+    simulate(&target, profiler)
+}
+
+#[test]
+fn fair_share_without_contention_equals_fifo() {
+    // a chain that alternates between two tasks, so there is at most one transfer at a time
+    let mut nodes = vec![node("x", "Placeholder", &[], &[&[-1, 64]])];
+    for i in 0..6 {
+        let input = if i == 0 { "x".to_string() } else { format!("relu{}", i - 1) };
+        nodes.push(node(&format!("relu{}", i), "Relu", &[&input], &[&[-1, 64]]))
+    }
+    nodes.push(node("GradientDescent", "NoOp", &["^relu5"], &[]));
+    let ndev = 4;
+    let strategy = nodes.iter().enumerate().map(|(i, node)| (node.name.clone(), (vec![i % 2 * 2], 1))).collect();
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    let prof = profiler(&nodes, ndev);
+    assert_eq!(simulate(&t, &prof), simulate_with(&t, &prof, &[("link_model", "fair_share")]))
+}
+
+#[test]
+fn fuse_mini_batch_once_equals_no_fusion() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let fused = crate::polishing::fuse_mini_batch(&nodes, 1);
+    for seed in 0..4 {
+        // the replicas of the micro-batch take the strategy of their original nodes
+        let s = strategy(&nodes, ndev, seed);
+        let fused_strategy = fused.iter().map(|node| (node.name.clone(), s[crate::graph::origin_of(node)].clone())).collect();
+        let expected = simulate(&compile(Graph::new(&nodes), target(ndev), &s), &prof);
+        assert_eq!(simulate(&compile(Graph::new(&fused), target(ndev), &fused_strategy), &prof), expected, "seed {}", seed)
+    }
+}
+
+/// the node-indexed arrays of a strategy, like tge.strategy_arrays
+fn strategy_arrays(nodes: &[NodeDef], ndev: usize, strategy: &BTreeMap<String, (Vec<usize>, i8)>) -> (Vec<i8>, Vec<u8>) {
+    let (mut methods, mut placements) = (vec![0; nodes.len()], vec![0; nodes.len() * ndev]);
+    for (i, node) in nodes.iter().enumerate() {
+        if let Some((devices, method)) = strategy.get(&node.name) {
+            methods[i] = *method;
+            for &d in devices {
+                placements[i * ndev + d] += 1
+            }
+        }
+    }
+    (methods, placements)
+}
+
+#[test]
+fn edit_with_arrays_equals_edit_with_names() {
+    // reversed, so the node order of the graph differs from the GraphDef
+    let (nodes, ndev) = (mlp(3, 64).into_iter().rev().collect::<Vec<_>>(), 4);
+    for seed in 0..4 {
+        let s = strategy(&nodes, ndev, seed);
+        let expected = compile(Graph::new(&nodes), target(ndev), &s);
+
+        let (methods, placements) = strategy_arrays(&nodes, ndev, &s);
+        let mut graph = Graph::new(&nodes);
+        let mut t = target(ndev);
+        graph.options.insert("fill_batchsize".into(), "32".into());
+        graph.options.insert("replace_placeholder".into(), "32".into());
+        unsafe { crate::edit_graph_v2(&mut *graph, &mut t, methods.as_ptr(), placements.as_ptr(), ndev as _) };
+        graph.compile(&mut t);
+        crate::polishing::remove_dangling_nodes(&mut t);
+        assert!(t.pb == expected.pb, "seed {}", seed)
+    }
+}
+
+#[test]
+fn profiler_from_arrays_equals_profiler_from_dict() {
+    let (nodes, ndev) = (mlp(3, 64).into_iter().rev().collect::<Vec<_>>(), 4);
+    // only some replica numbers are profiled for some nodes, so the lookups fall back to the others
+    let nreps = [1u32, 2, 4];
+    let mut data = BTreeMap::new();
+    let mut times = vec![core::u64::MAX; nodes.len() * nreps.len() * ndev];
+    for (i, node) in nodes.iter().enumerate() {
+        let profiled: Vec<_> = (0..nreps.len()).filter(|j| (i + j) % 3 != 0).collect();
+        for &j in profiled.iter() {
+            let row: Vec<u64> = (0..ndev).map(|d| ((i * 37 + d * 11) % 50 + 10) as u64 * 8 / nreps[j] as u64).collect();
+            times[(i * nreps.len() + j) * ndev..(i * nreps.len() + j + 1) * ndev].copy_from_slice(&row);
+            data.entry(node.name.clone()).or_insert_with(Vec::new).push((nreps[j] as usize, row))
+        }
+    }
+    let from_dict = DataProfiler::from_dict(data);
+    let graph = Graph::new(&nodes);
+    let from_arrays = unsafe { Box::from_raw(crate::create_profiler_v2(&*graph, nreps.as_ptr(), nreps.len() as _, times.as_ptr(), ndev as _)) };
+    drop(graph);
+
+    for seed in 0..4 {
+        let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        assert_eq!(simulate(&t, &from_arrays), simulate(&t, &from_dict), "seed {}", seed)
+    }
+}
+
+#[test]
+fn shared_profiler_equals_a_profiler_per_evaluation() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let text: String = nodes.iter().enumerate().flat_map(|(i, node)| (1..=ndev).map(move |nrep| {
+        let times: Vec<_> = (0..ndev).map(|d| (((i * 37 + d * 11) % 50 + 10) * 8 / nrep).to_string()).collect();
+        format!("{} {} {}\n", node.name, nrep, times.join(" "))
+    })).collect();
+    let new_profiler = || unsafe { Box::from_raw(crate::create_profiler(text.as_ptr(), text.len() as _)) };
+    let shared = new_profiler();
+    let targets: Vec<_> = (0..4).map(|seed| compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed))).collect();
+    for _ in 0..2 {
+        for t in targets.iter() {
+            assert_eq!(simulate(t, &shared), simulate(t, &new_profiler()));
+            assert_eq!(simulate(t, &shared), simulate(t, &profiler(&nodes, ndev)))
+        }
+    }
+}
+
+#[test]
+fn compiled_target_evaluates_again_and_takes_new_topology() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let slow = || target(ndev).apply(|t| t.links = t.links.iter().map(|x| x / 4).collect());
+    let mut slower = false; // the all-reduces use the nccl model, but the transfers of some strategies take longer
+    for seed in 0..4 {
+        let mut t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let first = simulate(&t, &prof);
+        assert_eq!(simulate(&t, &prof), first);
+
+        let expected = simulate(&compile(Graph::new(&nodes), slow(), &strategy(&nodes, ndev, seed)), &prof);
+        let links: Vec<_> = slow().links.iter().map(|x| x.to_string()).collect();
+        let paths: Vec<_> = slow().paths.iter().map(|path| path.iter().map(|x| x.to_string()).collect::<Vec<_>>().join(" ")).collect();
+        let (links, paths) = (links.join(" "), paths.join("\n") + "\n");
+        slower |= expected.0 > first.0;
+        unsafe { crate::set_topology(&mut t, links.as_ptr(), links.len() as _, paths.as_ptr(), paths.len() as _) };
+        assert_eq!(simulate(&t, &prof), expected, "seed {}", seed)
+    }
+    assert!(slower)
+}
+
+/// a chain of Relu nodes ending with the GradientDescent sink
+fn chain(n: usize) -> Vec<NodeDef> {
+    let mut nodes = vec![node("x", "Placeholder", &[], &[&[-1, 64]])];
+    for i in 0..n {
+        let input = if i == 0 { "x".to_string() } else { format!("relu{}", i - 1) };
+        nodes.push(node(&format!("relu{}", i), "Relu", &[&input], &[&[-1, 64]]))
+    }
+    nodes.push(node("GradientDescent", "NoOp", &[&format!("^relu{}", n - 1)], &[]));
+    nodes
+}
+
+#[test]
+fn chain_on_one_device_takes_the_sum_of_its_ops() {
+    let (nodes, ndev) = (chain(6), 4);
+    let prof = profiler(&nodes, ndev);
+    let strategy = nodes.iter().map(|node| (node.name.clone(), (vec![1], 1))).collect();
+    let mut t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    // the sink is a NoOp, which is put on device 0 regardless of the strategy. It only has a control input, so no transfer is needed
+    let expected: u64 = t.pb.node.iter().map(|node| {
+        let device_id = t.devices.iter().position(|d| *d == node.device).unwrap();
+        crate::misc::Profiler::profile(&prof, node, device_id).unwrap_or(0)
+    }).sum();
+    assert!(expected > 0);
+    assert_eq!(simulate(&t, &prof).0, expected);
+    // the task graph is indexed by the position in the GraphDef, which does not need to be topological
+    t.pb.node.reverse();
+    assert_eq!(simulate(&t, &prof).0, expected)
+}
+
+#[test]
+fn evaluate_batch_equals_evaluating_each() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let strategies: Vec<_> = (0..6).map(|seed| strategy(&nodes, ndev, seed)).collect();
+    let (mut methods, mut placements) = (vec![], vec![]);
+    for s in strategies.iter() {
+        let (m, p) = strategy_arrays(&nodes, ndev, s);
+        methods.extend(m);
+        placements.extend(p);
+    }
+
+    let (nstrategy, nnode, nlinks) = (strategies.len(), nodes.len(), target(ndev).links.len());
+    let (mut times, mut memory) = (vec![0; nstrategy], vec![0; nstrategy * ndev]);
+    let mut feedback: Vec<Vec<u64>> = [nnode, nnode, nnode, nnode, ndev, ndev, nlinks].iter().map(|size| vec![0; nstrategy * size]).collect();
+    let options = "fill_batchsize 32\nreplace_placeholder 32\n";
+    let (graph, template) = (Graph::new(&nodes), target(ndev));
+    unsafe {
+        let mut f = feedback.iter_mut().map(|x| x.as_mut_ptr());
+        crate::evaluate_batch(&*graph, options.as_ptr(), options.len() as _, &template, &prof, core::ptr::null(),
+            methods.as_ptr(), placements.as_ptr(), nstrategy as _, 3, times.as_mut_ptr(), memory.as_mut_ptr(),
+            f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap())
+    }
+
+    for (i, s) in strategies.iter().enumerate() {
+        let (time, peak) = simulate(&compile(Graph::new(&nodes), target(ndev), s), &prof);
+        assert_eq!((times[i], &memory[i * ndev..(i + 1) * ndev]), (time, &peak[..]), "strategy {}", i);
+        assert!(feedback[4][i * ndev..(i + 1) * ndev].iter().any(|&busy| busy > 0))
+    }
+}
+
+/// calls `evaluate` with the feedback arrays in the node order of `nodes`
+fn evaluate_with_feedback(nodes: &[NodeDef], t: &Target, prof: &DataProfiler) -> (u64, Vec<Vec<u64>>) {
+    let graph = Graph::new(nodes);
+    let (nnode, ndev, nlinks) = (nodes.len(), t.ndev(), t.links.len());
+    let mut memory = vec![0; ndev];
+    let mut feedback: Vec<Vec<u64>> = [nnode, nnode, nnode, nnode, ndev, ndev, nlinks].iter().map(|&size| vec![0; size]).collect();
+    let time = unsafe {
+        let mut f = feedback.iter_mut().map(|x| x.as_mut_ptr());
+        crate::evaluate(t, prof, core::ptr::null(), 0, core::ptr::null(), 0, memory.as_mut_ptr(), &*graph,
+            f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap(), f.next().unwrap())
+    };
+    assert_eq!((time, memory), simulate(t, prof));
+    (time, feedback)
+}
+
+#[test]
+fn feedback_of_a_chain_is_all_critical() {
+    let (nodes, ndev) = (chain(6), 4);
+    let prof = profiler(&nodes, ndev);
+    let strategy = nodes.iter().map(|node| (node.name.clone(), (vec![1], 1))).collect();
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    let (total, feedback) = evaluate_with_feedback(&nodes, &t, &prof);
+    for (i, node) in nodes.iter().enumerate().filter(|(_, node)| node.op == "Relu") {
+        let compiled = t.pb.node.iter().find(|x| x.attr.get("_tge_origin").map(|x| x.get_s()) == Some(node.name.as_bytes())).unwrap();
+        let time = crate::misc::Profiler::profile(&prof, compiled, 1).unwrap();
+        assert_eq!((feedback[0][i], feedback[1][i], feedback[2][i], feedback[3][i]), (time, 0, 0, time), "{}", node.name)
+    }
+    // device_busy_time and device_critical_time
+    assert_eq!((feedback[4].iter().sum::<u64>(), feedback[5].iter().sum::<u64>()), (total, total));
+    assert!(feedback[6].iter().all(|&x| x == 0))
+}
+
+#[test]
+fn feedback_is_bounded_by_the_total_time() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for seed in 0..4 {
+        let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let (total, feedback) = evaluate_with_feedback(&nodes, &t, &prof);
+        for x in feedback.iter().flatten() {
+            assert!(*x <= total, "seed {}", seed)
+        }
+        // the critical path is a chain of tasks, so the time on it adds up to at most the total time, and some op is on it without slack
+        assert!(feedback[5].iter().chain(feedback[6].iter()).sum::<u64>() <= total, "seed {}", seed);
+        assert!((0..nodes.len()).any(|i| feedback[2][i] == 0 && feedback[3][i] > 0), "seed {}", seed)
+    }
+}
+
+fn chrome_events(t: &Target, prof: &DataProfiler) -> Vec<serde_json::Value> {
+    let mut simulator = SimpleSimulator::new(t);
+    simulator.simulate(prof);
+    let mut output = vec![];
+    simulator.write_chrome(&mut output);
+    serde_json::from_slice(&output).unwrap()
+}
+
+#[test]
+fn chrome_filters_keep_a_subset_of_the_events() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for seed in 0..4 {
+        let mut t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let all = chrome_events(&t, &prof);
+        let total = simulate(&t, &prof).0;
+        let (start, end) = (total / 4, total / 2);
+        for (name, value) in &[("chrome_devices", "0,2".to_string()), ("chrome_start", start.to_string()), ("chrome_end", end.to_string()), ("chrome_min_duration", "50".to_string())] {
+            t.options.insert(name.to_string(), value.clone());
+        }
+        let filtered = chrome_events(&t, &prof);
+        assert!(filtered.len() < all.len(), "seed {}", seed);
+        for event in filtered.iter() {
+            assert!(all.contains(event), "seed {}: {}", seed, event);
+            if event["ph"] == "X" {
+                let (ts, dur) = (event["ts"].as_u64().unwrap(), event["dur"].as_u64().unwrap());
+                assert!(dur >= 50 && ts <= end && ts + dur >= start, "seed {}: {}", seed, event);
+                if event["pid"] == 0 {
+                    assert!(event["tid"] == 0 || event["tid"] == 2, "seed {}: {}", seed, event)
+                }
+            }
+        }
+
+        // aggregating the links keeps the bytes on each link
+        for name in &["chrome_devices", "chrome_start", "chrome_end", "chrome_min_duration"] {
+            t.options.remove(*name);
+        }
+        t.options.insert("chrome_aggregate_links".into(), "True".into());
+        let aggregated = chrome_events(&t, &prof);
+        let link_bytes = |events: &[serde_json::Value], field: &str| events.iter().filter(|e| e["ph"] == "X" && e["pid"] == 1).fold(BTreeMap::new(), |mut acc, e| {
+            *acc.entry(e["tid"].as_u64().unwrap()).or_insert(0) += e["args"][field].as_u64().unwrap();
+            acc
+        });
+        assert_eq!(link_bytes(&aggregated, "bytes"), link_bytes(&all, "size"), "seed {}", seed)
+    }
+}
+
+#[test]
+fn gzipped_chrome_trace_equals_plain() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, 1));
+    let mut simulator = SimpleSimulator::new(&t);
+    simulator.simulate(&prof);
+    let dir = std::env::temp_dir().join(format!("tge_chrome_{}", std::process::id()));
+    std::fs::create_dir_all(&dir).unwrap();
+    let (plain, gzipped) = (dir.join("trace.json"), dir.join("trace.json.gz"));
+    crate::write_chrome(&simulator, plain.to_str().unwrap());
+    crate::write_chrome(&simulator, gzipped.to_str().unwrap());
+    let mut decoded = vec![];
+    std::io::Read::read_to_end(&mut flate2::read::GzDecoder::new(std::fs::File::open(&gzipped).unwrap()), &mut decoded).unwrap();
+    assert_eq!(decoded, std::fs::read(&plain).unwrap());
+    std::fs::remove_dir_all(&dir).unwrap()
+}
+
+fn dump_records(t: &Target, prof: &DataProfiler) -> serde_json::Value {
+    let mut simulator = SimpleSimulator::new(t);
+    simulator.simulate(prof);
+    let mut output = vec![];
+    simulator.dump_records(&mut output);
+    serde_json::from_slice(&output).unwrap()
+}
+
+#[test]
+fn memory_options_only_add_to_the_peaks() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for seed in 0..4 {
+        let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let (time, plain) = simulate(&t, &prof);
+        let persistent = simulate_with(&t, &prof, &[("memory_persistent", "True")]);
+        let fragmented = simulate_with(&t, &prof, &[("memory_fragmentation", "True")]);
+        let both = simulate_with(&t, &prof, &[("memory_persistent", "True"), ("memory_fragmentation", "True")]);
+        // the memory model does not change the schedule
+        assert_eq!((persistent.0, fragmented.0, both.0), (time, time, time), "seed {}", seed);
+        for d in 0..ndev {
+            assert!(persistent.1[d] >= plain[d] && fragmented.1[d] >= plain[d], "seed {} device {}", seed, d);
+            assert!(both.1[d] >= persistent.1[d], "seed {} device {}", seed, d)
+        }
+        // the weights of all replicas are held for the whole step, and they add at most their size to the peak of each device
+        let records = dump_records(&t.clone().apply(|t| { t.options.insert("memory_persistent".into(), "True".into()); }), &prof);
+        let persistent_memory: Vec<_> = records["device_persistent_memory"].as_array().unwrap().iter().map(|x| x.as_u64().unwrap()).collect();
+        assert!(persistent_memory.iter().sum::<u64>() >= 3 * 64 * 64 * 4, "seed {}", seed);
+        for d in 0..ndev {
+            assert!(persistent.1[d] - plain[d] <= persistent_memory[d], "seed {} device {}", seed, d)
+        }
+    }
+}
+
+#[test]
+fn fusion_of_a_single_all_reduce_equals_no_fusion() {
+    let (nodes, ndev) = (mlp(1, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, 0));
+    let base = simulate(&t, &prof);
+    assert_eq!(base, simulate_with(&t, &prof, &[("link_model", "fifo"), ("collective_fusion_threshold", "0")]));
+    assert_eq!(base, simulate_with(&t, &prof, &[("collective_fusion_threshold", "1000000000")]))
+}
+
+#[test]
+fn critical_path_of_a_chain_across_tasks_covers_the_transfers() {
+    // the chain alternates between the first devices of two tasks, so every other step is a transfer through link 0
+    let (nodes, ndev) = (chain(6), 4);
+    let prof = profiler(&nodes, ndev);
+    let strategy = nodes.iter().enumerate().map(|(i, node)| (node.name.clone(), (vec![i % 2 * 2], 1))).collect();
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    let total = simulate(&t, &prof).0;
+    let records = dump_records(&t, &prof);
+    let sum = |key: &str| records[key].as_array().unwrap().iter().map(|x| x.as_u64().unwrap()).sum::<u64>();
+    let link_critical_time = records["link_critical_time"].as_array().unwrap();
+    assert!(link_critical_time[0].as_u64().unwrap() > 0 && link_critical_time[1..].iter().all(|x| x == 0));
+    assert_eq!(sum("device_critical_time") + sum("link_critical_time"), total);
+
+    let path: Vec<_> = records["critical_path"].as_array().unwrap().iter().map(|x| x.as_str().unwrap()).collect();
+    assert_eq!(path.iter().filter(|x| x.contains("->relu")).count(), 6, "{:?}", path);
+    for node in nodes.iter().filter(|node| node.op == "Relu") {
+        assert_eq!(records["op_slack"][&node.name], 0, "{}", node.name);
+        assert!(records["op_critical_time"][&node.name].as_u64().unwrap() > 0, "{}", node.name)
+    }
+}
+
+#[test]
+fn critical_path_is_a_chain_of_tasks_without_slack() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for seed in 0..4 {
+        let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let total = simulate(&t, &prof).0;
+        let records = dump_records(&t, &prof);
+        let sum = |key: &str| records[key].as_object().map(|x| x.values().map(|x| x.as_u64().unwrap()).sum::<u64>())
+            .unwrap_or_else(|| records[key].as_array().unwrap().iter().map(|x| x.as_u64().unwrap()).sum());
+        assert!(!records["critical_path"].as_array().unwrap().is_empty(), "seed {}", seed);
+        // the ops exclude the auxiliary nodes, and tasks on the path do not overlap
+        assert!(sum("op_critical_time") <= sum("device_critical_time") + sum("link_critical_time"), "seed {}", seed);
+        assert!(sum("device_critical_time") + sum("link_critical_time") <= total, "seed {}", seed);
+        let slack = records["op_slack"].as_object().unwrap();
+        assert!(slack.values().all(|x| x.as_u64().unwrap() <= total), "seed {}", seed);
+        for (name, time) in records["op_critical_time"].as_object().unwrap() {
+            if time.as_u64().unwrap() > 0 {
+                assert_eq!(slack[name], 0, "seed {} op {}", seed, name)
+            }
+        }
+    }
+}
+
+#[test]
+fn elided_control_dependencies_do_not_change_the_simulation() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let mut total_added = 0; // elided dependencies that are not direct edges
+    for seed in 0..4 {
+        let mut t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let nelided = crate::scheduler::heft_control(&mut t, &prof);
+
+        // chain every pair of consecutive nodes on each device in the order of their priorities
+        let mut full = t.clone();
+        let mut chains: BTreeMap<&str, Vec<(i64, usize)>> = BTreeMap::new();
+        for (i, node) in t.pb.node.iter().enumerate() {
+            if let Some(priority) = node.attr.get("_priority") {
+                chains.entry(&node.device).or_default().push((priority.get_i(), i))
+            }
+        }
+        let mut nadded = 0;
+        for chain in chains.values_mut() {
+            chain.sort_unstable();
+            for pair in chain.windows(2) {
+                let prev = &t.pb.node[pair[0].1].name;
+                if !t.pb.node[pair[1].1].input.iter().any(|input| input.trim_start_matches('^').split(':').next() == Some(prev)) {
+                    full.pb.node[pair[1].1].input.push(format!("^{}", prev));
+                    nadded += 1
+                }
+            }
+        }
+        // the elided dependencies include the ones that are direct edges
+        assert!(nadded <= nelided, "seed {}", seed);
+        total_added += nadded;
+        assert_eq!(simulate(&t, &prof), simulate(&full, &prof), "seed {}", seed)
+    }
+    assert!(total_added > 0)
+}
+
+/// the indexes of the inputs of each node in the GraphDef
+fn input_ids(t: &Target) -> Vec<Vec<usize>> {
+    let names: std::collections::HashMap<_, _> = t.pb.node.iter().enumerate().map(|(i, node)| (&node.name[..], i)).collect();
+    t.pb.node.iter().map(|node| node.input.iter().map(|input| names[input.trim_start_matches('^').split(':').next().unwrap()]).collect()).collect()
+}
+
+fn is_acyclic(t: &Target) -> bool {
+    let inputs = input_ids(t);
+    let mut indegrees: Vec<_> = inputs.iter().map(|x| x.len()).collect();
+    let mut succs = vec![vec![]; inputs.len()];
+    for (i, x) in inputs.iter().enumerate() {
+        for &j in x {
+            succs[j].push(i)
+        }
+    }
+    let mut queue: Vec<_> = (0..indegrees.len()).filter(|&i| indegrees[i] == 0).collect();
+    let mut sorted = 0;
+    while let Some(i) = queue.pop() {
+        sorted += 1;
+        for &j in succs[i].iter() {
+            indegrees[j] -= 1;
+            if indegrees[j] == 0 {
+                queue.push(j)
+            }
+        }
+    }
+    sorted == inputs.len()
+}
+
+#[test]
+fn list_schedules_follow_the_edges() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for &algorithm in &[crate::scheduler::Algorithm::Cpop, crate::scheduler::Algorithm::Peft, crate::scheduler::Algorithm::Lookahead(2)] {
+        for seed in 0..4 {
+            let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+            for &add_control_dependency in &[false, true] {
+                let mut scheduled = t.clone();
+                crate::scheduler::list_schedule(&mut scheduled, &prof, algorithm, add_control_dependency, None);
+                assert!(is_acyclic(&scheduled), "{:?} seed {}", algorithm, seed);
+
+                // the priorities are the positions in the schedule, so they increase along the edges
+                let priority = |i: usize| scheduled.pb.node[i].attr.get("_priority").map(|x| x.get_i());
+                for (i, inputs) in input_ids(&scheduled).iter().enumerate() {
+                    for &j in inputs {
+                        if let (Some(a), Some(b)) = (priority(j), priority(i)) {
+                            assert!(a < b, "{:?} seed {}: {} -> {}", algorithm, seed, scheduled.pb.node[j].name, scheduled.pb.node[i].name)
+                        }
+                    }
+                }
+                assert!(simulate(&scheduled, &prof).0 > 0, "{:?} seed {}", algorithm, seed)
+            }
+        }
+    }
+}
+
+/// independent branches that each make a large tensor and reduce it, so running all the large ones first takes the most memory
+fn branches(n: usize) -> Vec<NodeDef> {
+    let mut nodes = vec![node("x", "Placeholder", &[], &[&[-1, 4]])];
+    for i in 0..n {
+        nodes.push(node(&format!("large{}", i), "Relu", &["x"], &[&[-1, 4096]]));
+        nodes.push(node(&format!("small{}", i), "Relu", &[&format!("large{}", i)], &[&[-1, 1]]))
+    }
+    let smalls: Vec<_> = (0..n).map(|i| format!("small{}", i)).collect();
+    nodes.push(node("sum", "AddN", &smalls.iter().map(|x| &x[..]).collect::<Vec<_>>(), &[&[-1, 1]]));
+    nodes.push(node("GradientDescent", "NoOp", &["^sum"], &[]));
+    nodes
+}
+
+#[test]
+fn memory_limits_bound_the_peaks() {
+    let (nodes, ndev) = (branches(6), 4);
+    let prof = profiler(&nodes, ndev);
+    let strategy = nodes.iter().map(|node| (node.name.clone(), (vec![0], 1))).collect();
+    let t = compile(Graph::new(&nodes), target(ndev), &strategy);
+    let mut over_limits = false;
+    for &algorithm in &[crate::scheduler::Algorithm::Cpop, crate::scheduler::Algorithm::Peft, crate::scheduler::Algorithm::Lookahead(2)] {
+        let peak = |limits: Option<&[u64]>| {
+            let mut scheduled = t.clone();
+            crate::scheduler::list_schedule(&mut scheduled, &prof, algorithm, true, limits);
+            simulate_with(&scheduled, &prof, &[("memory_persistent", "True")]).1[0]
+        };
+        // two of the large tensors and the small ones fit
+        let limits = [2 * 32 * 4096 * 4 + 4096; 4];
+        assert!(peak(Some(&limits)) <= limits[0], "{:?}", algorithm);
+        assert_eq!(peak(Some(&[core::u64::MAX; 4])), peak(None), "{:?}", algorithm);
+        over_limits |= peak(None) > limits[0]
+    }
+    assert!(over_limits)
+}
+
+#[test]
+fn recompute_keeps_the_graph_acyclic() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    for seed in 0..4 {
+        // recompute every other forward layer
+        let s = strategy(&nodes, ndev, seed).apply(|s| for l in (0..5).step_by(2) {
+            for name in &[format!("mm{}", l), format!("relu{}", l)] {
+                s.get_mut(name).unwrap().1 = 5
+            }
+        });
+        let t = compile(Graph::new(&nodes), target(ndev), &s);
+        assert!(t.pb.node.iter().any(|node| node.name.ends_with("/aux_recompute")));
+        assert!(is_acyclic(&t), "seed {}", seed);
+        assert!(simulate(&t, &prof).0 > 0)
+    }
+}
+
+#[test]
+fn buckets_all_reduce_the_same_bytes() {
+    let nodes = mlp(5, 64);
+    let collectives = |t: &Target| -> (usize, u64) {
+        let sizes: Vec<_> = t.pb.node.iter().filter(|node| node.op == "CollectiveReduce").map(|node| node.attr["_tge_input_sizes"].get_list().i[0] as u64).collect();
+        (sizes.len(), sizes.iter().sum())
+    };
+    for &ndev in &[2, 4] {
+        // seed 0 replicates every node with collective all-reduce
+        let (prof, s) = (profiler(&nodes, ndev), strategy(&nodes, ndev, 0));
+        let (count, bytes) = collectives(&compile(Graph::new(&nodes), target(ndev), &s));
+        assert!(count > 0, "ndev {}", ndev);
+        for &bucket_size in &[1, 64 * 64 * 4 * 2, core::u64::MAX] {
+            let graph = Graph::new(&nodes).apply(|g| { g.options.insert("collective_bucket_size".into(), bucket_size.to_string()); });
+            let t = compile(graph, target(ndev), &s);
+            let (bucketed_count, bucketed_bytes) = collectives(&t);
+            assert_eq!(bucketed_bytes, bytes, "ndev {} bucket size {}", ndev, bucket_size);
+            // a bucket smaller than any tensor leaves them alone, and a bucket of everything leaves one all-reduce per device
+            match bucket_size {
+                1 => assert_eq!(bucketed_count, count, "ndev {}", ndev),
+                core::u64::MAX => assert_eq!(bucketed_count, ndev, "ndev {}", ndev),
+                _ => assert!(bucketed_count < count, "ndev {}", ndev)
+            }
+            assert!(is_acyclic(&t) && simulate(&t, &prof).0 > 0, "ndev {} bucket size {}", ndev, bucket_size)
+        }
+    }
+}
+
+#[test]
+fn edges_match_the_inputs_of_the_nodes() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    for seed in 0..4 {
+        let t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, seed));
+        let edges = t.edges();
+        assert_eq!(edges.len(), t.pb.node.len());
+        let mut expected_succs = vec![vec![]; edges.len()];
+        for (i, node) in t.pb.node.iter().enumerate() {
+            assert_eq!(edges.names[&node.name[..]], i);
+            let inputs: Vec<_> = node.input.iter().map(|input| {
+                let (name, index) = match (input.strip_prefix('^'), input.split_once(':')) {
+                    (Some(name), _) => (name, None),
+                    (None, Some((name, index))) => (name, Some(index.parse().unwrap())),
+                    (None, None) => (&input[..], Some(0))
+                };
+                crate::misc::Input { node: edges.names[name], index }
+            }).collect();
+            assert_eq!(edges.inputs(i), &inputs[..], "seed {} node {}", seed, node.name);
+            for input in inputs {
+                expected_succs[input.node].push(i)
+            }
+        }
+        let (offsets, succs) = edges.successors();
+        for (i, expected) in expected_succs.iter().enumerate() {
+            assert_eq!(&succs[offsets[i]..offsets[i+1]], &expected[..], "seed {} node {}", seed, t.pb.node[i].name)
+        }
+    }
+}
+
+#[test]
+fn imported_analysis_equals_analyzing() {
+    let (nodes, ndev) = (mlp(5, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let analysis = Graph::new(&nodes).export_analysis();
+    assert_eq!(Graph::with_analysis(&nodes, &analysis).export_analysis(), analysis);
+    for seed in 0..4 {
+        let s = strategy(&nodes, ndev, seed);
+        let expected = compile(Graph::new(&nodes), target(ndev), &s);
+        let imported = compile(Graph::with_analysis(&nodes, &analysis), target(ndev), &s);
+        assert_eq!(imported.pb.node.iter().map(|node| &node.name).collect::<Vec<_>>(), expected.pb.node.iter().map(|node| &node.name).collect::<Vec<_>>());
+        assert_eq!(simulate(&imported, &prof), simulate(&expected, &prof), "seed {}", seed)
+    }
+}
+
+#[test]
+fn reset_and_edit_again_equals_a_fresh_graph() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let prof = profiler(&nodes, ndev);
+    let mut graph = Graph::new(&nodes);
+    for seed in (0..8).chain(0..4) {
+        // the strategies in turn, so each edit follows a different one
+        let s = strategy(&nodes, ndev, seed);
+        let reused = compile_in(&mut graph, target(ndev), &s);
+        let fresh = compile(Graph::new(&nodes), target(ndev), &s);
+        assert!(reused.pb.node == fresh.pb.node, "seed {}", seed);
+        assert_eq!(simulate(&reused, &prof), simulate(&fresh, &prof), "seed {}", seed);
+        crate::editor::reset(&mut graph)
+    }
+}
+
+#[test]
+fn write_protobuf_writes_the_graph_or_returns_the_error() {
+    let (nodes, ndev) = (mlp(3, 64), 4);
+    let mut t = compile(Graph::new(&nodes), target(ndev), &strategy(&nodes, ndev, 0));
+    let expected = t.pb.write_to_bytes().unwrap();
+    let mut read = vec![0; unsafe { crate::compute_size(&mut t) } as usize];
+    unsafe { crate::read_protobuf(&mut t, read.as_mut_ptr()) };
+    assert_eq!(read, expected);
+
+    let dir = std::env::temp_dir().join(format!("tge_protobuf_{}", std::process::id()));
+    std::fs::create_dir_all(&dir).unwrap();
+    // file names are raw bytes, which do not need to be valid UTF-8
+    let name: &[u8] = if cfg!(unix) { b"graph\xff.pb" } else { b"graph.pb" };
+    let path = dir.join(crate::os_path(name));
+    let raw = [dir.to_str().unwrap().as_bytes(), b"/", name].concat();
+    assert_eq!(unsafe { crate::write_protobuf(&mut t, raw.as_ptr(), raw.len() as _) }, 0);
+    assert_eq!(std::fs::read(&path).unwrap(), expected);
+
+    let missing = [dir.to_str().unwrap().as_bytes(), b"/missing/graph.pb"].concat();
+    let status = unsafe { crate::write_protobuf(&mut t, missing.as_ptr(), missing.len() as _) };
+    assert_eq!(std::io::Error::from_raw_os_error(status).kind(), std::io::ErrorKind::NotFound);
+    std::fs::remove_dir_all(&dir).unwrap()
+}
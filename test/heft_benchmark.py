@@ -0,0 +1,50 @@
+# measures how heft scales with the size of the compiled graph. No GPU or cluster is needed.
+# usage: python heft_benchmark.py [nlayers ...]. The default largest model compiles to about half a million nodes on 8 devices.
+
+import sys
+import tensorflow as tf
+import tge
+from utils import measure_time, synthetic_profile
+
+devices = [ "/job:worker/replica:0/task:{}/device:GPU:{}".format(i // 4, i % 4) for i in range(8) ]
+
+def model_fn(nlayers, ntowers=4):
+    x = tf.placeholder(tf.float32, shape=(None, 64))
+    y = tf.placeholder(tf.float32, shape=(None, 10))
+    towers = []
+    for _ in range(ntowers):
+        net = x
+        for _ in range(nlayers):
+            net = tf.contrib.slim.fully_connected(net, 64, activation_fn=tf.nn.relu)
+        towers.append(net)
+    output = tf.contrib.slim.fully_connected(tf.add_n(towers), 10, activation_fn=None)
+    loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=y, logits=output)
+    optimizer = tf.train.GradientDescentOptimizer(0.2).minimize(tf.reduce_sum(loss))
+    return optimizer
+
+for nlayers in map(int, sys.argv[1:] or (10, 100, 1000)):
+    tf.reset_default_graph()
+    model_fn(nlayers)
+    gdef = tf.get_default_graph().as_graph_def(add_shapes=True)
+
+    profile = tge.Profile(synthetic_profile(gdef, len(devices)), gdef)
+    strategy = { node.name: [1] + [1] * len(devices) for node in gdef.node }
+
+    t = (tge.TGE(gdef, devices)
+        .set_strategy(strategy)
+        .replace_placeholder(64)
+        .use_collective()
+        .set_bandwidth(intra=3000, inter=1000)
+        .compile())
+    nnodes = len(t.get_result().node)
+
+    print("{} layers, {} nodes, {} nodes after compiling".format(nlayers, len(gdef.node), nnodes))
+    with measure_time("heft rank"):
+        t.heft(profile)
+    with measure_time("heft control"):
+        t.heft(profile, add_control_dependency=True)
+    print("{} control dependencies elided".format(t.elided_control_dependencies))
+    for algorithm in ("cpop", "peft", "lookahead"):
+        with measure_time(algorithm):
+            t.schedule(profile, algorithm)
+    assert len(t.get_result().node) == nnodes # scheduling only adds control dependencies
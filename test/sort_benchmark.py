@@ -0,0 +1,50 @@
+# measures building and simulating graphs whose GraphDef is not in topological order, which used to take quadratic time. No GPU or cluster is needed.
+# usage: python sort_benchmark.py [vgg|resnet ...]
+
+import sys
+import tensorflow as tf
+import tge
+from utils import measure_time, synthetic_profile
+
+devices = [ "/job:worker/replica:0/task:{}/device:GPU:{}".format(i // 4, i % 4) for i in range(8) ]
+
+def model_fn(model):
+    x = tf.placeholder(tf.float32, shape=(None, 224, 224, 3))
+    y = tf.placeholder(tf.float32, shape=(None, 1000))
+    if model == "vgg":
+        from tensorflow.contrib.slim.nets import vgg
+        output, _ = vgg.vgg_19(x, 1000)
+    else:
+        from tensorflow.contrib.slim.nets import resnet_v2
+        output, _ = resnet_v2.resnet_v2_101(x, 1000)
+        output = tf.contrib.slim.flatten(output)
+    loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=y, logits=output)
+    optimizer = tf.train.GradientDescentOptimizer(0.2).minimize(tf.reduce_sum(loss))
+    return optimizer
+
+for model in sys.argv[1:] or ("vgg", "resnet"):
+    tf.reset_default_graph()
+    model_fn(model)
+    gdef = tf.get_default_graph().as_graph_def(add_shapes=True)
+
+    profile = tge.Profile(synthetic_profile(gdef, len(devices)), gdef)
+    strategy = { node.name: [2] + [1] * len(devices) for node in gdef.node } # the ring all-reduce adds many unordered nodes
+
+    reversed_gdef = type(gdef)()
+    reversed_gdef.CopyFrom(gdef)
+    del reversed_gdef.node[:]
+    reversed_gdef.node.extend(reversed(gdef.node))
+
+    print("{}: {} nodes".format(model, len(gdef.node)))
+    compiled = []
+    for name, g in (("ordered", gdef), ("reversed", reversed_gdef)):
+        with measure_time("{} build".format(name)):
+            t = tge.TGE(g, devices).set_strategy(strategy).replace_placeholder(64)
+        with measure_time("{} compile".format(name)):
+            t.compile()
+        with measure_time("{} evaluate".format(name)):
+            result, _ = t.evaluate(profile)
+        print("{} simulated time: {}".format(name, result))
+        assert result > 0
+        compiled.append(sorted(node.name for node in t.get_result().node))
+    assert compiled[0] == compiled[1] # the order of the GraphDef does not change what is compiled
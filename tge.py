@@ -1,5 +1,9 @@
 import re
+import os
 import ctypes
+import hashlib
+import collections
+import numpy as np
 
 PROFILER_T = ctypes.CFUNCTYPE(ctypes.c_uint64, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32)
 
@@ -8,6 +12,15 @@ libtge = ctypes.cdll.LoadLibrary("./libtge.so")
 libtge.create_graph.argtypes = [ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
 libtge.create_graph.restype = ctypes.c_void_p
 
+libtge.create_graph_with_analysis.argtypes = [ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32), ctypes.c_uint32]
+libtge.create_graph_with_analysis.restype = ctypes.c_void_p
+
+libtge.clone_graph.argtypes = [ctypes.c_void_p]
+libtge.clone_graph.restype = ctypes.c_void_p
+
+libtge.export_analysis.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint32)]
+libtge.export_analysis.restype = None
+
 libtge.destroy_graph.argtypes = [ctypes.c_void_p]
 libtge.destroy_graph.restype = None
 
@@ -20,6 +33,9 @@ libtge.get_groups.restype = None
 libtge.edit_graph.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
 libtge.edit_graph.restype = None
 
+libtge.edit_graph_v2.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int8), ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32]
+libtge.edit_graph_v2.restype = None
+
 libtge.reset_graph.argtypes = [ctypes.c_void_p]
 libtge.reset_graph.restype = None
 
@@ -29,18 +45,33 @@ libtge.create_target.restype = ctypes.c_void_p
 libtge.destroy_target.argtypes = [ctypes.c_void_p]
 libtge.destroy_target.restype = None
 
+libtge.set_topology.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
+libtge.set_topology.restype = None
+
+libtge.set_target_option.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
+libtge.set_target_option.restype = None
+
+libtge.set_nccl_model.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
+libtge.set_nccl_model.restype = None
+
 libtge.compute_size.argtypes = [ctypes.c_void_p]
 libtge.compute_size.restype = ctypes.c_uint32
 
 libtge.read_protobuf.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char)]
 libtge.read_protobuf.restype = None
 
+libtge.write_protobuf.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
+libtge.write_protobuf.restype = ctypes.c_int32
+
 libtge.compile.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 libtge.compile.restype = None
 
 libtge.create_profiler.argtypes = [ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
 libtge.create_profiler.restype = ctypes.c_void_p
 
+libtge.create_profiler_v2.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32), ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint64), ctypes.c_uint32]
+libtge.create_profiler_v2.restype = ctypes.c_void_p
+
 libtge.destroy_profiler.argtypes = [ctypes.c_void_p]
 libtge.destroy_profiler.restype = None
 
@@ -48,11 +79,36 @@ libtge.heft_rank.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 libtge.heft_rank.restype = None
 
 libtge.heft_control.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-libtge.heft_control.restype = None
+libtge.heft_control.restype = ctypes.c_uint32
+
+libtge.list_schedule.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint8, ctypes.POINTER(ctypes.c_uint64)]
+libtge.list_schedule.restype = ctypes.c_uint32
+
+libtge.pipeline_schedule.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32]
+libtge.pipeline_schedule.restype = ctypes.c_uint32
 
-libtge.evaluate.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint64)]
+libtge.fuse_mini_batch.argtypes = [ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_char), ctypes.POINTER(ctypes.c_uint32)]
+libtge.fuse_mini_batch.restype = None
+
+libtge.evaluate.argtypes = [
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint64),
+    ctypes.c_void_p, *[ctypes.POINTER(ctypes.c_uint64)] * 7
+]
 libtge.evaluate.restype = ctypes.c_uint64
 
+libtge.evaluate_batch.argtypes = [
+    ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+    ctypes.POINTER(ctypes.c_int8), ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32, ctypes.c_uint32,
+    *[ctypes.POINTER(ctypes.c_uint64)] * 9
+]
+libtge.evaluate_batch.restype = None
+
+libtge.record_timeline.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+libtge.record_timeline.restype = ctypes.c_void_p
+
+libtge.destroy_timeline.argtypes = [ctypes.c_void_p]
+libtge.destroy_timeline.restype = None
+
 libtge.remove_colocation_hint.argtypes = [ctypes.c_void_p]
 libtge.remove_colocation_hint.restype = None
 
@@ -82,23 +138,276 @@ def simplify_graph(graph_def, sinks=["GradientDescent"]):
     libtge.simplify_graph(graph_raw_mut, graph_len_mut, sinks_raw, len(sinks_raw))
     graph_def.ParseFromString(graph_raw_mut.raw[:graph_len_mut[0]])
 
+def profile_arrays(profile_dict, graph_def):
+    """
+    convert a profile dict {(name, nreplica): [time on each device]} into (nreps, times), where times is a uint64 array
+    shaped [node, nrep, device] in the node order of graph_def. Missing entries are filled with the maximum uint64
+    """
+    nreps = np.array(sorted(set(nrep for _, nrep in profile_dict.keys())), dtype=np.uint32)
+    ndev = len(next(iter(profile_dict.values()))) if len(profile_dict) > 0 else 0
+    node_index = { node.name: i for i, node in enumerate(graph_def.node) }
+    nrep_index = { nrep: i for i, nrep in enumerate(nreps.tolist()) }
+    times = np.full((len(graph_def.node), len(nreps), ndev), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for (name, nrep), t in profile_dict.items():
+        if name in node_index:
+            times[node_index[name], nrep_index[nrep]] = t
+    return nreps, times
+
+_analyzed_graphs = collections.OrderedDict() # GraphDef digest => the analyzed graph, which is cloned for each TGE. The least recently used is released first
+_analyzed_graphs_limit = 8
+_graph_def_digests = collections.OrderedDict() # id(graph_def) => (graph_def, fingerprint, digest), so the same GraphDef object is not serialized and hashed again
+_analysis_cache_dir = None
+
+def set_analysis_cache(directory):
+    """
+    save the analysis of each graph to directory, named by the digest of the GraphDef, and load it in later runs to skip analyzing.
+    The files are flat uint32 arrays (see Graph::export_analysis) that are memory-mapped when loading. None disables it.
+    Within a process the analyzed graphs of the last few GraphDefs are also kept in memory, see clear_graph_cache.
+    """
+    global _analysis_cache_dir
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    _analysis_cache_dir = directory
+
+def clear_graph_cache():
+    "release the analyzed graphs kept in memory. Call it after changing a GraphDef in place, see _analyzed_graph"
+    for graph in _analyzed_graphs.values():
+        libtge.destroy_graph(graph)
+    _analyzed_graphs.clear()
+    _graph_def_digests.clear()
+
+def _export_analysis(graph):
+    size = ctypes.c_uint32(0)
+    libtge.export_analysis(graph, None, ctypes.byref(size))
+    analysis = np.zeros(size.value, dtype='<u4')
+    libtge.export_analysis(graph, analysis.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32)), ctypes.byref(size))
+    return analysis
+
+def _fingerprint(graph_def):
+    nodes = graph_def.node
+    return (len(nodes), nodes[0].name, nodes[-1].name) if len(nodes) > 0 else (0, None, None)
+
+def _analyzed_graph(graph_def):
+    """
+    the parsed and analyzed graph shared by graph_defs with the same content. It belongs to the cache, see _create_graph for a graph to edit.
+    A GraphDef object seen before is recognized by its id and a fingerprint of its nodes instead of hashing it again, so changes that keep
+    the number of nodes and the first and last names are not noticed.
+    """
+    known = _graph_def_digests.get(id(graph_def))
+    if known is not None and known[0] is graph_def and known[1] == _fingerprint(graph_def) and known[2] in _analyzed_graphs:
+        digest = known[2]
+    else:
+        graph_raw = graph_def.SerializeToString()
+        digest = hashlib.sha1(graph_raw).hexdigest()
+        if digest not in _analyzed_graphs:
+            path = os.path.join(_analysis_cache_dir, digest + ".analysis") if _analysis_cache_dir is not None else None
+            if path is not None and os.path.exists(path) and os.path.getsize(path) > 0:
+                analysis = np.memmap(path, dtype='<u4', mode='r')
+                graph = libtge.create_graph_with_analysis(graph_raw, len(graph_raw), analysis.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32)), len(analysis))
+            else:
+                graph = libtge.create_graph(graph_raw, len(graph_raw))
+                if path is not None:
+                    _export_analysis(graph).tofile(path + ".tmp")
+                    os.replace(path + ".tmp", path) # other processes may be reading it
+            _analyzed_graphs[digest] = graph
+            if len(_analyzed_graphs) > _analyzed_graphs_limit: # the TGE instances own clones, so the evicted graph can be released
+                libtge.destroy_graph(_analyzed_graphs.popitem(last=False)[1])
+        _graph_def_digests[id(graph_def)] = graph_def, _fingerprint(graph_def), digest # holding graph_def keeps its id from being reused
+    _graph_def_digests.move_to_end(id(graph_def))
+    if len(_graph_def_digests) > _analyzed_graphs_limit:
+        _graph_def_digests.popitem(last=False)
+    _analyzed_graphs.move_to_end(digest)
+    return _analyzed_graphs[digest]
+
+def _create_graph(graph_def):
+    "a copy of the analyzed graph of graph_def. The caller owns the returned graph."
+    return libtge.clone_graph(_analyzed_graph(graph_def))
+
+def _default_topology(ndev):
+    """all devices share a single link"""
+    return [1000000], [[] if i == j else [0] for i in range(ndev) for j in range(ndev)]
+
+def _topology_raw(links, paths):
+    assert all(bandwidth > 0 for bandwidth in links), "links must have positive bandwidth"
+    links_raw = ' '.join(map(str, links)).encode('ascii')
+    paths_raw = '\n'.join((' '.join(map(str, path)) for path in paths))
+    paths_raw = (paths_raw + '\n').encode('ascii')
+    return links_raw, paths_raw
+
+def _nccls_raw(nccls):
+    nccls_raw = '\n'.join((' '.join([k, *map(str, v)]) for k, v in nccls.items()))
+    return (nccls_raw + '\n').encode('ascii')
+
+def _create_target(devices, sinks, links, paths, nccls):
+    devices_raw = ' '.join(devices).encode('ascii')
+    sinks_raw = ' '.join(sinks).encode('ascii')
+    links_raw, paths_raw = _topology_raw(links, paths)
+    nccls_raw = _nccls_raw(nccls)
+    return libtge.create_target(
+        devices_raw, len(devices_raw),
+        links_raw, len(links_raw),
+        paths_raw, len(paths_raw),
+        sinks_raw, len(sinks_raw),
+        nccls_raw, len(nccls_raw)
+    )
+
+def _set_target_option(target, name, value):
+    name_raw = str(name).encode('ascii')
+    value_raw = str(value).encode('ascii')
+    libtge.set_target_option(target, name_raw, len(name_raw), value_raw, len(value_raw))
+
+def memory_model_options(persistent=True, fragmentation=False, timeline=False):
+    """the simulator options of a memory model (see TGE.set_memory_model), which can be used as the target_options of evaluate_batch"""
+    return { "memory_persistent": bool(persistent), "memory_fragmentation": bool(fragmentation), "memory_timeline": bool(timeline) }
+
+# the feedback arrays in the order of the arguments of evaluate and evaluate_batch, and whether they are indexed by node, device or link
+_FEEDBACK_ARRAYS = (
+    ("op_makespan", "node"), ("op_idle_after", "node"), ("op_slack", "node"), ("op_critical_time", "node"),
+    ("device_busy_time", "device"), ("device_critical_time", "device"), ("link_critical_time", "link")
+)
+
+def _feedback_arrays(prefix, nnode, ndev, nlinks):
+    """zero arrays shaped [*prefix, node], [*prefix, device] or [*prefix, link]"""
+    sizes = { "node": nnode, "device": ndev, "link": nlinks }
+    return { name: np.zeros((*prefix, sizes[index]), dtype=np.uint64) for name, index in _FEEDBACK_ARRAYS }
+
+def _bubble_fraction(device_busy_time, times):
+    """the fraction of the step that the devices with any op stay idle, e.g. the pipeline bubbles"""
+    used = device_busy_time > 0
+    return 1 - device_busy_time.sum(-1) / np.maximum(times * used.sum(-1), 1)
+
+def _as_u64_pointer(array):
+    return array.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64))
+
+def strategy_arrays(strategy, graph_def, ndev):
+    """convert a strategy (see TGE.set_strategy) into node-indexed arrays (methods, placements)"""
+    if isinstance(strategy, tuple): # already node-indexed arrays
+        methods, placements = strategy
+    else:
+        methods = np.zeros(len(graph_def.node), dtype=np.int8)
+        placements = np.zeros((len(graph_def.node), ndev), dtype=np.int64)
+        for i, node in enumerate(graph_def.node):
+            s = strategy.get(node.name)
+            if s is not None:
+                methods[i] = s[0]
+                placements[i] = s[1:]
+    assert len(methods) == len(graph_def.node) and np.shape(placements) == (len(graph_def.node), ndev)
+    assert np.all((np.asarray(placements) >= 0) & (np.asarray(placements) <= 255)), "placements are replica numbers in uint8"
+    return np.ascontiguousarray(methods, dtype=np.int8), np.ascontiguousarray(placements, dtype=np.uint8)
+
+class Profile:
+    """
+    A profiler that lives in libtge. It is built once from a profile dict {(name, nreplica): [time on each device]}
+    and the GraphDef whose nodes it profiles. It can be shared by many TGE instances and evaluations, as long as
+    they use the same device list and their nodes (or the origins of fused nodes, see TGE.pipeline) are named as in that GraphDef.
+    """
+    def __init__(self, profile_dict, graph_def):
+        nreps, self.times = profile_arrays(profile_dict, graph_def) # the profiler borrows times, so it is kept with it
+        self.ndev = self.times.shape[2]
+        self.profiler = libtge.create_profiler_v2(
+            _analyzed_graph(graph_def),
+            nreps.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32)), len(nreps),
+            self.times.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)), self.ndev
+        )
+
+    def __del__(self):
+        libtge.destroy_profiler(self.profiler)
+
+_last_profile = None # (profile dict, graph_def, Profile) of the last profile dict, so evaluating with the same dict again reuses its profiler
+
+def _as_profile(profile, graph_def):
+    "a Profile of a profile dict, which should not be modified after being passed to TGE. A Profile is returned as is"
+    global _last_profile
+    if isinstance(profile, Profile):
+        return profile
+    if _last_profile is None or _last_profile[0] is not profile or _last_profile[1] is not graph_def:
+        _last_profile = (profile, graph_def, Profile(profile, graph_def))
+    return _last_profile[2]
+
+class Timeline:
+    """
+    A recorded simulation in libtge (see TGE.record_timeline). Evaluations of strategies that differ from the recorded one in a few nodes
+    can resume from its checkpoints instead of simulating from the beginning. The results are the same either way.
+    """
+    def __init__(self, timeline):
+        self.timeline = timeline
+
+    def __del__(self):
+        libtge.destroy_timeline(self.timeline)
+
+def evaluate_batch(graph_def, devices, strategies, profile, topology=None, nccl_model={}, sinks=["GradientDescent"], options={}, target_options={}, nthreads=0, timeline=None):
+    """
+    edit, compile and evaluate a list of strategies of the same graph in parallel. It is equivalent to (but much faster than) evaluating each strategy with a new TGE.
+
+    strategies: a list of strategies, each is either a dict or a tuple of node-indexed arrays (see TGE.set_strategy)
+    profile: either a Profile or a profile dict
+    topology: (links, paths), see TGE.set_topology. The default is the same as TGE
+    options: graph options, e.g. {"fill_batchsize": 64, "replace_placeholder": 64}
+    target_options: simulator options, e.g. memory_model_options(...)
+    nthreads: the number of threads. 0 means using all cores.
+    timeline: a Timeline recorded with the same devices, topology and profile. Each simulation resumes from it when possible.
+
+    returns (times, peak_memories, feedback), where times is shaped [strategy], peak_memories is shaped [strategy, device],
+    and feedback is a dict of arrays like TGE.evaluate, with an extra leading dimension of strategy.
+    """
+    profile = _as_profile(profile, graph_def)
+    assert profile.ndev in (0, len(devices))
+    links, paths = topology if topology is not None else _default_topology(len(devices))
+    nstrategy, nnode, ndev = len(strategies), len(graph_def.node), len(devices)
+
+    arrays = [strategy_arrays(strategy, graph_def, ndev) for strategy in strategies]
+    methods = np.ascontiguousarray(np.array([m for m, _ in arrays], dtype=np.int8).reshape(nstrategy, nnode))
+    placements = np.ascontiguousarray(np.array([p for _, p in arrays], dtype=np.uint8).reshape(nstrategy, nnode, ndev))
+
+    times = np.zeros(nstrategy, dtype=np.uint64)
+    peak_memories = np.zeros((nstrategy, ndev), dtype=np.uint64)
+    feedback = _feedback_arrays((nstrategy,), nnode, ndev, len(links))
+    if nstrategy == 0:
+        feedback["device_total_utilization"] = np.zeros((nstrategy, ndev))
+        feedback["bubble_fraction"] = np.zeros(nstrategy)
+        return times, peak_memories, feedback
+
+    options_raw = ''.join('{} {}\n'.format(k, v) for k, v in options.items()).encode('ascii')
+    target = _create_target(devices, sinks, links, paths, nccl_model)
+    for name, value in target_options.items():
+        _set_target_option(target, name, value)
+    try:
+        libtge.evaluate_batch(
+            _analyzed_graph(graph_def), options_raw, len(options_raw), target, profile.profiler, timeline.timeline if timeline is not None else None,
+            methods.ctypes.data_as(ctypes.POINTER(ctypes.c_int8)), placements.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), nstrategy, nthreads,
+            _as_u64_pointer(times), _as_u64_pointer(peak_memories), *(_as_u64_pointer(feedback[name]) for name, _ in _FEEDBACK_ARRAYS)
+        )
+    finally:
+        libtge.destroy_target(target)
+
+    feedback["device_total_utilization"] = feedback["device_busy_time"] / np.maximum(times, 1)[:, None]
+    feedback["bubble_fraction"] = _bubble_fraction(feedback["device_busy_time"], times)
+    return times, peak_memories, feedback
+
 class TGE:
     def __init__(self, graph_def, device_list, sinks=["GradientDescent"]):
         self.sinks = sinks
         self.devices = device_list
         self.graph_def = graph_def
 
-        graph_raw = graph_def.SerializeToString()
-        self.graph = libtge.create_graph(graph_raw, len(graph_raw))
+        self.graph = _create_graph(graph_def)
 
-        # default topology
-        self.links = [1000000]
-        self.paths = [[] if i == j else [0] for i in range(len(device_list)) for j in range(len(device_list))]
+        self.links, self.paths = _default_topology(len(device_list))
         self.nccls = {}
+        self.target_options = {} # options for the simulator, they survive recreating the target
+        self.elided_control_dependencies = 0 # the number of control dependencies skipped by the last heft, see heft
+        self.options = {} # options for the graph, they survive recreating the graph in pipeline
+
+        # see pipeline. When pipelined, graph_def is the fused graph and origins maps each of its nodes to the index in original_graph_def
+        self.original_graph_def = graph_def
+        self.origins = None
+        self.representatives = None # the node in graph_def that gets the op feedback of each original node
+        self.micro_batches = 1
+        self.pipeline_schedule = None
 
         self.strategy = None
         self.target = None
-        self.profiler = None
+        self.profile = None
         self.compiled = False # if the target is compiled. Being True also implies that self.target is not None.
         self.edited = False # if the graph is edited. It must be reset before another editing.
 
@@ -108,9 +417,6 @@ class TGE:
         if self.target is not None:
             libtge.destroy_target(self.target)
 
-        if self.profiler is not None:
-            libtge.destroy_profiler(self.profiler)
-
     def get_result(self):
         assert self.target is not None
         size = libtge.compute_size(self.target)
@@ -120,6 +426,27 @@ class TGE:
         result.ParseFromString(buf.raw)
         return result
 
+    def get_result_bytes(self):
+        """
+        the serialized GraphDef as a memoryview, written by the library directly into its buffer. It saves parsing the GraphDef
+        when it is only passed on, e.g. tf.GraphDef.FromString(bytes(...)) in another process or a file.
+        """
+        assert self.target is not None
+        size = libtge.compute_size(self.target)
+        buf = np.empty(size, dtype=np.uint8)
+        libtge.read_protobuf(self.target, buf.ctypes.data_as(ctypes.POINTER(ctypes.c_char)))
+        return buf.data
+
+    def write_result(self, path):
+        "write the serialized GraphDef to path without passing it through Python. Load it with GraphDef.ParseFromString. Raises IOError if it fails"
+        assert self.target is not None
+        path_raw = os.fsencode(path)
+        status = libtge.write_protobuf(self.target, path_raw, len(path_raw))
+        if status > 0:
+            raise IOError(status, os.strerror(status), path)
+        if status != 0:
+            raise IOError("fail to write {}".format(path))
+
     def get_groups(self):
         names_raw = ' '.join((node.name for node in self.graph_def.node)).encode('ascii')
         result = (ctypes.c_uint32 * len(self.graph_def.node))(*(0 for x in self.graph_def.node))
@@ -128,28 +455,79 @@ class TGE:
 
     @chain
     def compile(self):
+        """
+        edit and compile the graph. The topology (see set_topology), the nccl, link, collective and memory models, the collective fusion
+        and the chrome options only affect evaluating, so they can still be changed afterwards without compiling again
+        """
         assert self.strategy is not None
         self._create_target()
         self._edit()
         libtge.compile(self.graph, self.target)
         self.compiled = True
 
+        if self.pipeline_schedule is not None:
+            schedule_raw = self.pipeline_schedule.encode('ascii')
+            self.elided_control_dependencies = libtge.pipeline_schedule(self.target, schedule_raw, len(schedule_raw))
+
         # for backward compatibility
         self.remove_colocation_hint()
         self.remove_shape_hint()
 
     @chain
-    def heft(self, profile_dict, add_control_dependency=False):
+    def heft(self, profile, add_control_dependency=False):
+        """
+        profile: either a Profile or a profile dict
+        add_control_dependency: chain the nodes on each device in the order of their priorities. Dependencies that are already implied
+            by the graph are skipped, and the number of them is saved in self.elided_control_dependencies
+        """
         if not self.compiled:
             self.compile()
 
-        self._create_profiler(profile_dict)
+        self._set_profile(profile)
         if add_control_dependency:
-            libtge.heft_control(self.target, self.profiler)
+            self.elided_control_dependencies = libtge.heft_control(self.target, self.profile.profiler)
         else:
-            libtge.heft_rank(self.target, self.profiler)
+            libtge.heft_rank(self.target, self.profile.profiler)
 
-    def evaluate(self, profile_dict, chrome_path="", dump_path=""):
+    @chain
+    def schedule(self, profile, algorithm="heft", add_control_dependency=False, lookahead=2, memory_limit=None):
+        """
+        set the priorities of the nodes with a scheduling algorithm. The placement is decided by the strategy, so the algorithms only decide the order on each device.
+        algorithm: "heft" (same as TGE.heft), "cpop", "peft" or "lookahead"
+        lookahead: the number of steps that the lookahead algorithm looks into the descendants of each candidate
+        add_control_dependency: see TGE.heft
+        memory_limit: the memory capacity of each device. If given, the ops whose allocations do not fit are deferred while other ops are ready,
+            which keeps the peak memory under the limit when possible at the cost of time. Not supported by "heft".
+            The simulator runs ops as soon as they are ready, so the order only takes effect with add_control_dependency.
+        """
+        if algorithm == "heft":
+            assert memory_limit is None, "memory_limit requires a list scheduler (cpop, peft or lookahead)"
+            self.heft(profile, add_control_dependency)
+            return
+
+        if not self.compiled:
+            self.compile()
+
+        self._set_profile(profile)
+        algorithm_raw = algorithm.encode('ascii')
+        if memory_limit is not None:
+            memory_limit = np.ascontiguousarray(memory_limit, dtype=np.uint64)
+            assert memory_limit.shape == (len(self.devices),)
+        nelided = libtge.list_schedule(self.target, self.profile.profiler, algorithm_raw, len(algorithm_raw), lookahead, add_control_dependency,
+            _as_u64_pointer(memory_limit) if memory_limit is not None else None)
+        if add_control_dependency:
+            self.elided_control_dependencies = nelided
+
+    def evaluate(self, profile, chrome_path="", dump_path="", feedback=False):
+        """
+        profile: either a Profile or a profile dict
+        chrome_path: write a chrome trace (see set_chrome_options) to this path. It is gzipped if the path ends with ".gz"
+        feedback: if True, returns (time, memory, feedback) where feedback is a dict of arrays:
+            op_makespan, op_idle_after, op_slack and op_critical_time are shaped [node] in the order of graph_def.node (the original one if pipelined),
+            device_busy_time, device_critical_time and device_total_utilization are shaped [device], link_critical_time is shaped [link].
+            op_slack is how long an op can be delayed without delaying the step, and the critical times are how long the critical path spends on each op, device and link.
+            bubble_fraction is the fraction of the step that the devices with any op stay idle.
+        """
         if not self.compiled: # for backward compatibility
             self.compile()
         self.remove_dangling_nodes()
@@ -157,55 +535,59 @@ class TGE:
         chrome_path = chrome_path.encode('ascii')
         dump_path = dump_path.encode('ascii')
         memory = (ctypes.c_uint64 * len(self.devices))(*(0 for x in self.devices))
-        self._create_profiler(profile_dict)
-        result = libtge.evaluate(self.target, self.profiler, chrome_path, len(chrome_path), dump_path, len(dump_path), memory)
-        self.target = None # evaluator takes the ownership of target for performance
+        self._set_profile(profile)
+        if not feedback:
+            result = libtge.evaluate(self.target, self.profile.profiler, chrome_path, len(chrome_path), dump_path, len(dump_path), memory, None, *[None] * len(_FEEDBACK_ARRAYS))
+            return result, list(memory)
+
+        feedback = _feedback_arrays((), len(self.graph_def.node), len(self.devices), len(self.links))
+        result = libtge.evaluate(self.target, self.profile.profiler, chrome_path, len(chrome_path), dump_path, len(dump_path), memory,
+            self.graph, *(_as_u64_pointer(feedback[name]) for name, _ in _FEEDBACK_ARRAYS))
+        feedback["device_total_utilization"] = feedback["device_busy_time"] / max(result, 1)
+        feedback["bubble_fraction"] = _bubble_fraction(feedback["device_busy_time"], result)
+        if self.origins is not None:
+            for name, index in _FEEDBACK_ARRAYS:
+                if index == "node":
+                    feedback[name] = feedback[name][self.representatives]
+        return result, list(memory), feedback
+
+    def record_timeline(self, profile):
+        """simulate like evaluate and return the Timeline, which evaluate_batch can resume from. profile: either a Profile or a profile dict"""
+        if not self.compiled:
+            self.compile()
+        self.remove_dangling_nodes()
 
-        return result, list(memory)
+        self._set_profile(profile)
+        return Timeline(libtge.record_timeline(self.target, self.profile.profiler))
 
     def _create_target(self):
-        devices_raw = ' '.join(self.devices).encode('ascii')
-        sinks_raw = ' '.join(self.sinks).encode('ascii')
-        links_raw = ' '.join(map(str, self.links)).encode('ascii')
-        paths_raw = '\n'.join((' '.join(map(str, path)) for path in self.paths))
-        paths_raw = (paths_raw + '\n').encode('ascii')
-        nccls_raw = '\n'.join((' '.join([k, *map(str, v)]) for k, v in self.nccls.items()))
-        nccls_raw = (nccls_raw + '\n').encode('ascii')
-
         if self.target is not None:
             libtge.destroy_target(self.target)
-        self.target = libtge.create_target(
-            devices_raw, len(devices_raw),
-            links_raw, len(links_raw),
-            paths_raw, len(paths_raw),
-            sinks_raw, len(sinks_raw),
-            nccls_raw, len(nccls_raw)
-        )
+        self.target = _create_target(self.devices, self.sinks, self.links, self.paths, self.nccls)
+        for name, value in self.target_options.items():
+            _set_target_option(self.target, name, value)
         self.compiled = False
 
     def _edit(self):
-        strategy_raw = ''
-        for name, strategy in self.strategy.items():
-            strategy_raw += name + ' ' + str(strategy[0])
-            for i, j in enumerate(strategy[1:]):
-                while j > 0:
-                    strategy_raw += ' ' + str(i)
-                    j -= 1
-            strategy_raw += '\n'
-        strategy_raw = strategy_raw.encode('ascii')
+        methods, placements = self._strategy_arrays()
         if self.edited:
             libtge.reset_graph(self.graph)
-        libtge.edit_graph(self.graph, self.target, strategy_raw, len(strategy_raw))
+        libtge.edit_graph_v2(self.graph, self.target,
+            methods.ctypes.data_as(ctypes.POINTER(ctypes.c_int8)),
+            placements.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),
+            placements.shape[1])
         self.edited = True
 
-    def _create_profiler(self, profile_dict):
-        profile_raw = ''
-        for (name, nreplica), times in profile_dict.items():
-            profile_raw += ' '.join([name, str(nreplica), *map(str, times)]) + '\n'
-        profile_raw = profile_raw.encode('ascii')
-        if self.profiler is not None:
-            libtge.destroy_profiler(self.profiler)
-        self.profiler = libtge.create_profiler(profile_raw, len(profile_raw))
+    def _strategy_arrays(self):
+        if self.origins is None:
+            return strategy_arrays(self.strategy, self.graph_def, len(self.devices))
+        methods, placements = strategy_arrays(self.strategy, self.original_graph_def, len(self.devices))
+        return np.ascontiguousarray(methods[self.origins]), np.ascontiguousarray(placements[self.origins])
+
+    def _set_profile(self, profile):
+        profile = _as_profile(profile, self.original_graph_def)
+        assert profile.ndev in (0, len(self.devices))
+        self.profile = profile # keep a reference so the profiler outlives the target using it
 
     @chain
     def remove_colocation_hint(self):
@@ -232,9 +614,14 @@ class TGE:
         """
         links: an array contains the bandwidth of each link. The unit is bytes/time where time is the same unit of profiling
         paths: an array where the i*n+j element is an array of link indexes that in the path of i->j.
+
+        It can be changed after compiling. The compiled graph is kept and only the evaluation uses the new topology.
         """
+        links_raw, paths_raw = _topology_raw(links, paths)
         self.links = links
         self.paths = paths
+        if self.target is not None:
+            libtge.set_topology(self.target, links_raw, len(links_raw), paths_raw, len(paths_raw))
 
     @chain
     def set_bandwidth(self, intra, inter):
@@ -258,12 +645,116 @@ class TGE:
     def set_nccl_model(self, model):
         """use profiler.py to make a model"""
         self.nccls = model
+        if self.target is not None:
+            nccls_raw = _nccls_raw(self.nccls)
+            libtge.set_nccl_model(self.target, nccls_raw, len(nccls_raw))
+
+    def _set_target_option(self, name, value):
+        self.target_options[name] = value
+        if self.target is not None:
+            _set_target_option(self.target, name, value)
+
+    @chain
+    def set_chrome_options(self, devices=None, start=None, end=None, min_duration=None, aggregate_links=False):
+        """only write the tasks on these device indices, overlapping [start, end] and not shorter than min_duration (1 by default) to the chrome trace, optionally merging the overlapping transfers of each link"""
+        if devices is not None:
+            self._set_target_option("chrome_devices", ','.join(map(str, devices)))
+        if start is not None:
+            self._set_target_option("chrome_start", int(start))
+        if end is not None:
+            self._set_target_option("chrome_end", int(end))
+        if min_duration is not None:
+            self._set_target_option("chrome_min_duration", int(min_duration))
+        self._set_target_option("chrome_aggregate_links", bool(aggregate_links))
+
+    @chain
+    def set_link_model(self, model="fair_share"):
+        """"fifo" (the default of the simulator): a transfer holds all links on its path. "fair_share": concurrent transfers share the links with max-min fairness"""
+        assert model in ("fifo", "fair_share")
+        self._set_target_option("link_model", model)
+
+    @chain
+    def set_collective_model(self, model="links"):
+        """the all-reduces without an entry in the nccl model take "nccl" (the default of the simulator): a general fallback, or "links": a ring limited by its slowest link"""
+        assert model in ("nccl", "links")
+        self._set_target_option("collective_model", model)
+
+    @chain
+    def set_collective_fusion(self, threshold=64<<20, cycle=0):
+        """fuse the all-reduces of a group that are ready before the pending one starts, up to threshold bytes (0 disables it), like Horovod. They only start at multiples of cycle"""
+        self._set_target_option("collective_fusion_threshold", int(threshold))
+        self._set_target_option("collective_fusion_cycle", int(cycle))
+
+    @chain
+    def set_collective_bucket(self, size=25<<20):
+        """
+        pack the all-reduces (strategy 1) into buckets when compiling, i.e. concat the gradients, all-reduce them once and split them back.
+        Unlike set_collective_fusion, the buckets are fixed in the graph, so the result can run as is. The gradients are taken in the order
+        that they are expected to become ready in the backward pass, and a bucket waits for all of them. It must be set before compiling.
+        To tune the size offline, evaluate with different sizes (or pass it as the "collective_bucket_size" option of evaluate_batch).
+        size: the max bytes of a bucket. 0 disables bucketing
+        """
+        self._set_option("collective_bucket_size", int(size))
+
+    @chain
+    def set_memory_model(self, persistent=True, fragmentation=False, timeline=False):
+        """count the variables and optimizer states (persistent) besides the activations, the fragmentation of a best-fit allocator, and record the memory over time (timeline)"""
+        for name, value in memory_model_options(persistent, fragmentation, timeline).items():
+            self._set_target_option(name, value)
 
     def _set_option(self, name, value):
+        self.options[name] = value
+        if name in ("replace_placeholder", "fill_batchsize"):
+            value = int(value) // self.micro_batches
         name_raw = str(name).encode('ascii')
         value_raw = str(value).encode('ascii')
         libtge.set_option(self.graph, name_raw, len(name_raw), value_raw, len(value_raw))
 
+    @chain
+    def pipeline(self, micro_batches, schedule="1f1b"):
+        """
+        split each batch into micro_batches and pipeline them. The nodes that depend on the batch are replicated for each micro-batch, and their
+        outputs used by the shared nodes (i.e. the gradients) are summed. The stages are decided by the strategy, which still refers to the original
+        nodes, and the micro-batches on each device are ordered with control dependencies when compiling. The backward nodes are the ones under
+        the "gradients" scope. The batch size given to replace_placeholder or fill_batchsize is split into the micro-batches, and the profile
+        is looked up with the number of replicas multiplied by micro_batches. evaluate reports the bubbles as feedback["bubble_fraction"].
+        schedule: "gpipe" (all forward passes before all backward passes) or "1f1b" (alternate between them after filling the pipeline), or None
+        """
+        assert self.origins is None, "the graph is already pipelined"
+        graph_raw = self.graph_def.SerializeToString()
+        size = ctypes.c_uint32(0)
+        libtge.fuse_mini_batch(graph_raw, len(graph_raw), micro_batches, None, ctypes.byref(size))
+        buf = ctypes.create_string_buffer(size.value)
+        libtge.fuse_mini_batch(graph_raw, len(graph_raw), micro_batches, buf, ctypes.byref(size))
+        fused = type(self.graph_def)()
+        fused.ParseFromString(buf.raw)
+
+        index = { node.name: i for i, node in enumerate(self.graph_def.node) }
+        nodes = { node.name: node for node in fused.node }
+        def origin(node):
+            if "_tge_origin" in node.attr:
+                return index[node.attr["_tge_origin"].s.decode()]
+            if node.name in index:
+                return index[node.name]
+            return origin(nodes[node.input[0].split(':')[0]]) # the sums follow the placement of the summed tensors
+        self.origins = np.array([origin(node) for node in fused.node], dtype=np.int64)
+
+        # the op feedback is written to the last replica of each node, see evaluate in lib.rs
+        self.representatives = np.zeros(len(self.graph_def.node), dtype=np.int64)
+        for i, node in enumerate(fused.node):
+            if "_tge_origin" in node.attr or node.name in index:
+                self.representatives[self.origins[i]] = i
+
+        libtge.destroy_graph(self.graph)
+        self.graph = _create_graph(fused)
+        self.graph_def = fused
+        self.edited = False
+        self.compiled = False
+        self.micro_batches = micro_batches
+        self.pipeline_schedule = schedule
+        for name, value in list(self.options.items()):
+            self._set_option(name, value)
+
     @chain
     def replace_placeholder(self, batchsize):
         self._set_option("replace_placeholder", batchsize)
@@ -301,4 +792,8 @@ class TGE:
         #    2: all reduce via GRPC ring
         #    3: all reduce via NCCL operator (does not support multiple machine)
         #    4: broadcasting and duplicating
+        #    5: (on forward nodes) recompute the outputs for the nodes under the "gradients" scope instead of keeping them alive through the
+        #       forward pass. Connected marked nodes are recomputed together once the gradients reach them, so leave the layer boundaries unmarked
+        #    6: hierarchical all reduce: sum on each machine, all reduce among the machines via collective operator, then copy back on each machine
+        # alternatively, a tuple of node-indexed arrays (methods, placements) can be used, where methods is shaped [node] and placements is shaped [node, device]
         self.strategy = strategy
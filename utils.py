@@ -99,6 +99,20 @@ def group_around_topk_costs(gdef, groups, cost, k):
 
     return list(groupby(enumerate(result), key=cadr, value=car).values())
 
+from contextlib import contextmanager
+@contextmanager
+def measure_time(name):
+    import time
+    tic = time.perf_counter()
+    yield
+    toc = time.perf_counter()
+    print("{}: {:.3g}s".format(name, toc - tic))
+
+def synthetic_profile(gdef, ndev, nreps=(1, 2, 4, 8)):
+    # random times so that the ranks are not dominated by ties. No device is needed to build it.
+    import numpy as np
+    return { (node.name, nrep): np.random.randint(1, 100, ndev).tolist() for node in gdef.node for nrep in nreps }
+
 def save(var, file):
     import pickle
     with open(file, 'wb') as f: